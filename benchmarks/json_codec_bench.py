@@ -0,0 +1,90 @@
+"""
+Compare the standard library and orjson on the payloads the server handles most.
+
+    python benchmarks/json_codec_bench.py [--iterations N]
+
+Each payload is checked to encode to identical bytes with both backends before timing.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def make_message(i):
+    message = {
+        "user": f"user{i % 40}",
+        "content": f"Message number {i} with some text, an emoji 🎉 and non-ASCII café",
+        "timestamp": 1752000000.123456 + i,
+        "type": "message",
+        "pinned": False,
+        "id": str(uuid.UUID(int=i))
+    }
+    if i % 5 == 1:
+        message["reply_to"] = {"id": str(uuid.UUID(int=i - 1)), "user": f"user{(i - 1) % 40}"}
+    return message
+
+def make_payloads():
+    channels = [
+        {
+            "type": "text",
+            "name": f"channel-{i}",
+            "description": f"Channel number {i}",
+            "permissions": {"view": ["user"], "send": ["user"], "delete": ["owner"]}
+        }
+        for i in range(20)
+    ]
+    return {
+        "message_new frame": {"cmd": "message_new", "message": make_message(1), "channel": "general", "global": True},
+        "messages_get (100)": {"cmd": "messages_get", "channel": "general", "messages": [make_message(i) for i in range(100)]},
+        "channels_get (20)": {"cmd": "channels_get", "val": channels},
+        "channel file (5000)": [make_message(i) for i in range(5000)]
+    }
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode("utf-8")
+
+def bench(func, arg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    if orjson is None:
+        print("orjson is not installed, only the standard library will be measured")
+
+    print(f"{'payload':<22}{'size':>10}  {'op':<8}{'json us':>12}{'orjson us':>12}{'speedup':>10}")
+    for name, payload in make_payloads().items():
+        encoded = stdlib_dumps(payload)
+        iterations = max(1, args.iterations // 50) if len(encoded) > 100000 else args.iterations
+        if orjson is not None:
+            assert orjson.dumps(payload) == encoded, f"{name}: orjson output differs"
+
+        rows = [
+            ("encode", stdlib_dumps, orjson.dumps if orjson else None, payload),
+            ("decode", json.loads, orjson.loads if orjson else None, encoded)
+        ]
+        for op, std_func, fast_func, arg in rows:
+            std_us = bench(std_func, arg, iterations)
+            if fast_func is None:
+                print(f"{name:<22}{len(encoded):>10}  {op:<8}{std_us:>12.1f}{'-':>12}{'-':>10}")
+                continue
+            fast_us = bench(fast_func, arg, iterations)
+            print(f"{name:<22}{len(encoded):>10}  {op:<8}{std_us:>12.1f}{fast_us:>12.1f}{std_us / fast_us:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""
+Publish/subscribe brokers that carry broadcasts between server nodes.
+
+A node is one server process, one of several workers on a host or one of
+several hosts. Nodes publish frames on named channels and receive the frames
+other nodes publish on the channels they subscribed to. A node never receives
+its own frames, it delivers to its local sockets itself.
+
+Brokers implement the Broker interface:
+- MemoryBroker links nodes that run in the same process, through a MemoryExchange.
+- SocketBroker connects to a BrokerServer over a Unix domain socket, as the
+  workers started by the supervisor do, or over TCP, to link several hosts.
+- BrokerServer is a small stand-in broker. Run `python broker.py --port 5700`
+  for a standalone one that nodes on other hosts can reach.
+
+Other brokers (Redis, NATS, ...) can be plugged in by implementing the same
+interface and returning them from build_broker.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import struct
+import json_codec
+from logger import Logger
+
+# Socket frames are a 4-byte big-endian length followed by a JSON object:
+#   {"op": "hello", "n": node}           first frame of every connection
+#   {"op": "sub" | "unsub", "c": channel}
+#   {"op": "pub", "c": channel, "n": sending node, "d": frame}
+_HEADER = struct.Struct(">I")
+
+# Published by the broker itself when a node disconnects, with that node as sender
+NODE_DOWN = "node_down"
+
+def pack_frame(frame) -> bytes:
+    payload = json_codec.dumps_bytes(frame)
+    return _HEADER.pack(len(payload)) + payload
+
+async def read_raw_frame(reader) -> bytes:
+    header = await reader.readexactly(_HEADER.size)
+    return header + await reader.readexactly(_HEADER.unpack(header)[0])
+
+def unpack_frame(raw: bytes):
+    return json_codec.loads(raw[_HEADER.size:])
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class Broker:
+    """
+    Interface of a broker, as seen by one node.
+
+    Callbacks subscribed to a channel are called on the node's event loop with
+    (frame, sending node) for every frame other nodes publish on it, one at a
+    time and in order. They may be coroutines. Frames must be JSON-serializable.
+    Callbacks registered with on_connect run every time the node (re)joins the
+    broker, after its subscriptions are in place.
+    """
+
+    def __init__(self, node_id=None):
+        self.node_id = node_id if node_id is not None else default_node_id()
+        self.subscribers = {}
+        self.connect_callbacks = []
+
+    def subscribe(self, channel: str, callback):
+        callbacks = self.subscribers.setdefault(channel, [])
+        callbacks.append(callback)
+        if len(callbacks) == 1:
+            self._channel_added(channel)
+
+    def unsubscribe(self, channel: str, callback):
+        callbacks = self.subscribers.get(channel)
+        if not callbacks or callback not in callbacks:
+            return
+        callbacks.remove(callback)
+        if not callbacks:
+            del self.subscribers[channel]
+            self._channel_removed(channel)
+
+    def on_connect(self, callback):
+        self.connect_callbacks.append(callback)
+
+    def publish(self, channel: str, frame=None):
+        """Send a frame to the other nodes subscribed to the channel, returns False if it was dropped"""
+        raise NotImplementedError
+
+    async def start(self):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    def _channel_added(self, channel):
+        pass
+
+    def _channel_removed(self, channel):
+        pass
+
+    async def _dispatch(self, channel, frame, node):
+        for callback in list(self.subscribers.get(channel, ())):
+            try:
+                result = callback(frame, node)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                Logger.error(f"Error handling broker frame on '{channel}': {str(e)}")
+
+    async def _connected(self):
+        for callback in list(self.connect_callbacks):
+            try:
+                result = callback()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                Logger.error(f"Error in broker connect callback: {str(e)}")
+
+class MemoryExchange:
+    """Shared by the MemoryBrokers of nodes running in one process"""
+
+    def __init__(self):
+        self.nodes = {}
+
+    def route(self, channel, frame, sender):
+        for node_id, broker in list(self.nodes.items()):
+            if node_id != sender and channel in broker.subscribers:
+                broker._queue.put_nowait((channel, frame, sender))
+
+    def leave(self, node_id):
+        if self.nodes.pop(node_id, None) is not None:
+            self.route(NODE_DOWN, None, node_id)
+
+class MemoryBroker(Broker):
+    """
+    In-process broker. Frames are handed over as-is, without encoding, and
+    must not be modified after publishing.
+    """
+
+    def __init__(self, exchange: MemoryExchange = None, node_id=None):
+        super().__init__(node_id)
+        self.exchange = exchange if exchange is not None else MemoryExchange()
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def publish(self, channel: str, frame=None):
+        if self._task is None:
+            return False
+        self.exchange.route(channel, frame, self.node_id)
+        return True
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        self.exchange.nodes[self.node_id] = self
+        await self._connected()
+
+    async def _run(self):
+        while True:
+            await self._dispatch(*await self._queue.get())
+
+    async def close(self):
+        self.exchange.leave(self.node_id)
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+class SocketBroker(Broker):
+    """
+    Connection to a BrokerServer, over a Unix domain socket when `path` is
+    given and over TCP otherwise. Reconnects and restores its subscriptions
+    when the connection is lost. Frames published while disconnected are dropped.
+    """
+
+    def __init__(self, node_id=None, path: str = None, host: str = "127.0.0.1", port: int = 5700,
+                 max_reconnect_delay: float = 5.0):
+        super().__init__(node_id)
+        self.path = path
+        self.host = host
+        self.port = port
+        self.max_reconnect_delay = max_reconnect_delay
+        self.writer = None
+        self._task = None
+        self._closing = False
+
+    @property
+    def address(self):
+        return self.path or f"{self.host}:{self.port}"
+
+    def publish(self, channel: str, frame=None):
+        return self._send({"op": "pub", "c": channel, "n": self.node_id, "d": frame})
+
+    def _send(self, frame):
+        if self.writer is None or self.writer.is_closing():
+            return False
+        self.writer.write(pack_frame(frame))
+        return True
+
+    def _channel_added(self, channel):
+        self._send({"op": "sub", "c": channel})
+
+    def _channel_removed(self, channel):
+        self._send({"op": "unsub", "c": channel})
+
+    async def start(self):
+        await self._connect()
+
+    async def _connect(self):
+        delay = 0.1
+        while True:
+            try:
+                if self.path:
+                    reader, writer = await asyncio.open_unix_connection(self.path)
+                else:
+                    reader, writer = await asyncio.open_connection(self.host, self.port)
+                break
+            except OSError:
+                # Refused, unreachable, timed out or no socket file yet: retry with backoff
+                if self._closing:
+                    return
+                await asyncio.sleep(delay)
+                delay = min(self.max_reconnect_delay, delay * 2)
+        self.writer = writer
+        self._send({"op": "hello", "n": self.node_id})
+        for channel in self.subscribers:
+            self._send({"op": "sub", "c": channel})
+        self._task = asyncio.get_running_loop().create_task(self._read(reader))
+        await self._connected()
+
+    async def _read(self, reader):
+        try:
+            while True:
+                frame = unpack_frame(await read_raw_frame(reader))
+                await self._dispatch(frame["c"], frame.get("d"), frame["n"])
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        if not self._closing:
+            Logger.error(f"Node {self.node_id} lost the broker connection to {self.address}, reconnecting")
+            self.writer = None
+            await self._connect()
+
+    async def close(self):
+        self._closing = True
+        if self._task:
+            self._task.cancel()
+        if self.writer:
+            self.writer.close()
+
+class BrokerServer:
+    """
+    Stand-in broker for SocketBrokers, on a Unix domain socket when `path` is
+    given and on TCP otherwise. Each published frame is forwarded unchanged to
+    the other connections subscribed to its channel.
+    """
+
+    def __init__(self, path: str = None, host: str = "127.0.0.1", port: int = 5700):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.server = None
+        # channel -> set of writers subscribed to it
+        self.channels = {}
+
+    @property
+    def address(self):
+        return self.path or f"{self.host}:{self.port}"
+
+    async def start(self):
+        if self.path:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.server = await asyncio.start_unix_server(self._handle_node, path=self.path)
+        else:
+            self.server = await asyncio.start_server(self._handle_node, self.host, self.port)
+        Logger.success(f"Broker listening on {self.address}")
+
+    async def _handle_node(self, reader, writer):
+        node_id = None
+        subscribed = set()
+        try:
+            node_id = unpack_frame(await read_raw_frame(reader))["n"]
+            while True:
+                raw = await read_raw_frame(reader)
+                frame = unpack_frame(raw)
+                op = frame["op"]
+                if op == "pub":
+                    self._route(frame["c"], raw, writer)
+                elif op == "sub":
+                    self.channels.setdefault(frame["c"], set()).add(writer)
+                    subscribed.add(frame["c"])
+                elif op == "unsub":
+                    self._unsubscribe(frame["c"], writer)
+                    subscribed.discard(frame["c"])
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        except Exception as e:
+            Logger.error(f"Broker dropped node {node_id}: {str(e)}")
+        finally:
+            for channel in subscribed:
+                self._unsubscribe(channel, writer)
+            if node_id is not None:
+                self._route(NODE_DOWN, pack_frame({"op": "pub", "c": NODE_DOWN, "n": node_id, "d": None}), writer)
+            writer.close()
+
+    def _route(self, channel, raw: bytes, sender):
+        for writer in list(self.channels.get(channel, ())):
+            if writer is not sender:
+                writer.write(raw)
+
+    def _unsubscribe(self, channel, writer):
+        writers = self.channels.get(channel)
+        if writers is not None:
+            writers.discard(writer)
+            if not writers:
+                del self.channels[channel]
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+def build_broker(config, node_id=None, bus_path=None):
+    """
+    The broker a node should use: the TCP broker in cluster.broker if one is
+    configured, else the supervisor's local bus at bus_path. None for a
+    single standalone server.
+    """
+    broker_config = config.get("cluster", {}).get("broker")
+    if broker_config:
+        return SocketBroker(node_id, host=broker_config.get("host", "127.0.0.1"), port=broker_config.get("port", 5700))
+    if bus_path:
+        return SocketBroker(node_id, path=bus_path)
+    return None
+
+async def serve(host, port):
+    server = BrokerServer(host=host, port=port)
+    await server.start()
+    try:
+        await asyncio.Future()
+    finally:
+        await server.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a standalone OriginChats broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5700)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        Logger.warning("Broker stopped by user")
@@ -0,0 +1,71 @@
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+from broker import BrokerServer
+from logger import Logger
+
+def default_bus_path(config) -> str:
+    port = config.get("websocket", {}).get("port", 5613)
+    return os.path.join(tempfile.gettempdir(), f"originchats-{port}.sock")
+
+class Supervisor:
+    """
+    Runs `workers` server processes sharing the websocket port (SO_REUSEPORT)
+    and, unless cluster.broker points them at an external broker, the local
+    bus linking them. Workers that exit are restarted.
+    """
+
+    def __init__(self, config, workers: int, config_path: str = "config.json", restart_delay: float = 1.0):
+        self.config = config
+        self.workers = workers
+        self.config_path = config_path
+        self.restart_delay = restart_delay
+        cluster_config = config.get("cluster", {})
+        if cluster_config.get("broker"):
+            self.bus_path = None
+            self.hub = None
+        else:
+            self.bus_path = cluster_config.get("bus_socket") or default_bus_path(config)
+            self.hub = BrokerServer(path=self.bus_path)
+        self.processes = {}
+        self._stopping = False
+
+    async def run(self):
+        if self.hub:
+            await self.hub.start()
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, lambda: stopped.done() or stopped.set_result(None))
+
+        monitors = [loop.create_task(self._run_worker(worker_id)) for worker_id in range(self.workers)]
+        Logger.success(f"Supervisor started {self.workers} workers")
+        try:
+            await stopped
+        finally:
+            self._stopping = True
+            for process in self.processes.values():
+                if process.returncode is None:
+                    process.terminate()
+            await asyncio.gather(*monitors, return_exceptions=True)
+            if self.hub:
+                await self.hub.stop()
+            Logger.info("Supervisor stopped")
+
+    async def _run_worker(self, worker_id: int):
+        while not self._stopping:
+            args = ["--config", self.config_path, "--worker-id", str(worker_id)]
+            if self.bus_path:
+                args += ["--bus", self.bus_path]
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "init.py"), *args
+            )
+            self.processes[worker_id] = process
+            Logger.info(f"Worker {worker_id} started (pid {process.pid})")
+            returncode = await process.wait()
+            if self._stopping:
+                break
+            Logger.error(f"Worker {worker_id} exited with code {returncode}, restarting")
+            await asyncio.sleep(self.restart_delay)
@@ -1,10 +1,32 @@
-import json, os
+import os
+import sys
+import time
+import functools
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json_codec
+from .locking import serialized as _serialized, write_lock, write_json
+from . import timeindex, segments, search, user_index
 
 _MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 channels_db_dir = os.path.join(_MODULE_DIR, "channels")
 channels_index = os.path.join(_MODULE_DIR, "channels.json")
 
+# Each channel has a change log next to its messages, one JSON object per line:
+#   {"rev": 12, "op": "add" | "edit" | "delete", "id": "<message id>", "ts": <unix time>}
+# The first line is always {"rev": r, "op": "start", "ts": t}: every change after
+# revision r and after time t is in the log. Older changes are trimmed away once
+# the log outgrows CHANGE_LOG_MAX_BYTES.
+CHANGE_LOG_MAX_BYTES = 512 * 1024
+
+def _channel_serialized(func):
+    """Run a read-modify-write of a channel's messages while holding that channel's lock"""
+    @functools.wraps(func)
+    def wrapper(channel_name, *args, **kwargs):
+        with segments.channel_lock(channel_name):
+            return func(channel_name, *args, **kwargs)
+    return wrapper
+
 def get_channel(channel_name):
     """
     Get channel data by channel name.
@@ -26,15 +48,27 @@ def get_channel_messages(channel_name, limit=100):
     Returns:
         list: A list of messages from the specified channel.
     """
-    # Load the channel data
-    try:
-        with open(f"{channels_db_dir}/{channel_name}.json", 'r') as f:
-            channel_data = json.load(f)
-    except FileNotFoundError:
-        return []
+    # Only the newest segments are read
+    return [msg for _, msg in segments.read_last(channel_name, limit)]
 
-    # Return the last 'limit' messages
-    return channel_data[-limit:]
+def get_messages_before(channel_name, before, limit=100, before_id=None):
+    """
+    Retrieve the messages sent before a message, to page back through a channel's history.
+
+    Args:
+        channel_name (str): The name of the channel.
+        before (float): Unix timestamp of the oldest message the client has.
+        limit (int): The maximum number of messages to retrieve.
+        before_id (str): ID of that message. Messages are ordered by timestamp and then
+            ID, so messages sharing its timestamp are not skipped. Without it, only
+            messages sent strictly before `before` are returned.
+
+    Returns:
+        tuple: (messages, more), the last `limit` messages before it, oldest first,
+        and whether there are older ones.
+    """
+    # Segments are read one at a time from the newest, archived ones decompressed only when reached
+    return segments.read_before(channel_name, before, limit, before_id)
 
 def save_channel_message(channel_name, message):
     """
@@ -45,26 +79,158 @@ def save_channel_message(channel_name, message):
         message (dict): The message to save, should contain 'user', 'content', and 'timestamp'.
 
     Returns:
-        bool: True if the message was saved successfully, False otherwise.
+        int: The channel's revision after the message was added.
+    """
+    return save_channel_messages(channel_name, [message])
+
+@_channel_serialized
+def save_channel_messages(channel_name, messages):
+    """
+    Append several messages to a channel with a single file write.
+
+    Args:
+        channel_name (str): The name of the channel to save the messages to.
+        messages (list): The messages to append, in order.
+
+    Returns:
+        int: The channel's revision after the messages were added. The i-th of n
+        messages was added at revision rev - n + 1 + i.
+    """
+    # Append the new messages to the channel's newest segment
+    segments.append(channel_name, messages)
+    search.index_messages(channel_name, messages)
+    user_index.record_messages(channel_name, messages)
+    ids = [message.get("id") for message in messages]
+    return _log_changes(channel_name, "add", ids)
+
+def _changes_path(channel_name):
+    return f"{channels_db_dir}/{channel_name}.changes"
+
+def _read_last_line(path):
+    """Last line of a file, read from the end"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 4096))
+        lines = f.read().splitlines()
+    return lines[-1] if lines else None
+
+def get_channel_rev(channel_name):
+    """
+    Get the revision of a channel: the number of the last change to its messages.
+
+    Args:
+        channel_name (str): The name of the channel.
+
+    Returns:
+        int: The channel's revision, 0 if it has no logged changes.
+    """
+    try:
+        last_line = _read_last_line(_changes_path(channel_name))
+    except FileNotFoundError:
+        return 0
+    return json_codec.loads(last_line)["rev"] if last_line else 0
+
+def _log_changes(channel_name, op, ids):
+    """Append changes to the channel's change log, returns the new revision. Called holding the channel's lock."""
+    path = _changes_path(channel_name)
+    now = time.time()
+    rev = get_channel_rev(channel_name)
+    lines = []
+    if rev == 0 and not os.path.exists(path):
+        lines.append(json_codec.dumps({"rev": 0, "op": "start", "ts": now}))
+    for message_id in ids:
+        rev += 1
+        lines.append(json_codec.dumps({"rev": rev, "op": op, "id": message_id, "ts": now}))
+    with open(path, 'a') as f:
+        f.write("\n".join(lines) + "\n")
+        size = f.tell()
+    if size > CHANGE_LOG_MAX_BYTES:
+        _trim_changes(channel_name)
+    return rev
+
+def _trim_changes(channel_name):
+    """Drop the older half of a change log, moving its start marker forward"""
+    path = _changes_path(channel_name)
+    with open(path, 'r') as f:
+        entries = [json_codec.loads(line) for line in f if line.strip()]
+    changes = entries[1:]
+    dropped, kept = changes[:len(changes) // 2], changes[len(changes) // 2:]
+    if not dropped:
+        return
+    start = {"rev": dropped[-1]["rev"], "op": "start", "ts": dropped[-1]["ts"]}
+    directory = os.path.dirname(path)
+    tmp_path = os.path.join(directory, f".{channel_name}.changes.tmp")
+    with open(tmp_path, 'w') as f:
+        f.write("\n".join(json_codec.dumps(entry) for entry in [start] + kept) + "\n")
+    os.replace(tmp_path, path)
+
+def get_changes_since(channel_name, rev=None, timestamp=None):
+    """
+    Get the logged changes to a channel's messages after a revision or a point in time.
+
+    Args:
+        channel_name (str): The name of the channel.
+        rev (int): Return changes after this revision.
+        timestamp (float): Return changes made after this unix time, used when rev is None.
+
+    Returns:
+        list: The change entries, oldest first, or None if the log no longer goes back that far.
     """
-    # Ensure the channels directory exists
-    os.makedirs(channels_db_dir, exist_ok=True)
-    
-    # Load existing channel data or create a new one
     try:
-        with open(f"{channels_db_dir}/{channel_name}.json", 'r') as f:
-            channel_data = json.load(f)
+        with open(_changes_path(channel_name), 'r') as f:
+            entries = [json_codec.loads(line) for line in f if line.strip()]
     except FileNotFoundError:
-        channel_data = []
+        entries = []
+    if not entries:
+        # Nothing was logged yet, so only a client that is up to date can be answered
+        return [] if rev == 0 else None
 
-    # Append the new message
-    channel_data.append(message)
+    start = entries[0]
+    if rev is not None:
+        # Older than the log, or newer than any change, as after the database was replaced
+        if rev < start["rev"] or rev > entries[-1]["rev"]:
+            return None
+        return [entry for entry in entries[1:] if entry["rev"] > rev]
+    if timestamp < start["ts"]:
+        return None
+    return [entry for entry in entries[1:] if entry["ts"] > timestamp]
 
-    # Save the updated channel data with compact formatting
-    with open(f"{channels_db_dir}/{channel_name}.json", 'w') as f:
-        json.dump(channel_data, f, separators=(',', ':'), ensure_ascii=False)
+def get_messages_since(channel_name, rev=None, timestamp=None):
+    """
+    Get what changed in a channel after a revision or a point in time.
 
-    return True
+    Args:
+        channel_name (str): The name of the channel.
+        rev (int): Return changes after this revision.
+        timestamp (float): Return changes made after this unix time, used when rev is None.
+
+    Returns:
+        dict: {"messages": [...], "deleted": [...], "rev": int}, where messages are the
+        current versions of messages added or edited since, oldest first, and deleted
+        are tombstones {"id", "rev", "ts"} of messages deleted since. None if the change
+        log no longer goes back that far and the channel has to be fetched again.
+    """
+    changes = get_changes_since(channel_name, rev, timestamp)
+    if changes is None:
+        return None
+
+    changed, deleted = set(), {}
+    for entry in changes:
+        if entry["op"] == "delete":
+            changed.discard(entry["id"])
+            deleted[entry["id"]] = {"id": entry["id"], "rev": entry["rev"], "ts": entry["ts"]}
+        else:
+            changed.add(entry["id"])
+            deleted.pop(entry["id"], None)
+
+    messages = []
+    if changed:
+        # Changed messages are usually recent, only the segments holding them are read
+        messages = [msg for _, msg in segments.find_messages(channel_name, changed)]
+
+    current_rev = changes[-1]["rev"] if changes else (rev if rev is not None else get_channel_rev(channel_name))
+    return {"messages": messages, "deleted": list(deleted.values()), "rev": current_rev}
 
 def get_all_channels_for_roles(roles):
     """
@@ -76,19 +242,33 @@ def get_all_channels_for_roles(roles):
     Returns:
         list: A list of channel info dicts available for the specified roles.
     """
-    channels = []
     try:
         with open(channels_index, 'r') as f:
-            all_channels = json.load(f)
-        for channel in all_channels:
-            permissions = channel.get("permissions", {})
-            view_roles = permissions.get("view", [])
-            if any(role in view_roles for role in roles):
-                channels.append(channel)
+            all_channels = json_codec.load(f)
     except FileNotFoundError:
         return []
+    return filter_channels_for_roles(all_channels, roles)
+
+def filter_channels_for_roles(all_channels, roles):
+    """
+    Filter an already loaded channel list down to the channels the roles can view.
+
+    Args:
+        all_channels (list): Channel info dicts, as stored in the channels index.
+        roles (iterable): The roles to filter channels by.
+
+    Returns:
+        list: The channel info dicts viewable by at least one of the roles.
+    """
+    channels = []
+    for channel in all_channels:
+        permissions = channel.get("permissions", {})
+        view_roles = permissions.get("view", [])
+        if any(role in view_roles for role in roles):
+            channels.append(channel)
     return channels
 
+@_channel_serialized
 def edit_channel_message(channel_name, message_id, new_content):
     """
     Edit a message in a specific channel.
@@ -99,28 +279,16 @@ def edit_channel_message(channel_name, message_id, new_content):
         new_content (str): The new content for the message.
 
     Returns:
-        bool: True if the message was edited successfully, False otherwise.
+        int: The channel's revision after the edit, or False if the message was not found.
     """
-    try:
-        with open(f"{channels_db_dir}/{channel_name}.json", 'r') as f:
-            channel_data = json.load(f)
-
-        for msg in channel_data:
-            if msg.get("id") == message_id:
-                msg["content"] = new_content
-                break
-        else:
-            return False  # Message not found
-
-        # Ensure the channels directory exists
-        os.makedirs(channels_db_dir, exist_ok=True)
-        
-        with open(f"{channels_db_dir}/{channel_name}.json", 'w') as f:
-            json.dump(channel_data, f, separators=(',', ':'), ensure_ascii=False)
+    segment, old_msg = segments.find_message(channel_name, message_id)
+    if old_msg is None:
+        return False  # Message not found
 
-        return True
-    except FileNotFoundError:
-        return False
+    # Recorded as a patch of the message's segment, the segment is rewritten later by the compactor
+    segments.add_patches(channel_name, [(segment, {"op": "edit", "id": message_id, "set": {"content": new_content}})])
+    search.update_message(channel_name, old_msg, dict(old_msg, content=new_content))
+    return _log_changes(channel_name, "edit", [message_id])
 
 def get_channel_message(channel_name, message_id):
     """
@@ -133,16 +301,8 @@ def get_channel_message(channel_name, message_id):
     Returns:
         dict: The message if found, None otherwise.
     """
-    try:
-        with open(f"{channels_db_dir}/{channel_name}.json", 'r') as f:
-            channel_data = json.load(f)
-
-        for msg in channel_data:
-            if msg.get("id") == message_id:
-                return msg
-        return None  # Message not found
-    except FileNotFoundError:
-        return None  # Channel not found
+    _, msg = segments.find_message(channel_name, message_id)
+    return msg
     
 def does_user_have_permission(channel_name, user_roles, permission_type):
     """
@@ -158,7 +318,7 @@ def does_user_have_permission(channel_name, user_roles, permission_type):
     """
     try:
         with open(channels_index, 'r') as f:
-            channels_data = json.load(f)
+            channels_data = json_codec.load(f)
 
         for channel in channels_data:
             if channel.get("name") == channel_name:
@@ -170,6 +330,7 @@ def does_user_have_permission(channel_name, user_roles, permission_type):
 
     return False  # Channel not found
     
+@_channel_serialized
 def delete_channel_message(channel_name, message_id):
     """
     Delete a message from a specific channel.
@@ -179,23 +340,17 @@ def delete_channel_message(channel_name, message_id):
         message_id (str): The ID of the message to delete.
 
     Returns:
-        bool: True if the message was deleted successfully, False otherwise.
+        int: The channel's revision after the delete, or False if the message was not found.
     """
-    try:
-        with open(f"{channels_db_dir}/{channel_name}.json", 'r') as f:
-            channel_data = json.load(f)
-
-        new_data = [msg for msg in channel_data if msg.get("id") != message_id]
-
-        # Ensure the channels directory exists
-        os.makedirs(channels_db_dir, exist_ok=True)
-        
-        with open(f"{channels_db_dir}/{channel_name}.json", 'w') as f:
-            json.dump(new_data, f, separators=(',', ':'), ensure_ascii=False)
-
-        return True
-    except FileNotFoundError:
+    segment, msg = segments.find_message(channel_name, message_id)
+    if msg is None:
         return False
+
+    # A tombstone in the message's segment, removed with the message by the compactor
+    segments.add_patches(channel_name, [(segment, {"op": "del", "id": message_id})])
+    search.remove_messages(channel_name, [msg])
+    user_index.remove_messages(channel_name, [msg])
+    return _log_changes(channel_name, "delete", [message_id])
     
 def get_channels():
     """
@@ -206,10 +361,11 @@ def get_channels():
     """
     try:
         with open(channels_index, 'r') as f:
-            return json.load(f)
+            return json_codec.load(f)
     except FileNotFoundError:
         return []  # No channels found
     
+@_serialized
 def create_channel(channel_name, channel_type):
     """
     Create a new channel.
@@ -223,7 +379,7 @@ def create_channel(channel_name, channel_type):
     """
     try:
         with open(channels_index, 'r') as f:
-            channels = json.load(f)
+            channels = json_codec.load(f)
     except FileNotFoundError:
         channels = []
 
@@ -243,8 +399,7 @@ def create_channel(channel_name, channel_type):
     channels.append(new_channel)
 
     # Save the updated channels index
-    with open(channels_index, 'w') as f:
-        json.dump(channels, f, indent=4)
+    write_json(channels_index, channels, indented=True)
 
     return True
 
@@ -259,25 +414,34 @@ def delete_channel(channel_name):
         bool: True if the channel was deleted successfully, False if it does not exist.
     """
     try:
-        with open(channels_index, 'r') as f:
-            channels = json.load(f)
+        # The channel's lock is never taken while holding the write lock, only the other way round
+        with write_lock:
+            with open(channels_index, 'r') as f:
+                channels = json_codec.load(f)
 
-        new_channels = [channel for channel in channels if channel.get('name') != channel_name]
+            new_channels = [channel for channel in channels if channel.get('name') != channel_name]
 
-        if len(new_channels) == len(channels):
-            return False  # Channel not found
+            if len(new_channels) == len(channels):
+                return False  # Channel not found
 
-        # Save the updated channels index
-        with open(channels_index, 'w') as f:
-            json.dump(new_channels, f, indent=4)
+            # Save the updated channels index
+            write_json(channels_index, new_channels, indented=True)
 
-        # Remove the channel's message file
-        os.remove(f"{channels_db_dir}/{channel_name}.json")
+        # Remove the channel's segments and change log
+        with segments.channel_lock(channel_name):
+            if not segments.exists(channel_name):
+                return False
+            user_index.remove_messages(channel_name, segments.read_all(channel_name))
+            segments.drop(channel_name)
+            if os.path.exists(_changes_path(channel_name)):
+                os.remove(_changes_path(channel_name))
+            search.drop_channel(channel_name)
 
         return True
     except FileNotFoundError:
         return False  # Channels index not found
     
+@_serialized
 def set_channel_permissions(channel_name, role, permission, allow=True):
     """
     Set permissions for a specific role on a channel.
@@ -292,7 +456,7 @@ def set_channel_permissions(channel_name, role, permission, allow=True):
     """
     try:
         with open(channels_index, 'r') as f:
-            channels = json.load(f)
+            channels = json_codec.load(f)
 
         for channel in channels:
             if channel.get('name') == channel_name:
@@ -306,8 +470,7 @@ def set_channel_permissions(channel_name, role, permission, allow=True):
                             channel['permissions'][permission].remove(role)
                 
                 # Save the updated channels index
-                with open(channels_index, 'w') as f:
-                    json.dump(channels, f, indent=4)
+                write_json(channels_index, channels, indented=True)
                 
                 return True
         
@@ -327,7 +490,7 @@ def get_channel_permissions(channel_name):
     """
     try:
         with open(channels_index, 'r') as f:
-            channels = json.load(f)
+            channels = json_codec.load(f)
 
         for channel in channels:
             if channel.get('name') == channel_name:
@@ -337,6 +500,7 @@ def get_channel_permissions(channel_name):
     except FileNotFoundError:
         return None  # Channels index not found
     
+@_serialized
 def reorder_channel(channel_name, new_position):
     """
     Reorder a channel in the channels index.
@@ -350,7 +514,7 @@ def reorder_channel(channel_name, new_position):
     """
     try:
         with open(channels_index, 'r') as f:
-            channels = json.load(f)
+            channels = json_codec.load(f)
 
         for i, channel in enumerate(channels):
             if channel.get('name') == channel_name:
@@ -360,8 +524,7 @@ def reorder_channel(channel_name, new_position):
                 channels.insert(int(new_position), channel)
 
                 # Save the updated channels index
-                with open(channels_index, 'w') as f:
-                    json.dump(channels, f, indent=4)
+                write_json(channels_index, channels, indented=True)
                 
                 return True
         
@@ -381,21 +544,16 @@ def get_message_replies(channel_name, message_id, limit=50):
     Returns:
         list: A list of messages that are replies to the specified message.
     """
-    try:
-        with open(f"{channels_db_dir}/{channel_name}.json", 'r') as f:
-            channel_data = json.load(f)
-
-        replies = []
-        for msg in channel_data:
-            if msg.get("reply_to", {}).get("id") == message_id:
-                replies.append(msg)
-                if len(replies) >= limit:
-                    break
-        
-        return replies
-    except FileNotFoundError:
-        return []  # Channel not found
+    replies = []
+    for msg in segments.read_all(channel_name):
+        if msg.get("reply_to", {}).get("id") == message_id:
+            replies.append(msg)
+            if len(replies) >= limit:
+                break
+
+    return replies
     
+@_channel_serialized
 def purge_messages(channel_name, count):
     """
     Purge the last 'count' messages from a channel.
@@ -407,23 +565,194 @@ def purge_messages(channel_name, count):
     Returns:
         bool: True if messages were purged successfully, False if the channel does not exist or has fewer messages.
     """
-    try:
-        with open(f"{channels_db_dir}/{channel_name}.json", 'r') as f:
-            channel_data = json.load(f)
+    if not segments.exists(channel_name):
+        return False  # Channel not found
 
-        if len(channel_data) < count:
-            return False  # Not enough messages to purge
+    last = segments.read_last(channel_name, count)
+    if len(last) < count:
+        return False  # Not enough messages to purge
 
-        # Remove the last 'count' messages
-        new_data = channel_data[:-count]
+    # Tombstones for the last 'count' messages
+    _delete_located(channel_name, last)
 
-        # Save the updated channel data
-        with open(f"{channels_db_dir}/{channel_name}.json", 'w') as f:
-            json.dump(new_data, f, separators=(',', ':'), ensure_ascii=False)
+    return True
 
-        return True
-    except FileNotFoundError:
-        return False  # Channel not found
+def get_messages_in_range(channel_name, start=None, end=None, limit=100):
+    """
+    Get the messages of a channel sent within a time range, using the channel's timestamp index.
+
+    Args:
+        channel_name (str): The name of the channel.
+        start (float): Earliest unix timestamp to include, None for no lower bound.
+        end (float): Latest unix timestamp to include, None for no upper bound.
+        limit (int): The maximum number of messages to return, None for all of them.
+
+    Returns:
+        tuple: (messages, more), the oldest `limit` messages in the range and whether
+        the range holds more of them.
+    """
+    messages = [msg for _, msg in segments.read_range(
+        channel_name,
+        start if start is not None else float("-inf"),
+        end if end is not None else float("inf")
+    )]
+    if limit is None:
+        return messages, False
+    return messages[:limit], len(messages) > limit
+
+def get_channel_message_at(channel_name, message_id, timestamp):
+    """
+    Retrieve a message whose timestamp is known, reading only the part of the channel around it.
+
+    Args:
+        channel_name (str): The name of the channel.
+        message_id (str): The ID of the message to retrieve.
+        timestamp (float): The message's timestamp.
+
+    Returns:
+        dict: The message if found, None otherwise.
+    """
+    messages, _ = get_messages_in_range(channel_name, timestamp, timestamp, limit=None)
+    for msg in messages:
+        if msg.get("id") == message_id:
+            return msg
+    return None
+
+@_channel_serialized
+def purge_messages_after(channel_name, timestamp):
+    """
+    Purge every message of a channel sent after a point in time.
+
+    Args:
+        channel_name (str): The name of the channel.
+        timestamp (float): Unix timestamp, messages sent after it are removed.
+
+    Returns:
+        int: The number of messages purged, None if the channel has no stored messages.
+    """
+    if not segments.exists(channel_name):
+        return None
+
+    # Only the segments holding newer messages are read, found with their timestamp indexes
+    purged = [(segment, msg) for segment, msg in segments.read_range(channel_name, timestamp, float("inf"))
+              if timeindex.message_timestamp(msg) > timestamp]
+    if purged:
+        _delete_located(channel_name, purged)
+
+    return len(purged)
+
+def _delete_located(channel_name, located):
+    """Delete messages given as (segment number, message) tuples, with one change log entry per message"""
+    segments.add_patches(channel_name, [(segment, {"op": "del", "id": msg.get("id")}) for segment, msg in located])
+    _forget_messages(channel_name, [msg for _, msg in located])
+
+def _forget_messages(channel_name, deleted):
+    """Remove deleted messages from the indexes and record their deletion"""
+    search.remove_messages(channel_name, deleted)
+    user_index.remove_messages(channel_name, deleted)
+    ids = [msg.get("id") for msg in deleted]
+    _log_changes(channel_name, "delete", ids)
+
+def purge_user_messages(username, channel_name=None):
+    """
+    Purge every message a user sent, with one batch of tombstones per channel.
+
+    Args:
+        username (str): The user whose messages are purged, case-insensitive.
+        channel_name (str): Only purge messages of this channel.
+
+    Returns:
+        dict: The number of messages purged in each channel, by channel name, None
+        while the user message index is being built.
+    """
+    refs = user_index.get_user_messages(username, channel_name)
+    if refs is None:
+        return None
+    ids_by_channel = {}
+    for ref_channel, message_id, _ in refs:
+        ids_by_channel.setdefault(ref_channel, set()).add(message_id)
+
+    purged = {}
+    for ref_channel, ids in ids_by_channel.items():
+        with segments.channel_lock(ref_channel):
+            removed = [(segment, msg) for segment, msg in segments.find_messages(ref_channel, ids)
+                       if str(msg.get("user")).lower() == username.lower()]
+            if not removed:
+                continue
+            _delete_located(ref_channel, removed)
+        purged[ref_channel] = len(removed)
+
+    return purged
+
+def enforce_retention(channel_name, retention, limit=50):
+    """
+    Take one bounded step towards a channel's retention policy, removing its oldest messages.
+
+    The oldest segment is removed whole when every message in it is past the
+    policy, or when the channel is over max_bytes and it is not the only
+    segment. Otherwise up to `limit` of its oldest messages are deleted. The
+    step is planned without the channel's lock, which is only held while the
+    messages are removed.
+
+    Args:
+        channel_name (str): The name of the channel.
+        retention (dict): The channel's policy, any of max_messages, max_age_days and max_bytes.
+        limit (int): The maximum number of messages deleted one by one in this step.
+
+    Returns:
+        list: The messages removed, None if the channel already meets its policy.
+    """
+    max_messages = retention.get("max_messages")
+    max_age_days = retention.get("max_age_days")
+    max_bytes = retention.get("max_bytes")
+    cutoff = time.time() - max_age_days * 86400 if max_age_days is not None else None
+
+    def plan():
+        listed = segments.list_segments(channel_name)
+        if not listed:
+            return None
+        oldest = listed[0]
+        _, _, max_timestamp = segments.segment_summary(channel_name, oldest)
+        oldest_count = segments.count_messages(channel_name, oldest)
+        excess = 0
+        if max_messages is not None:
+            excess = sum(segments.count_messages(channel_name, segment) for segment in listed) - max_messages
+        whole = ((oldest_count == 0 and len(listed) > 1)
+                 or (cutoff is not None and (max_timestamp is None or max_timestamp < cutoff))
+                 or (max_messages is not None and excess >= oldest_count)
+                 or (max_bytes is not None and len(listed) > 1
+                     and sum(segments.stored_size(channel_name, segment) for segment in listed) > max_bytes))
+        if whole:
+            return oldest, None
+        candidates = []
+        for msg in segments.read_segment(channel_name, oldest):
+            if len(candidates) >= limit:
+                break
+            if len(candidates) < excess or (cutoff is not None and timeindex.message_timestamp(msg) < cutoff):
+                candidates.append(msg)
+            else:
+                break
+        return oldest, candidates
+
+    planned = segments.consistent_read(channel_name, plan)
+    if planned is None:
+        return None
+    oldest, candidates = planned
+
+    if candidates is None:
+        return segments.drop_segment(channel_name, oldest, forget=lambda removed: _forget_messages(channel_name, removed))
+    if not candidates:
+        return None
+
+    with segments.channel_lock(channel_name):
+        if oldest not in segments.list_segments(channel_name):
+            return []
+        # Only what is still there, as it is now
+        patches, _ = segments.read_patches(channel_name, oldest)
+        located = [(oldest, msg) for msg in segments.apply_patches(candidates, patches)]
+        if located:
+            _delete_located(channel_name, located)
+    return [msg for _, msg in located]
 
 def can_user_delete_own(channel_name, user_roles):
     """
@@ -432,7 +761,7 @@ def can_user_delete_own(channel_name, user_roles):
     """
     try:
         with open(channels_index, 'r') as f:
-            channels_data = json.load(f)
+            channels_data = json_codec.load(f)
         for channel in channels_data:
             if channel.get("name") == channel_name:
                 permissions = channel.get("permissions", {})
@@ -451,7 +780,7 @@ def can_user_edit_own(channel_name, user_roles):
     """
     try:
         with open(channels_index, 'r') as f:
-            channels_data = json.load(f)
+            channels_data = json_codec.load(f)
         for channel in channels_data:
             if channel.get("name") == channel_name:
                 permissions = channel.get("permissions", {})
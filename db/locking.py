@@ -0,0 +1,103 @@
+import fcntl, functools, os, tempfile, threading
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json_codec
+
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class WriteLock:
+    """
+    Serializes database writes between the threads of this process and,
+    through an exclusive flock on a lock file, between worker processes.
+    Re-entrant, so a locked function can call other locked functions.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        """Take the lock, returns False if it is held elsewhere and blocking is False"""
+        if not self._thread_lock.acquire(blocking):
+            return False
+        try:
+            if self._depth == 0:
+                if self._fd is None:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    self._thread_lock.release()
+                    return False
+            self._depth += 1
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+write_lock = WriteLock(os.path.join(_MODULE_DIR, ".write.lock"))
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+def lock_for(path):
+    """The WriteLock of a lock file, one instance per path in this process"""
+    with _locks_guard:
+        lock = _locks.get(path)
+        if lock is None:
+            lock = _locks[path] = WriteLock(path)
+        return lock
+
+def serialized(func):
+    """Run a read-modify-write function while holding the database write lock"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with write_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+def write_json(path, data, indented=False):
+    """
+    Replace a JSON file atomically: readers see either the old or the new
+    content, never a partially written file.
+    """
+    if indented:
+        _replace(path, lambda f: json_codec.dump_indented(data, f), "w")
+    else:
+        write_bytes(path, json_codec.dumps_bytes(data))
+
+def write_bytes(path, data):
+    """Replace a file atomically with the given bytes"""
+    _replace(path, lambda f: f.write(data), "wb")
+
+def _replace(path, write, mode):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -1,4 +1,8 @@
-import json, os
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json_codec
+from .locking import serialized, write_json
 
 _MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -16,7 +20,7 @@ def get_role(role_name):
     """
     try:
         with open(roles_index, "r") as f:
-            roles = json.load(f)
+            roles = json_codec.load(f)
         return roles.get(role_name, None)
     except FileNotFoundError:
         return None
@@ -30,11 +34,12 @@ def get_all_roles():
     """
     try:
         with open(roles_index, "r") as f:
-            roles = json.load(f)
+            roles = json_codec.load(f)
         return roles
     except FileNotFoundError:
         return {}
 
+@serialized
 def add_role(role_name, role_data):
     """
     Add a new role to the roles database.
@@ -48,7 +53,7 @@ def add_role(role_name, role_data):
     """
     try:
         with open(roles_index, "r") as f:
-            roles = json.load(f)
+            roles = json_codec.load(f)
     except FileNotFoundError:
         roles = {}
 
@@ -57,11 +62,11 @@ def add_role(role_name, role_data):
 
     roles[role_name] = role_data
 
-    with open(roles_index, "w") as f:
-        json.dump(roles, f, indent=4)
+    write_json(roles_index, roles, indented=True)
 
     return True
 
+@serialized
 def update_role(role_name, role_data):
     """
     Update an existing role in the roles database.
@@ -75,7 +80,7 @@ def update_role(role_name, role_data):
     """
     try:
         with open(roles_index, "r") as f:
-            roles = json.load(f)
+            roles = json_codec.load(f)
     except FileNotFoundError:
         return False  # Roles database does not exist
 
@@ -84,11 +89,11 @@ def update_role(role_name, role_data):
 
     roles[role_name] = role_data
 
-    with open(roles_index, "w") as f:
-        json.dump(roles, f, indent=4)
+    write_json(roles_index, roles, indented=True)
 
     return True
 
+@serialized
 def update_role_key(role_name, key, value):
     """
     Update a specific key in a role's data.
@@ -103,7 +108,7 @@ def update_role_key(role_name, key, value):
     """
     try:
         with open(roles_index, "r") as f:
-            roles = json.load(f)
+            roles = json_codec.load(f)
     except FileNotFoundError:
         return False  # Roles database does not exist
 
@@ -112,11 +117,11 @@ def update_role_key(role_name, key, value):
 
     roles[role_name][key] = value
 
-    with open(roles_index, "w") as f:
-        json.dump(roles, f, indent=4)
+    write_json(roles_index, roles, indented=True)
 
     return True
 
+@serialized
 def delete_role(role_name):
     """
     Delete a role from the roles database.
@@ -129,7 +134,7 @@ def delete_role(role_name):
     """
     try:
         with open(roles_index, "r") as f:
-            roles = json.load(f)
+            roles = json_codec.load(f)
     except FileNotFoundError:
         return False  # Roles database does not exist
 
@@ -138,8 +143,7 @@ def delete_role(role_name):
 
     del roles[role_name]
 
-    with open(roles_index, "w") as f:
-        json.dump(roles, f, indent=4)
+    write_json(roles_index, roles, indented=True)
 
     return True
 
@@ -155,7 +159,7 @@ def role_exists(role_name):
     """
     try:
         with open(roles_index, "r") as f:
-            roles = json.load(f)
+            roles = json_codec.load(f)
         return role_name in roles
     except FileNotFoundError:
         return False  # Roles database does not exist
\ No newline at end of file
@@ -0,0 +1,272 @@
+"""
+Full-text search over channel messages.
+
+Each channel has an inverted index in db/search/, kept in two files:
+
+- <channel>.idx, the base index:
+  {"terms": {term: [message ids]}, "docs": {message id: [user, timestamp]}}
+- <channel>.log, changes since the base was written, one JSON object per line:
+  {"op": "add", "id", "user", "ts", "terms"} or {"op": "del", "id", "terms"}
+
+Message writes in db/channels.py append to the log, which is cheap whatever
+the size of the channel. Once the log outgrows LOG_MERGE_BYTES it is merged
+into a new base. Replaying the log in order always gives the same result,
+even over a base that already contains some of it, so readers never need
+the channel's lock.
+
+Searching loads the base once per process and then replays only what was
+appended to the log since the last search. A message matches when it
+contains every term of the query.
+
+A channel without a base is indexed in a background thread, started by the
+first search or write that needs it. The build starts a new log, reads the
+stored messages without any lock and writes the base next to the log, so
+changes made meanwhile are replayed over it. Searches skip the channel
+until its base exists.
+
+Rebuild every index from the stored messages with:
+
+    python -m db.search rebuild [channel ...]
+"""
+
+import os, re, sys
+import heapq
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json_codec
+from .locking import write_bytes
+from . import segments
+from logger import Logger
+
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+search_db_dir = os.path.join(_MODULE_DIR, "search")
+
+LOG_MERGE_BYTES = 256 * 1024
+MAX_TERM_LENGTH = 40
+
+_WORD = re.compile(r"\w+")
+
+# channel name -> loaded index, see _load
+_cache = {}
+
+# Channels being indexed by a background thread of this process
+_building = set()
+_building_guard = threading.Lock()
+
+def tokenize(text):
+    """The distinct search terms of a text, lowercased"""
+    if not isinstance(text, str):
+        return []
+    return list(dict.fromkeys(word for word in _WORD.findall(text.lower()) if len(word) <= MAX_TERM_LENGTH))
+
+def _paths(channel_name):
+    return (os.path.join(search_db_dir, f"{channel_name}.idx"),
+            os.path.join(search_db_dir, f"{channel_name}.log"))
+
+def _add_op(message):
+    return {"op": "add", "id": message.get("id"), "user": message.get("user"),
+            "ts": message.get("timestamp"), "terms": tokenize(message.get("content"))}
+
+def _del_op(message):
+    return {"op": "del", "id": message.get("id"), "terms": tokenize(message.get("content"))}
+
+def _apply(terms, docs, op):
+    message_id = op["id"]
+    if op["op"] == "add":
+        docs[message_id] = [op.get("user"), op.get("ts")]
+        for term in op["terms"]:
+            terms.setdefault(term, set()).add(message_id)
+    else:
+        docs.pop(message_id, None)
+        for term in op["terms"]:
+            ids = terms.get(term)
+            if ids is not None:
+                ids.discard(message_id)
+                if not ids:
+                    del terms[term]
+
+def _build(messages):
+    terms, docs = {}, {}
+    for message in messages:
+        _apply(terms, docs, _add_op(message))
+    return terms, docs
+
+def _write_base(channel_name, terms, docs):
+    base_path, log_path = _paths(channel_name)
+    os.makedirs(search_db_dir, exist_ok=True)
+    write_bytes(base_path, json_codec.dumps_bytes({
+        "terms": {term: sorted(ids) for term, ids in terms.items()},
+        "docs": docs
+    }))
+    # Whatever the log held is in the new base now
+    write_bytes(log_path, b"")
+
+def rebuild(channel_name):
+    """Rebuild a channel's index from its stored messages, without keeping its lock while they are read"""
+    base_path, log_path = _paths(channel_name)
+    with segments.channel_lock(channel_name):
+        # Changes from now on are logged, and replayed over the new base
+        os.makedirs(search_db_dir, exist_ok=True)
+        write_bytes(log_path, b"")
+    terms, docs = _build(segments.read_all(channel_name))
+    with segments.channel_lock(channel_name):
+        write_bytes(base_path, json_codec.dumps_bytes({
+            "terms": {term: sorted(ids) for term, ids in terms.items()},
+            "docs": docs
+        }))
+
+def start_rebuild(channel_name):
+    """Index a channel in a background thread, unless this process is indexing it already"""
+    with _building_guard:
+        if channel_name in _building:
+            return
+        _building.add(channel_name)
+    threading.Thread(target=_rebuild_in_background, args=(channel_name,), name=f"search-index-{channel_name}", daemon=True).start()
+
+def _rebuild_in_background(channel_name):
+    try:
+        rebuild(channel_name)
+    except Exception as e:
+        Logger.error(f"Error indexing #{channel_name} for search: {str(e)}")
+    finally:
+        with _building_guard:
+            _building.discard(channel_name)
+
+def is_indexed(channel_name):
+    return os.path.exists(_paths(channel_name)[0])
+
+def _log(channel_name, ops):
+    """Record changes to a channel's messages. Called holding the channel's lock, after the messages were stored."""
+    base_path, log_path = _paths(channel_name)
+    if not os.path.exists(log_path):
+        # Not indexed yet, the build reads the messages stored by now
+        start_rebuild(channel_name)
+        return
+    with open(log_path, 'ab') as f:
+        f.write(b"".join(json_codec.dumps_bytes(op) + b"\n" for op in ops))
+        size = f.tell()
+    # A log without a base is the one of a build still reading the messages
+    if size > LOG_MERGE_BYTES and os.path.exists(base_path):
+        _merge(channel_name)
+
+def _merge(channel_name):
+    index = _load(channel_name)
+    _write_base(channel_name, index["terms"], index["docs"])
+
+def index_messages(channel_name, messages):
+    """Add new messages to the channel's index"""
+    _log(channel_name, [_add_op(message) for message in messages])
+
+def update_message(channel_name, old_message, new_message):
+    """Reindex an edited message"""
+    _log(channel_name, [_del_op(old_message), _add_op(new_message)])
+
+def remove_messages(channel_name, messages):
+    """Remove deleted messages from the channel's index"""
+    _log(channel_name, [_del_op(message) for message in messages])
+
+def drop_channel(channel_name):
+    """Remove the index of a deleted channel"""
+    for path in _paths(channel_name):
+        if os.path.exists(path):
+            os.remove(path)
+    _cache.pop(channel_name, None)
+
+def _base_id(path):
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def _load(channel_name):
+    """The channel's index, with the log replayed up to its current end, None while it is being built"""
+    base_path, log_path = _paths(channel_name)
+    if not os.path.exists(base_path):
+        start_rebuild(channel_name)
+        return None
+
+    while True:
+        index = _cache.get(channel_name)
+        try:
+            base_id = _base_id(base_path)
+            if index is None or index["base_id"] != base_id:
+                with open(base_path, 'rb') as f:
+                    base = json_codec.loads(f.read())
+                index = _cache[channel_name] = {
+                    "base_id": base_id,
+                    "terms": {term: set(ids) for term, ids in base["terms"].items()},
+                    "docs": base["docs"],
+                    "log_id": None,
+                    "log_offset": 0
+                }
+            with open(log_path, 'rb') as f:
+                log_id = os.fstat(f.fileno()).st_ino
+                # A merge writes the base before starting a new log. If the base is unchanged
+                # now that the log is open, this log continues the base we have.
+                if _base_id(base_path) != base_id:
+                    continue
+                if index["log_id"] != log_id:
+                    index["log_id"], index["log_offset"] = log_id, 0
+                f.seek(index["log_offset"])
+                data = f.read()
+        except FileNotFoundError:
+            # Replaced while we read it, start over from the new files
+            _cache.pop(channel_name, None)
+            if not os.path.exists(base_path):
+                start_rebuild(channel_name)
+                return None
+            continue
+        break
+
+    # Only complete lines, a writer may be halfway through appending
+    end = data.rfind(b"\n") + 1
+    for line in data[:end].splitlines():
+        _apply(index["terms"], index["docs"], json_codec.loads(line))
+    index["log_offset"] += end
+    return index
+
+def search(channel_names, query, user=None, limit=20):
+    """
+    Find the newest messages containing every term of a query.
+
+    Args:
+        channel_names (iterable): The channels to search.
+        query (str): The words to look for.
+        user (str): Only return messages sent by this user, case-insensitive.
+        limit (int): The maximum number of results.
+
+    Returns:
+        tuple: (hits, indexing), hits being (timestamp, channel name, message id, user)
+        tuples, newest first, and indexing the channels skipped because their index is
+        still being built.
+    """
+    query_terms = tokenize(query)
+    if not query_terms:
+        return [], []
+    if user is not None:
+        user = user.lower()
+    hits = []
+    indexing = []
+    for channel_name in channel_names:
+        index = _load(channel_name)
+        if index is None:
+            indexing.append(channel_name)
+            continue
+        postings = [index["terms"].get(term) for term in query_terms]
+        if not all(postings):
+            continue
+        postings.sort(key=len)
+        docs = index["docs"]
+        for message_id in postings[0].intersection(*postings[1:]):
+            doc = docs.get(message_id)
+            if doc is None or (user is not None and str(doc[0]).lower() != user):
+                continue
+            hits.append((doc[1] or 0, channel_name, message_id, doc[0]))
+    return heapq.nlargest(limit, hits), indexing
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("Usage: python -m db.search rebuild [channel ...]")
+        sys.exit(1)
+    names = sys.argv[2:] or segments.list_channels()
+    for name in names:
+        rebuild(name)
+        print(f"Rebuilt search index of {name}")
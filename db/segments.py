@@ -0,0 +1,788 @@
+"""
+Segmented message storage of a channel.
+
+A channel's messages are kept in db/channels/<channel>/, split into segments
+numbered in the order they were started:
+
+- <n>.json, a compact JSON array of messages, indexed by timeindex as
+  <n>.tsidx. New messages are appended to the newest segment. Once it holds
+  SEGMENT_MAX_BYTES the next message starts a new segment, so an append
+  rewrites at most one bounded segment.
+- <n>.patch, the edits and deletes of segment n's messages since it was
+  last written, one JSON object per line:
+    {"op": "edit", "id": message id, "set": {field: new value}}
+    {"op": "del", "id": message id}
+
+Reading a segment applies its patches, so an edit or delete only appends a
+line. Segments are rewritten without their patches, or merged with the next
+segment, by rewrite_segment and merge_segments, which the compactor (see
+handlers/compactor.py) calls in the background.
+
+Writes to a channel hold its lock, channel_lock, so writes to other channels
+never wait for them. Rewrites and merges build the new segment without the
+lock and take it only to check that the segments they read are unchanged and
+to swap the new files in. Around the swap they bump the channel's .generation
+counter to an odd number and then to the next even number. Readers never take
+the lock: a read that overlapped a swap is retried.
+
+Old segments can be moved to cold storage by archive_segment. An archived
+segment is one compressed block, <n>.json.gz (or .xz, .zst), holding the same
+JSON array, and is listed with its message count and timestamps in the
+channel's archive.json. It keeps its number, so it is read, patched and
+rewritten like any other segment, only decompressed whole when read.
+
+Channels stored as a single <channel>.json file are split into segments the
+first time they are used.
+"""
+
+import os, sys, time
+import gzip, lzma
+import shutil
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json_codec
+from .locking import lock_for, write_bytes
+from . import timeindex
+
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+channels_db_dir = os.path.join(_MODULE_DIR, "channels")
+
+SEGMENT_MAX_BYTES = 256 * 1024
+
+# Archive codecs: name -> (file suffix, compress, decompress)
+ARCHIVE_CODECS = {
+    "gzip": (".gz", gzip.compress, gzip.decompress),
+    "lzma": (".xz", lzma.compress, lzma.decompress)
+}
+try:
+    # In the standard library since Python 3.14
+    from compression import zstd
+    ARCHIVE_CODECS["zstd"] = (".zst", zstd.compress, zstd.decompress)
+except ImportError:
+    pass
+
+def configure(storage_config):
+    """Apply the `storage` section of config.json"""
+    global SEGMENT_MAX_BYTES
+    SEGMENT_MAX_BYTES = storage_config.get("segment_max_bytes", SEGMENT_MAX_BYTES)
+
+def channel_dir(channel_name):
+    return os.path.join(channels_db_dir, channel_name)
+
+def channel_lock(channel_name):
+    """The lock serializing writes to a channel's messages, between threads and worker processes"""
+    # Next to the channel's directory rather than in it, so it outlives the channel being dropped
+    return lock_for(os.path.join(channels_db_dir, f".{channel_name}.lock"))
+
+def segment_path(channel_name, segment):
+    return os.path.join(channels_db_dir, channel_name, f"{segment}.json")
+
+def patch_path(channel_name, segment):
+    return os.path.join(channels_db_dir, channel_name, f"{segment}.patch")
+
+def archive_path(channel_name, segment, codec):
+    return os.path.join(channels_db_dir, channel_name, f"{segment}.json{ARCHIVE_CODECS[codec][0]}")
+
+def _manifest_path(channel_name):
+    return os.path.join(channels_db_dir, channel_name, "archive.json")
+
+def read_archive_manifest(channel_name):
+    """The channel's archived segments: {segment number: {"codec", "count", "first_ts", "max_ts"}}"""
+    try:
+        with open(_manifest_path(channel_name), 'rb') as f:
+            return {int(segment): entry for segment, entry in json_codec.loads(f.read()).items()}
+    except FileNotFoundError:
+        return {}
+
+def _write_manifest(channel_name, manifest):
+    write_bytes(_manifest_path(channel_name), json_codec.dumps_bytes({str(segment): entry for segment, entry in manifest.items()}))
+
+def _archived(channel_name, segment):
+    """The manifest entry of an archived segment, None for a live one"""
+    if os.path.exists(segment_path(channel_name, segment)):
+        return None
+    return read_archive_manifest(channel_name).get(segment)
+
+def _legacy_path(channel_name):
+    return os.path.join(channels_db_dir, f"{channel_name}.json")
+
+def list_channels():
+    """Names of the channels that have stored messages"""
+    try:
+        entries = os.listdir(channels_db_dir)
+    except FileNotFoundError:
+        return []
+    names = set()
+    for entry in entries:
+        if entry.startswith("."):
+            continue
+        if entry.endswith(".json"):
+            names.add(entry[:-len(".json")])
+        elif os.path.isdir(os.path.join(channels_db_dir, entry)):
+            names.add(entry)
+    return sorted(names)
+
+def exists(channel_name):
+    return os.path.isdir(channel_dir(channel_name)) or os.path.exists(_legacy_path(channel_name))
+
+def list_segments(channel_name):
+    """The channel's segment numbers, oldest first"""
+    if not os.path.isdir(channel_dir(channel_name)):
+        if not os.path.exists(_legacy_path(channel_name)):
+            return []
+        _migrate(channel_name)
+    try:
+        entries = os.listdir(channel_dir(channel_name))
+    except FileNotFoundError:
+        return []
+    live = {int(entry[:-len(".json")]) for entry in entries if entry.endswith(".json") and entry[:-len(".json")].isdigit()}
+    return sorted(live.union(read_archive_manifest(channel_name)))
+
+def _chunks(messages):
+    """Split messages into runs of at most SEGMENT_MAX_BYTES, each holding at least one message"""
+    chunk, size = [], 0
+    for message in messages:
+        length = len(json_codec.dumps_bytes(message)) + 1
+        if chunk and size + length > SEGMENT_MAX_BYTES:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(message)
+        size += length
+    if chunk:
+        yield chunk
+
+def _migrate(channel_name):
+    """Split a channel stored as a single file into segments"""
+    with channel_lock(channel_name):
+        legacy_path = _legacy_path(channel_name)
+        if os.path.isdir(channel_dir(channel_name)) or not os.path.exists(legacy_path):
+            return
+        with open(legacy_path, 'r') as f:
+            messages = json_codec.load(f)
+        # Built next to the channel and swapped in, readers never see half of it
+        tmp_dir = os.path.join(channels_db_dir, f".{channel_name}.migrating")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for segment, chunk in enumerate(_chunks(messages)):
+            timeindex.write_messages(os.path.join(tmp_dir, f"{segment}.json"), chunk)
+        os.rename(tmp_dir, channel_dir(channel_name))
+        os.remove(legacy_path)
+        legacy_index = timeindex.index_path(legacy_path)
+        if os.path.exists(legacy_index):
+            os.remove(legacy_index)
+
+def _generation_path(channel_name):
+    return os.path.join(channels_db_dir, channel_name, ".generation")
+
+def _generation(channel_name):
+    try:
+        with open(_generation_path(channel_name), 'rb') as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+def _set_generation(channel_name, generation):
+    write_bytes(_generation_path(channel_name), str(generation).encode())
+
+def _begin_change(channel_name):
+    """Called holding the channel's lock, just before swapping files in"""
+    generation = _generation(channel_name)
+    # Odd while the change is in progress, also after a change that was interrupted
+    _set_generation(channel_name, generation + 1 if generation % 2 == 0 else generation + 2)
+
+def _end_change(channel_name):
+    _set_generation(channel_name, _generation(channel_name) + 1)
+
+def _repair_generation(channel_name):
+    """End a change left unfinished by a process that died, unless a change is being swapped in now"""
+    lock = channel_lock(channel_name)
+    if not lock.acquire(blocking=False):
+        return
+    try:
+        # Changes are only in progress while their writer holds the lock
+        if _generation(channel_name) % 2:
+            _end_change(channel_name)
+    finally:
+        lock.release()
+
+def consistent_read(channel_name, read):
+    """
+    Call read() and return its result, making sure no rewrite or merge of the
+    channel's segments was swapped in meanwhile. Never waits for the channel's lock.
+    """
+    for _ in range(100):
+        generation = _generation(channel_name)
+        if generation % 2 == 0:
+            try:
+                result = read()
+                if _generation(channel_name) == generation:
+                    return result
+            except FileNotFoundError:
+                pass  # a segment was merged away
+        else:
+            _repair_generation(channel_name)
+        # A swap is only a few renames
+        time.sleep(0.001)
+    return read()
+
+def read_patches(channel_name, segment):
+    """
+    The edits and deletes of a segment's messages.
+
+    Returns:
+        tuple: ({message id: None if deleted, else the fields to set}, number of patch records)
+    """
+    try:
+        with open(patch_path(channel_name, segment), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}, 0
+    return _parse_patches(data)
+
+def _parse_patches(data):
+    patches = {}
+    records = 0
+    # Only complete lines, a writer may be halfway through appending
+    for line in data[:data.rfind(b"\n") + 1].splitlines():
+        record = json_codec.loads(line)
+        records += 1
+        message_id = record["id"]
+        if record["op"] == "del":
+            patches[message_id] = None
+        elif message_id not in patches:
+            patches[message_id] = dict(record["set"])
+        elif patches[message_id] is not None:
+            patches[message_id].update(record["set"])
+    return patches, records
+
+def apply_patches(messages, patches):
+    """The messages with their edits applied and deleted ones left out"""
+    if not patches:
+        return messages
+    result = []
+    for message in messages:
+        message_id = message.get("id")
+        if message_id not in patches:
+            result.append(message)
+        elif patches[message_id] is not None:
+            result.append(dict(message, **patches[message_id]))
+    return result
+
+def _load_archived(channel_name, segment):
+    entry = read_archive_manifest(channel_name).get(segment)
+    if entry is None:
+        raise FileNotFoundError(segment_path(channel_name, segment))
+    with open(archive_path(channel_name, segment, entry["codec"]), 'rb') as f:
+        return json_codec.loads(ARCHIVE_CODECS[entry["codec"]][2](f.read()))
+
+def read_segment(channel_name, segment):
+    """A segment's current messages, oldest first. Raises FileNotFoundError if it does not exist."""
+    patches, _ = read_patches(channel_name, segment)
+    try:
+        with open(segment_path(channel_name, segment), 'r') as f:
+            messages = json_codec.load(f)
+    except FileNotFoundError:
+        messages = _load_archived(channel_name, segment)
+    return apply_patches(messages, patches)
+
+def read_segment_range(channel_name, segment, start, end):
+    """A segment's current messages with start <= timestamp <= end, oldest first"""
+    patches, _ = read_patches(channel_name, segment)
+    try:
+        messages = timeindex.read_range(segment_path(channel_name, segment), start, end)
+    except FileNotFoundError:
+        # Archived segments are decompressed whole
+        messages = [message for message in _load_archived(channel_name, segment)
+                    if start <= timeindex.message_timestamp(message) <= end]
+    return apply_patches(messages, patches)
+
+def read_all(channel_name):
+    """Every current message of a channel, oldest first"""
+    def read():
+        messages = []
+        for segment in list_segments(channel_name):
+            messages.extend(read_segment(channel_name, segment))
+        return messages
+    return consistent_read(channel_name, read)
+
+def read_last(channel_name, limit):
+    """
+    The channel's last `limit` messages, reading only the newest segments.
+
+    Returns:
+        list: (segment number, message) tuples, oldest first.
+    """
+    def read():
+        found = []
+        for segment in reversed(list_segments(channel_name)):
+            if len(found) >= limit:
+                break
+            found[:0] = [(segment, message) for message in read_segment(channel_name, segment)]
+        return found[-limit:] if limit > 0 else []
+    return consistent_read(channel_name, read)
+
+def read_range(channel_name, start, end):
+    """
+    The channel's messages with start <= timestamp <= end, skipping the
+    segments that hold none of them.
+
+    Returns:
+        list: (segment number, message) tuples, oldest first.
+    """
+    def read():
+        found = []
+        for segment in list_segments(channel_name):
+            count, first_timestamp, max_timestamp = segment_summary(channel_name, segment)
+            if not count or max_timestamp < start:
+                continue
+            if first_timestamp > end:
+                break
+            found.extend((segment, message) for message in read_segment_range(channel_name, segment, start, end))
+        return found
+    return consistent_read(channel_name, read)
+
+def _page_key(message):
+    return (timeindex.message_timestamp(message), str(message.get("id")))
+
+def read_before(channel_name, before, limit, before_id=None):
+    """
+    The last `limit` messages before a cursor, reading one segment at a time from
+    the newest and skipping the segments that start after it.
+
+    Messages are ordered by (timestamp, id), so messages sharing the timestamp of
+    the cursor are neither skipped nor repeated from one page to the next.
+
+    Args:
+        channel_name (str): The name of the channel.
+        before (float): Timestamp of the cursor.
+        before_id (str): Id of the cursor message. Without it, only messages sent
+            strictly before `before` are returned.
+        limit (int): The maximum number of messages to return.
+
+    Returns:
+        tuple: (messages, more), oldest first, and whether older messages exist.
+    """
+    cursor = (before, str(before_id)) if before_id is not None else None
+    def read():
+        found = []
+        for segment in reversed(list_segments(channel_name)):
+            count, first_timestamp, max_timestamp = segment_summary(channel_name, segment)
+            if not count or first_timestamp > before:
+                continue
+            # Done once the page is full and older segments cannot hold anything that sorts into it
+            if len(found) > limit and max_timestamp < timeindex.message_timestamp(found[-limit]):
+                break
+            found.extend(message for message in read_segment_range(channel_name, segment, float("-inf"), before)
+                         if (_page_key(message) < cursor if cursor is not None
+                             else timeindex.message_timestamp(message) < before))
+            found.sort(key=_page_key)
+        return found[-limit:] if limit > 0 else [], len(found) > limit
+    return consistent_read(channel_name, read)
+
+def find_message(channel_name, message_id):
+    """
+    Find a message, searching the newest segments first.
+
+    Returns:
+        tuple: (segment number, message), (None, None) if it is not found.
+    """
+    def read():
+        for segment in reversed(list_segments(channel_name)):
+            for message in read_segment(channel_name, segment):
+                if message.get("id") == message_id:
+                    return segment, message
+        return None, None
+    return consistent_read(channel_name, read)
+
+def find_messages(channel_name, message_ids):
+    """
+    Find several messages, reading the newest segments first and stopping once all are found.
+
+    Returns:
+        list: (segment number, message) tuples of the messages found, oldest first.
+    """
+    def read():
+        wanted = set(message_ids)
+        found = []
+        for segment in reversed(list_segments(channel_name)):
+            if not wanted:
+                break
+            matches = [message for message in read_segment(channel_name, segment) if message.get("id") in wanted]
+            wanted.difference_update(message.get("id") for message in matches)
+            found[:0] = [(segment, message) for message in matches]
+        return found
+    return consistent_read(channel_name, read)
+
+def segment_summary(channel_name, segment):
+    """(message count, timestamp of the first message, highest timestamp) of a segment, ignoring its patches"""
+    try:
+        return timeindex.summary(segment_path(channel_name, segment))
+    except FileNotFoundError:
+        entry = read_archive_manifest(channel_name).get(segment)
+        if entry is None:
+            raise
+        return entry["count"], entry["first_ts"], entry["max_ts"]
+
+def append(channel_name, messages):
+    """Append messages to the newest segment, starting a new one when it is full"""
+    with channel_lock(channel_name):
+        segments = list_segments(channel_name)
+        os.makedirs(channel_dir(channel_name), exist_ok=True)
+        segment = segments[-1] if segments else 0
+        path = segment_path(channel_name, segment)
+        # Archived segments are never appended to
+        if segments and (not os.path.exists(path) or os.path.getsize(path) >= SEGMENT_MAX_BYTES):
+            segment += 1
+        # The messages already stored are copied without being parsed
+        timeindex.append_messages(segment_path(channel_name, segment), messages)
+
+def add_patches(channel_name, records):
+    """
+    Record edits and deletes.
+
+    Args:
+        channel_name (str): The name of the channel.
+        records (list): (segment number, patch record) tuples.
+    """
+    by_segment = {}
+    for segment, record in records:
+        by_segment.setdefault(segment, []).append(json_codec.dumps_bytes(record) + b"\n")
+    with channel_lock(channel_name):
+        for segment, lines in by_segment.items():
+            with open(patch_path(channel_name, segment), 'ab') as f:
+                f.write(b"".join(lines))
+
+def _remove_segment(channel_name, segment):
+    path = segment_path(channel_name, segment)
+    for file in (path, timeindex.index_path(path), patch_path(channel_name, segment)):
+        if os.path.exists(file):
+            os.remove(file)
+    manifest = read_archive_manifest(channel_name)
+    entry = manifest.pop(segment, None)
+    if entry is not None:
+        _write_manifest(channel_name, manifest)
+        if os.path.exists(archive_path(channel_name, segment, entry["codec"])):
+            os.remove(archive_path(channel_name, segment, entry["codec"]))
+
+def _list_archived(channel_name, segment, messages, codec):
+    manifest = read_archive_manifest(channel_name)
+    manifest[segment] = {
+        "codec": codec,
+        "count": len(messages),
+        "first_ts": timeindex.message_timestamp(messages[0]),
+        "max_ts": max(timeindex.message_timestamp(message) for message in messages)
+    }
+    _write_manifest(channel_name, manifest)
+
+def _file_id(stat):
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def _snapshot(channel_name, segment):
+    """
+    Read a segment to compact it, without the lock.
+
+    Returns:
+        dict: "file", the file holding the messages, with its "id", the manifest "entry" if it is
+        archived, "messages" without patches, and "patch_data", the patch records read.
+    """
+    path = segment_path(channel_name, segment)
+    entry = None
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        entry = read_archive_manifest(channel_name).get(segment)
+        if entry is None:
+            raise
+        path = archive_path(channel_name, segment, entry["codec"])
+        f = open(path, 'rb')
+    with f:
+        file_id = _file_id(os.fstat(f.fileno()))
+        data = f.read()
+    if entry is not None:
+        data = ARCHIVE_CODECS[entry["codec"]][2](data)
+    # Patches are read after the messages, so they cover at least the messages read
+    try:
+        with open(patch_path(channel_name, segment), 'rb') as f:
+            patch_data = f.read()
+    except FileNotFoundError:
+        patch_data = b""
+    return {
+        "file": path,
+        "id": file_id,
+        "entry": entry,
+        "messages": json_codec.loads(data),
+        "patch_data": patch_data[:patch_data.rfind(b"\n") + 1]
+    }
+
+def _snapshot_messages(snapshot):
+    return apply_patches(snapshot["messages"], _parse_patches(snapshot["patch_data"])[0])
+
+def _patches_since(channel_name, segment, snapshot):
+    """
+    The patch records added to a segment since it was snapshotted, None if the
+    segment was replaced meanwhile. Called holding the channel's lock.
+    """
+    try:
+        if _file_id(os.stat(snapshot["file"])) != snapshot["id"]:
+            return None
+    except FileNotFoundError:
+        return None
+    try:
+        with open(patch_path(channel_name, segment), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        data = b""
+    if not data.startswith(snapshot["patch_data"]):
+        return None
+    return data[len(snapshot["patch_data"]):]
+
+def _set_patches(channel_name, segment, data):
+    path = patch_path(channel_name, segment)
+    if data:
+        write_bytes(path, data)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def _temp_segment_path(channel_name, segment):
+    # Not a segment number, so never listed
+    return os.path.join(channels_db_dir, channel_name, f".{segment}.compacting.json")
+
+def _discard(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def stored_size(channel_name, segment):
+    """Bytes a segment takes on disk, compressed if it is archived, with its patches"""
+    entry = _archived(channel_name, segment)
+    path = archive_path(channel_name, segment, entry["codec"]) if entry else segment_path(channel_name, segment)
+    return _size(path) + _size(patch_path(channel_name, segment))
+
+def rewrite_segment(channel_name, segment):
+    """
+    Rewrite a segment with its patches applied, compressed again if it is
+    archived. An emptied segment other than the newest is removed.
+
+    Returns:
+        tuple: (bytes before, bytes after), None if the segment no longer exists
+        or changed while it was being rewritten.
+    """
+    segments = list_segments(channel_name)
+    if segment not in segments:
+        return None
+    try:
+        before = stored_size(channel_name, segment)
+        snapshot = _snapshot(channel_name, segment)
+    except FileNotFoundError:
+        return None
+    messages = _snapshot_messages(snapshot)
+    entry = snapshot["entry"]
+    remove = not messages and segment != segments[-1]
+
+    # Built without the lock, which is only taken to swap it in
+    tmp_path = _temp_segment_path(channel_name, segment)
+    tmp_files = (tmp_path, timeindex.index_path(tmp_path))
+    if remove:
+        tmp_files = ()
+    elif entry is not None:
+        write_bytes(tmp_path, ARCHIVE_CODECS[entry["codec"]][1](json_codec.dumps_bytes(messages)))
+    else:
+        timeindex.write_messages(tmp_path, messages)
+
+    try:
+        with channel_lock(channel_name):
+            added = _patches_since(channel_name, segment, snapshot)
+            if added is None:
+                return None
+            _begin_change(channel_name)
+            try:
+                if remove:
+                    _remove_segment(channel_name, segment)
+                    return before, 0
+                if entry is not None:
+                    os.replace(tmp_path, snapshot["file"])
+                    _list_archived(channel_name, segment, messages, entry["codec"])
+                else:
+                    path = segment_path(channel_name, segment)
+                    os.replace(timeindex.index_path(tmp_path), timeindex.index_path(path))
+                    os.replace(tmp_path, path)
+                # Edits and deletes made while rewriting apply to the new segment
+                _set_patches(channel_name, segment, added)
+            finally:
+                _end_change(channel_name)
+    finally:
+        _discard(*tmp_files)
+    return before, stored_size(channel_name, segment)
+
+def merge_segments(channel_name, segment):
+    """
+    Merge a live segment with the next one, applying the patches of both.
+
+    Returns:
+        tuple: (bytes before, bytes after), None if either segment no longer exists,
+        is archived or changed while they were being merged.
+    """
+    segments = list_segments(channel_name)
+    if segment not in segments or segment == segments[-1]:
+        return None
+    following = segments[segments.index(segment) + 1]
+    try:
+        before = stored_size(channel_name, segment) + stored_size(channel_name, following)
+        first = _snapshot(channel_name, segment)
+        second = _snapshot(channel_name, following)
+    except FileNotFoundError:
+        return None
+    if first["entry"] is not None or second["entry"] is not None:
+        return None
+
+    # Built without the lock, which is only taken to swap it in
+    tmp_path = _temp_segment_path(channel_name, segment)
+    timeindex.write_messages(tmp_path, _snapshot_messages(first) + _snapshot_messages(second))
+
+    path = segment_path(channel_name, segment)
+    try:
+        with channel_lock(channel_name):
+            added = _patches_since(channel_name, segment, first)
+            added_following = _patches_since(channel_name, following, second)
+            if added is None or added_following is None:
+                return None
+            _begin_change(channel_name)
+            try:
+                os.replace(timeindex.index_path(tmp_path), timeindex.index_path(path))
+                os.replace(tmp_path, path)
+                # Edits and deletes made while merging apply to the merged segment
+                _set_patches(channel_name, segment, added + added_following)
+                _remove_segment(channel_name, following)
+            finally:
+                _end_change(channel_name)
+    finally:
+        _discard(tmp_path, timeindex.index_path(tmp_path))
+    return before, os.path.getsize(path)
+
+def archive_segment(channel_name, segment, codec="gzip"):
+    """
+    Move a live segment other than the newest to cold storage, as one
+    compressed block with its patches applied.
+
+    Returns:
+        tuple: (bytes before, bytes after), None if the segment is not a live, sealed segment.
+    """
+    segments = list_segments(channel_name)
+    if segment not in segments or segment == segments[-1]:
+        return None
+    try:
+        before = stored_size(channel_name, segment)
+        snapshot = _snapshot(channel_name, segment)
+    except FileNotFoundError:
+        return None
+    if snapshot["entry"] is not None:
+        return None
+    messages = _snapshot_messages(snapshot)
+
+    # Compressed without the lock, which is only taken to swap the block in
+    tmp_path = os.path.join(channels_db_dir, channel_name, f".{segment}.archiving{ARCHIVE_CODECS[codec][0]}")
+    after = 0
+    if messages:
+        data = ARCHIVE_CODECS[codec][1](json_codec.dumps_bytes(messages))
+        write_bytes(tmp_path, data)
+        after = len(data)
+
+    try:
+        with channel_lock(channel_name):
+            added = _patches_since(channel_name, segment, snapshot)
+            if added is None:
+                return None
+            _begin_change(channel_name)
+            try:
+                if messages:
+                    os.replace(tmp_path, archive_path(channel_name, segment, codec))
+                    _list_archived(channel_name, segment, messages, codec)
+                path = segment_path(channel_name, segment)
+                _discard(path, timeindex.index_path(path))
+                # Edits and deletes made while compressing apply to the archived block
+                _set_patches(channel_name, segment, added if messages else b"")
+            finally:
+                _end_change(channel_name)
+    finally:
+        _discard(tmp_path)
+    return before, after
+
+def drop_segment(channel_name, segment, forget=None):
+    """
+    Remove a whole segment, live or archived. The segment is read without the
+    lock, which is only taken to remove it.
+
+    Args:
+        channel_name (str): The name of the channel.
+        segment (int): The segment number.
+        forget (callable): Called with the messages removed, still holding the channel's lock.
+
+    Returns:
+        list: The current messages the segment held, None if it no longer exists
+        or changed while it was being read.
+    """
+    if segment not in list_segments(channel_name):
+        return None
+    try:
+        snapshot = _snapshot(channel_name, segment)
+    except FileNotFoundError:
+        return None
+    with channel_lock(channel_name):
+        added = _patches_since(channel_name, segment, snapshot)
+        if added is None:
+            return None
+        messages = apply_patches(_snapshot_messages(snapshot), _parse_patches(added)[0])
+        _begin_change(channel_name)
+        try:
+            _remove_segment(channel_name, segment)
+        finally:
+            _end_change(channel_name)
+        if forget is not None and messages:
+            forget(messages)
+    return messages
+
+def count_messages(channel_name, segment):
+    """A segment's current number of messages, from its index and patches, without reading the messages"""
+    count, _, _ = segment_summary(channel_name, segment)
+    patches, _ = read_patches(channel_name, segment)
+    return count - sum(1 for patch in patches.values() if patch is None)
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+def survey(channel_name):
+    """
+    Size, age and garbage of each segment, for the compactor.
+
+    Returns:
+        list: {"segment", "bytes", "messages", "patches", "max_ts", "archived"} dicts, oldest segment first.
+    """
+    result = []
+    manifest = read_archive_manifest(channel_name)
+    for segment in list_segments(channel_name):
+        try:
+            count, _, max_timestamp = segment_summary(channel_name, segment)
+            _, records = read_patches(channel_name, segment)
+        except FileNotFoundError:
+            continue
+        archived = segment in manifest and not os.path.exists(segment_path(channel_name, segment))
+        result.append({
+            "segment": segment,
+            "bytes": stored_size(channel_name, segment) - _size(patch_path(channel_name, segment)),
+            "messages": count,
+            "patches": records,
+            "max_ts": max_timestamp,
+            "archived": archived
+        })
+    return result
+
+def drop(channel_name):
+    """Remove every segment of a deleted channel"""
+    with channel_lock(channel_name):
+        shutil.rmtree(channel_dir(channel_name), ignore_errors=True)
+        legacy_path = _legacy_path(channel_name)
+        for path in (legacy_path, timeindex.index_path(legacy_path)):
+            if os.path.exists(path):
+                os.remove(path)
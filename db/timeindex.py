@@ -0,0 +1,147 @@
+"""
+Sparse timestamp index of a message file, one segment of a channel (see segments.py).
+
+Message files are compact JSON arrays written by this module, so every
+message starts at a known byte offset. For every INDEX_EVERY-th message the
+index, stored next to the message file as <name>.tsidx, records
+
+    [position, byte offset, highest timestamp up to and including it]
+
+The running maximum never decreases, even if a message was stored slightly
+out of timestamp order, so it can be binary searched. A time range is found by
+bisecting the entries and parsing only the bytes between two of them.
+
+The index records the size of the file it describes. Appends extend both
+without parsing the existing messages. Any other write rebuilds it. Writes
+are made holding the channel's lock (see segments.channel_lock). Readers
+never write: a missing or stale index is rebuilt in memory, and for good by
+the next write.
+"""
+
+import bisect, os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json_codec
+from .locking import write_bytes
+
+INDEX_EVERY = 64
+
+def index_path(channel_file):
+    return channel_file[:-len(".json")] + ".tsidx"
+
+def message_timestamp(message):
+    timestamp = message.get("timestamp")
+    return timestamp if isinstance(timestamp, (int, float)) else 0
+
+def _extend(index, parts, messages):
+    """Add entries for messages appended at the end of the indexed file"""
+    position = index["count"]
+    offset = index["size"] - 1  # the new messages replace the closing bracket
+    for part, message in zip(parts, messages):
+        if position > 0:
+            offset += 1  # comma
+        index["max_ts"] = max(index["max_ts"], message_timestamp(message))
+        if position % INDEX_EVERY == 0:
+            index["entries"].append([position, offset, index["max_ts"]])
+        offset += len(part)
+        position += 1
+    index["count"] = position
+    index["size"] = offset + 1
+
+def _build(messages):
+    """The encoded messages and a fresh index for them"""
+    parts = [json_codec.dumps_bytes(message) for message in messages]
+    # An empty file is just the two brackets
+    index = {"every": INDEX_EVERY, "count": 0, "size": 2, "max_ts": 0, "entries": []}
+    _extend(index, parts, messages)
+    return parts, index
+
+def write_messages(channel_file, messages):
+    """Write a channel's messages and a fresh index for them"""
+    parts, index = _build(messages)
+    write_bytes(channel_file, b"[" + b",".join(parts) + b"]")
+    write_bytes(index_path(channel_file), json_codec.dumps_bytes(index))
+
+def append_messages(channel_file, messages):
+    """Append messages to a channel file, without parsing or re-encoding the messages already in it"""
+    index = load_index(channel_file)
+    if index is None:
+        try:
+            with open(channel_file, 'r') as f:
+                existing = json_codec.load(f)
+        except FileNotFoundError:
+            existing = []
+        write_messages(channel_file, existing + list(messages))
+        return
+
+    with open(channel_file, 'rb') as f:
+        data = f.read()
+    parts = [json_codec.dumps_bytes(message) for message in messages]
+    separator = b"," if index["count"] else b""
+    _extend(index, parts, messages)
+    write_bytes(channel_file, data[:-1] + separator + b",".join(parts) + b"]")
+    write_bytes(index_path(channel_file), json_codec.dumps_bytes(index))
+
+def load_index(channel_file):
+    """The channel's index, or None if it is missing or does not match the file"""
+    try:
+        with open(index_path(channel_file), 'rb') as f:
+            index = json_codec.loads(f.read())
+        if index.get("every") != INDEX_EVERY or index.get("size") != os.path.getsize(channel_file):
+            return None
+        return index
+    except (FileNotFoundError, json_codec.JSONDecodeError):
+        return None
+
+def _ensure_index(channel_file):
+    index = load_index(channel_file)
+    if index is None:
+        # Built in memory, its offsets only hold if the file is in the compact form written here
+        with open(channel_file, 'rb') as f:
+            data = f.read()
+        parts, index = _build(json_codec.loads(data))
+        index["exact"] = b"[" + b",".join(parts) + b"]" == data
+    return index
+
+def summary(channel_file):
+    """(message count, timestamp of the first message, highest timestamp) of a file, from its index"""
+    index = _ensure_index(channel_file)
+    if not index["entries"]:
+        return 0, None, None
+    return index["count"], index["entries"][0][2], index["max_ts"]
+
+def read_range(channel_file, start, end):
+    """
+    Messages with start <= timestamp <= end, oldest first, parsing only the
+    part of the file the index points to.
+
+    Raises FileNotFoundError if the channel has no message file.
+    """
+    for _ in range(2):
+        index = _ensure_index(channel_file)
+        entries = index["entries"]
+        if not entries:
+            return []
+        if not index.get("exact", True):
+            break
+        maxima = [entry[2] for entry in entries]
+        # Every message before the last entry with a maximum below start is older than start
+        first = max(0, bisect.bisect_left(maxima, start) - 1)
+        # Stop one block after the first entry past end, for messages stored slightly out of order
+        last = bisect.bisect_right(maxima, end) + 1
+        if last <= first:
+            return []
+        begin = entries[first][1]
+        with open(channel_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size != index["size"]:
+                continue  # replaced since the index was read
+            f.seek(begin)
+            if last < len(entries):
+                chunk = f.read(entries[last][1] - begin)
+            else:
+                chunk = f.read()
+        messages = json_codec.loads(b"[" + chunk.rstrip(b",]") + b"]")
+        return [message for message in messages if start <= message_timestamp(message) <= end]
+    # Still changing under us, or not indexable, fall back to reading everything
+    with open(channel_file, 'r') as f:
+        return [message for message in json_codec.load(f) if start <= message_timestamp(message) <= end]
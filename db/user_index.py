@@ -0,0 +1,246 @@
+"""
+Index of the messages each user sent, across all channels.
+
+Every user has a log in db/user_index/, named after the URL-quoted
+lowercased username, so lookups are case-insensitive, with one JSON object
+per line:
+
+    {"op": "add", "c": channel, "id": message id, "ts": timestamp}
+    {"op": "del", "c": channel, "id": message id}
+
+Message writes in db/channels.py append to the logs of the users whose
+messages were added or deleted, so keeping the index costs one small append
+per user and write. Replaying a log in order gives the user's current
+messages. A log with more deleted entries than live ones is rewritten on
+the next read.
+
+The whole index is built from the stored messages in a background thread,
+started with the server or by the first lookup. The stored messages are read
+without any lock. Changes made meanwhile are recorded in
+db/user_index.journal and replayed into the new index just before it is
+swapped in, and lookups are answered with None until it is ready. It can
+also be rebuilt by hand with:
+
+    python -m db.user_index rebuild
+"""
+
+import os, sys
+import shutil
+import threading
+from urllib.parse import quote
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json_codec
+from .locking import write_bytes, lock_for
+from . import segments
+from logger import Logger
+
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+user_index_dir = os.path.join(_MODULE_DIR, "user_index")
+journal_path = os.path.join(_MODULE_DIR, "user_index.journal")
+
+# Guards the logs and the journal. Only the index's own lock, so saving a message in one
+# channel never waits for writes in another channel or to users.json and roles.json
+_index_lock = lock_for(os.path.join(_MODULE_DIR, ".user_index.lock"))
+
+# Written into the index once it is complete. Indexes of an older format are rebuilt.
+FORMAT = "2"
+_format_path = os.path.join(user_index_dir, ".format")
+
+# Logs smaller than this are never rewritten, however many deletes they hold
+COMPACT_MIN_ENTRIES = 64
+
+_build_guard = threading.Lock()
+_build_thread = None
+
+def _log_path(username, directory=user_index_dir):
+    return os.path.join(directory, quote(username.lower(), safe="") + ".log")
+
+def _group(channel_name, messages, op):
+    """Log entries for a batch of messages, grouped by the lowercased name of the user who sent them"""
+    entries = {}
+    for message in messages:
+        username = message.get("user")
+        if not isinstance(username, str) or not username:
+            continue
+        entry = {"op": op, "c": channel_name, "id": message.get("id")}
+        if op == "add":
+            entry["ts"] = message.get("timestamp")
+        entries.setdefault(username.lower(), []).append(entry)
+    return entries
+
+def _lines(entries):
+    return b"".join(json_codec.dumps_bytes(entry) + b"\n" for entry in entries)
+
+def is_ready():
+    """Whether the index is complete and can answer lookups"""
+    try:
+        with open(_format_path, 'r') as f:
+            return f.read().strip() == FORMAT
+    except FileNotFoundError:
+        return False
+
+def _append(channel_name, messages, op):
+    grouped = _group(channel_name, messages, op)
+    if not grouped:
+        return
+    with _index_lock:
+        built = os.path.isdir(user_index_dir)
+        journaling = os.path.exists(journal_path)
+        if built:
+            for username, entries in grouped.items():
+                with open(_log_path(username), 'ab') as f:
+                    f.write(_lines(entries))
+        if journaling:
+            # A rebuild is reading the stored messages, it replays these before swapping its index in
+            with open(journal_path, 'ab') as f:
+                f.write(b"".join(_lines({"user": username, **entry} for entry in entries)
+                                 for username, entries in grouped.items()))
+    if not built and not journaling:
+        start_rebuild()
+
+def record_messages(channel_name, messages):
+    """Add new messages to the index. Called holding the channel's lock, after the messages were stored."""
+    _append(channel_name, messages, "add")
+
+def remove_messages(channel_name, messages):
+    """Remove deleted messages from the index. Called holding the channel's lock, after the messages were stored."""
+    _append(channel_name, messages, "del")
+
+def rebuild():
+    """
+    Rebuild the index of every user from the stored messages.
+
+    Returns:
+        bool: False if another rebuild is already running.
+    """
+    build_lock = lock_for(os.path.join(_MODULE_DIR, ".user_index.build.lock"))
+    if not build_lock.acquire(blocking=False):
+        return False
+    try:
+        # Changes from now on are journaled as well as indexed
+        with _index_lock:
+            write_bytes(journal_path, b"")
+
+        logs = {}
+        for channel_name in segments.list_channels():
+            for username, entries in _group(channel_name, segments.read_all(channel_name), "add").items():
+                logs.setdefault(username, []).extend(entries)
+
+        # Built next to the index and swapped in, readers never see a half-built index
+        tmp_dir = user_index_dir + ".tmp"
+        old_dir = user_index_dir + ".old"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for username, entries in logs.items():
+            with open(_log_path(username, tmp_dir), 'wb') as f:
+                f.write(_lines(entries))
+
+        with _index_lock:
+            # Changes made while the messages were read, replaying one that was read already changes nothing
+            with open(journal_path, 'rb') as f:
+                journal = f.read()
+            replayed = {}
+            for line in journal.splitlines():
+                entry = json_codec.loads(line)
+                replayed.setdefault(entry.pop("user"), []).append(entry)
+            for username, entries in replayed.items():
+                with open(_log_path(username, tmp_dir), 'ab') as f:
+                    f.write(_lines(entries))
+            with open(os.path.join(tmp_dir, ".format"), 'w') as f:
+                f.write(FORMAT)
+
+            if os.path.isdir(user_index_dir):
+                shutil.rmtree(old_dir, ignore_errors=True)
+                os.rename(user_index_dir, old_dir)
+            os.rename(tmp_dir, user_index_dir)
+            os.remove(journal_path)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        return True
+    finally:
+        build_lock.release()
+
+def ensure_built():
+    """Start building the index in the background if it is missing, outdated or its last rebuild was interrupted"""
+    if not is_ready() or os.path.exists(journal_path):
+        start_rebuild()
+
+def start_rebuild():
+    """Rebuild the index in a background thread, unless this process is rebuilding it already"""
+    global _build_thread
+    with _build_guard:
+        if _build_thread is not None and _build_thread.is_alive():
+            return
+        _build_thread = threading.Thread(target=_rebuild_in_background, name="user-index-rebuild", daemon=True)
+        _build_thread.start()
+
+def _rebuild_in_background():
+    try:
+        if rebuild():
+            Logger.info("Built the user message index")
+    except Exception as e:
+        Logger.error(f"Error building the user message index: {str(e)}")
+
+def _replay(data):
+    refs = {}
+    entries = 0
+    # Only complete lines, a writer may be halfway through appending
+    for line in data[:data.rfind(b"\n") + 1].splitlines():
+        entry = json_codec.loads(line)
+        entries += 1
+        key = (entry["c"], entry["id"])
+        if entry["op"] == "add":
+            refs[key] = entry.get("ts")
+        else:
+            refs.pop(key, None)
+    return refs, entries
+
+def get_user_messages(username, channel_name=None):
+    """
+    Find the messages a user sent.
+
+    Args:
+        username (str): The user who sent the messages.
+        channel_name (str): Only return messages of this channel.
+
+    Returns:
+        list: (channel name, message id, timestamp) tuples, in the order they were sent,
+        None while the index is being built.
+    """
+    if not is_ready():
+        start_rebuild()
+        return None
+    try:
+        with open(_log_path(username), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+
+    refs, entries = _replay(data)
+    if entries > COMPACT_MIN_ENTRIES and entries > 2 * len(refs):
+        _compact(username)
+
+    return [(channel, message_id, timestamp) for (channel, message_id), timestamp in refs.items()
+            if channel_name is None or channel == channel_name]
+
+def _compact(username):
+    """Rewrite a user's log with only the messages that still exist"""
+    path = _log_path(username)
+    with _index_lock:
+        try:
+            with open(path, 'rb') as f:
+                refs, _ = _replay(f.read())
+        except FileNotFoundError:
+            return
+        write_bytes(path, b"".join(
+            json_codec.dumps_bytes({"op": "add", "c": channel, "id": message_id, "ts": timestamp}) + b"\n"
+            for (channel, message_id), timestamp in refs.items()
+        ))
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print("Usage: python -m db.user_index rebuild")
+        sys.exit(1)
+    if not rebuild():
+        print("The user message index is being rebuilt already")
+        sys.exit(1)
+    print("Rebuilt the user message index")
@@ -1,12 +1,14 @@
-import json, os
+import os
 from . import roles
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json_codec
+from .locking import serialized, write_json
 from logger import Logger
 _MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 users_index = os.path.join(_MODULE_DIR, "users.json")
-config = json.load(open(os.path.join(_MODULE_DIR, "..", "config.json"), "r"))
+config = json_codec.load(open(os.path.join(_MODULE_DIR, "..", "config.json"), "r"))
 
 def user_exists(user_id):
     """
@@ -14,7 +16,7 @@ def user_exists(user_id):
     """
     try:
         with open(users_index, "r") as f:
-            users = json.load(f)
+            users = json_codec.load(f)
         return user_id in users
     except FileNotFoundError:
         return False
@@ -25,18 +27,19 @@ def get_user(user_id):
     """
     try:
         with open(users_index, "r") as f:
-            users = json.load(f)
+            users = json_codec.load(f)
         return users.get(user_id, None)
     except FileNotFoundError:
         return None
 
+@serialized
 def add_user(user_id):
     """
     Add a new user to the users database.
     """
     try:
         with open(users_index, "r") as f:
-            users = json.load(f)
+            users = json_codec.load(f)
     except FileNotFoundError:
         users = {}
 
@@ -45,8 +48,7 @@ def add_user(user_id):
 
     users[user_id] = config["DB"]["users"]["default"].copy()
 
-    with open(users_index, "w") as f:
-        json.dump(users, f, indent=4)
+    write_json(users_index, users, indented=True)
 
     return True
 
@@ -65,7 +67,7 @@ def get_users():
     """
     try:
         with open(users_index, "r") as f:
-            users = json.load(f)
+            users = json_codec.load(f)
 
         for _, user_data in users.items():
             # Get the color of the first role
@@ -91,20 +93,20 @@ def get_users():
     except FileNotFoundError:
         return []
     
+@serialized
 def save_user(user_id, user_data):
     """
     Save user data to the users database.
     """
     try:
         with open(users_index, "r") as f:
-            users = json.load(f)
+            users = json_codec.load(f)
     except FileNotFoundError:
         users = {}
 
     users[user_id] = user_data
 
-    with open(users_index, "w") as f:
-        json.dump(users, f, indent=4)
+    write_json(users_index, users, indented=True)
     
 def get_banned_users():
     """
@@ -112,7 +114,7 @@ def get_banned_users():
     """
     try:
         with open(users_index, "r") as f:
-            users_data = json.load(f)
+            users_data = json_codec.load(f)
         
         banned_users = []
         for user_id, user_data in users_data.items():
@@ -132,6 +134,7 @@ def is_user_banned(user_id):
         return True
     return False
 
+@serialized
 def ban_user(user_id):
     """
     Ban a user by giving them the 'banned' role.
@@ -143,6 +146,7 @@ def ban_user(user_id):
         return True
     return False
 
+@serialized
 def unban_user(user_id):
     """
     Unban a user by removing the 'banned' role.
@@ -154,6 +158,7 @@ def unban_user(user_id):
         return True
     return False
 
+@serialized
 def give_role(user_id, role):
     """
     Give a user a role.
@@ -165,6 +170,7 @@ def give_role(user_id, role):
         return True
     return False
 
+@serialized
 def remove_role(user_id, role):
     """
     Remove a role from a user.
@@ -1,6 +1,7 @@
 import requests
-from db import users, roles
+from db import users, channels
 from handlers.websocket_utils import send_to_client, broadcast_to_all
+from handlers.presence import role_color
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -46,38 +47,104 @@ async def handle_authentication(websocket, data, config_data, connected_clients,
         return False
 
     user["username"] = websocket.username
+    ready = {"cmd": "ready", "user": user}
+    # Lets the client resume instead of authenticating again after a reconnect
+    sessions = server_data.get("sessions") if server_data else None
+    if sessions:
+        websocket.session = ready["session"] = sessions.issue(websocket.username)
+    await send_to_client(websocket, ready)
+
+    await come_online(websocket, user, connected_clients, server_data)
+    Logger.success(f"Client {client_ip} authenticated")
+    return True
+
+async def handle_resume(websocket, data, connected_clients, client_ip, server_data):
+    """Handle a reconnecting client resuming its session, sending what changed in its channels meanwhile"""
+    sessions = server_data.get("sessions")
+    username = sessions.redeem(data.get("session")) if sessions else None
+    if username is None:
+        await send_to_client(websocket, {"cmd": "resume_failed", "val": "Session expired or invalid"})
+        return False
+
+    if users.is_user_banned(username):
+        await send_to_client(websocket, {"cmd": "auth_error", "val": "Access denied: You are banned from this server"})
+        Logger.warning(f"Banned user {username} attempted to resume from {client_ip}")
+        return False
+
+    user = users.get_user(username)
+    if not user:
+        await send_to_client(websocket, {"cmd": "resume_failed", "val": "User not found"})
+        return False
+
+    websocket.authenticated = True
+    websocket.username = username
+    user["username"] = username
+    websocket.session = sessions.issue(username)
+
+    # Subscribe before reading the change logs, with nothing awaited in between, so every
+    # change is either in the resumed packet or delivered live after it. Changes are read
+    # from storage, so this works on whichever node the client reconnected to.
+    changes, resync = {}, []
+    subscriptions = server_data.get("subscriptions")
+    if subscriptions:
+        subscriptions.add(websocket, user.get("roles", []))
+        visible = websocket.subscribed_channels
+    else:
+        visible = {channel.get("name") for channel in channels.get_all_channels_for_roles(user.get("roles", []))}
+    last_seen = data.get("channels")
+    if isinstance(last_seen, dict):
+        for channel_name, rev in last_seen.items():
+            if channel_name not in visible:
+                continue
+            delta = None
+            if isinstance(rev, int) and not isinstance(rev, bool):
+                delta = channels.get_messages_since(channel_name, rev=rev)
+            if delta is None:
+                resync.append(channel_name)
+            else:
+                changes[channel_name] = delta
+
     await send_to_client(websocket, {
-        "cmd": "ready",
-        "user": user
-    })
-    
-    # Get the color of the first role for user_connect broadcast
-    user_roles = user.get("roles", [])
-    color = None
-    if user_roles:
-        first_role_name = user_roles[0]
-        first_role_data = roles.get_role(first_role_name)
-        if first_role_data:
-            color = first_role_data.get("color")
-    
-    # Broadcast user connection to all clients
-    await broadcast_to_all(connected_clients, {
-        "cmd": "user_connect",
-        "user": {
-            "username": websocket.username,
-            "roles": user.get("roles"),
-            "color": color
-        }
+        "cmd": "resumed",
+        "user": user,
+        "session": websocket.session,
+        "channels": changes,
+        "resync": resync
     })
+
+    await come_online(websocket, user, connected_clients, server_data)
+    Logger.success(f"Client {client_ip} resumed the session of {username}, {len(changes)} channels synced")
+    return True
+
+async def come_online(websocket, user, connected_clients, server_data=None):
+    """Count an authenticated socket as online and subscribe it to its channels"""
+    # Count the socket as online, the index announces the user in its next presence_update
+    presence = server_data.get("presence") if server_data else None
+    if presence:
+        first_connection = presence.connect(websocket, user)
+        color = presence.user(websocket.username)["color"]
+    else:
+        first_connection = True
+        color = role_color(user.get("roles", []))
+        await broadcast_to_all(connected_clients, {
+            "cmd": "user_connect",
+            "user": {
+                "username": websocket.username,
+                "roles": user.get("roles"),
+                "color": color
+            }
+        })
     
-    # Trigger user_connect event for plugins
-    if server_data and "plugin_manager" in server_data:
+    # Channel broadcasts are delivered to the channels the user can view
+    subscriptions = server_data.get("subscriptions") if server_data else None
+    if subscriptions:
+        subscriptions.add(websocket, user.get("roles", []))
+
+    # Trigger user_connect event for plugins when the user comes online
+    if first_connection and server_data and "plugin_manager" in server_data:
         server_data["plugin_manager"].trigger_event("user_connect", websocket, {
             "username": websocket.username,
             "roles": user.get("roles"),
             "color": color,
             "user": user
         }, server_data)
-    
-    Logger.success(f"Client {client_ip} authenticated")
-    return True
@@ -0,0 +1,99 @@
+import json_codec
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Subprotocols are named "originchats.<codec>", e.g. "originchats.msgpack"
+SUBPROTOCOL_PREFIX = "originchats."
+
+class CodecError(ValueError):
+    """Raised when a frame cannot be decoded with the connection's codec"""
+
+class JsonCodec:
+    """Default codec, frames are JSON text (encoded to UTF-8 bytes once, sent as text frames)"""
+
+    name = "json"
+    binary = False
+
+    def encode(self, message):
+        return json_codec.dumps_bytes(message)
+
+    def decode(self, data):
+        try:
+            return json_codec.loads(data)
+        except (json_codec.JSONDecodeError, UnicodeDecodeError) as e:
+            raise CodecError(str(e))
+
+class MsgpackCodec:
+    """Frames are MessagePack encoded binary messages"""
+
+    name = "msgpack"
+    binary = True
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, data):
+        if isinstance(data, str):
+            raise CodecError("Expected a binary frame")
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except (msgpack.ExtraData, msgpack.FormatError, msgpack.StackError, ValueError) as e:
+            raise CodecError(str(e))
+
+JSON = JsonCodec()
+
+# Codecs clients can choose from, only those whose library is installed
+CODECS = {JSON.name: JSON}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+def get_codec(name):
+    """Return the codec with this name, or None if it is unknown or unavailable"""
+    return CODECS.get(name)
+
+def codec_for(ws):
+    """The codec a connection negotiated, JSON if it never chose one"""
+    return getattr(ws, "codec", JSON)
+
+def subprotocols():
+    """Subprotocols advertised to clients, one per available codec"""
+    return [SUBPROTOCOL_PREFIX + name for name in CODECS]
+
+def select_subprotocol(connection, offered):
+    """
+    Pick the first offered subprotocol we support. Unlike the websockets default,
+    clients offering only unknown subprotocols are still accepted and use JSON.
+    """
+    for subprotocol in offered:
+        if subprotocol.startswith(SUBPROTOCOL_PREFIX) and subprotocol[len(SUBPROTOCOL_PREFIX):] in CODECS:
+            return subprotocol
+    return None
+
+def codec_for_subprotocol(subprotocol):
+    if subprotocol and subprotocol.startswith(SUBPROTOCOL_PREFIX):
+        return get_codec(subprotocol[len(SUBPROTOCOL_PREFIX):]) or JSON
+    return JSON
+
+class SharedFrame:
+    """
+    A message sent to many clients. It is encoded at most once per codec,
+    however many recipients share that codec.
+    """
+
+    __slots__ = ("message", "_encoded")
+
+    def __init__(self, message):
+        self.message = message
+        self._encoded = {}
+
+    def encode(self, codec):
+        payload = self._encoded.get(codec.name)
+        if payload is None:
+            payload = self._encoded[codec.name] = codec.encode(self.message)
+        return payload
+
+    def for_client(self, ws):
+        return self.encode(codec_for(ws))
@@ -0,0 +1,145 @@
+import asyncio
+import time
+from db import segments
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from logger import Logger
+from metrics import metrics
+
+class Compactor:
+    """
+    Background compaction of channel segments (see db/segments.py).
+
+    Every `interval` seconds the compactor looks at the segments of every
+    channel and, in a worker thread so the event loop keeps serving clients:
+
+    - rewrites a segment whose patch records (edits and deletes) reach
+      `garbage_ratio` of its messages, dropping the deleted messages and
+      folding in the edits,
+    - merges a segment smaller than `min_segment_bytes` into the following
+      one, as long as the result stays within the segment size limit,
+    - archives segments whose newest message is older than
+      `archive_after_seconds`, and the oldest live segments beyond the newest
+      `archive_keep_segments`, compressing each with `archive_codec`.
+
+    The newest segment of a channel is never archived. At most
+    `max_segments_per_run` segments are compacted per pass. New segments are
+    built without locking, the channel's lock is only held to swap them in, so
+    message writes never wait for a segment to be rebuilt.
+    """
+
+    def __init__(self, interval: float = 60, garbage_ratio: float = 0.25,
+                 min_segment_bytes: int = 64 * 1024, max_segments_per_run: int = 16,
+                 archive_after_seconds: float = None, archive_keep_segments: int = None,
+                 archive_codec: str = "gzip"):
+        self.interval = interval
+        self.garbage_ratio = garbage_ratio
+        self.min_segment_bytes = min_segment_bytes
+        self.max_segments_per_run = max_segments_per_run
+        self.archive_after_seconds = archive_after_seconds
+        self.archive_keep_segments = archive_keep_segments
+        if archive_codec not in segments.ARCHIVE_CODECS:
+            Logger.warning(f"Archive codec '{archive_codec}' is not available, using gzip")
+            archive_codec = "gzip"
+        self.archive_codec = archive_codec
+        self.stats = {
+            "runs": 0,
+            "last_run": None,
+            "segments": 0,
+            "garbage_records": 0,
+            "rewritten": 0,
+            "merged": 0,
+            "archived": 0,
+            "archived_segments": 0,
+            "bytes_reclaimed": 0
+        }
+        self._task = None
+        metrics.register_source("compaction", self.snapshot)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await loop.run_in_executor(None, self.run_once)
+            except Exception as e:
+                Logger.error(f"Compaction error: {str(e)}")
+
+    def plan(self, channel_name):
+        """The compaction steps a channel needs now, as ("rewrite" | "merge" | "archive", segment) tuples"""
+        survey = segments.survey(channel_name)
+        steps = []
+        merged_into = None
+        live = [info["segment"] for info in survey if not info["archived"]]
+        archive_before = time.time() - self.archive_after_seconds if self.archive_after_seconds is not None else None
+        for i, info in enumerate(survey):
+            if info["segment"] == merged_into:
+                continue  # already part of a merge
+            garbage = info["patches"] / info["messages"] if info["messages"] else float(info["patches"] > 0)
+            following = survey[i + 1] if i + 1 < len(survey) else None
+            if (following is not None and not info["archived"] and not following["archived"]
+                    and info["bytes"] < self.min_segment_bytes
+                    and info["bytes"] + following["bytes"] <= segments.SEGMENT_MAX_BYTES):
+                steps.append(("merge", info["segment"]))
+                merged_into = following["segment"]
+            elif not info["archived"] and following is not None and (
+                    (archive_before is not None and info["max_ts"] is not None and info["max_ts"] < archive_before)
+                    or (self.archive_keep_segments is not None
+                        and len(live) - live.index(info["segment"]) > self.archive_keep_segments)):
+                steps.append(("archive", info["segment"]))
+            elif info["patches"] and garbage >= self.garbage_ratio:
+                steps.append(("rewrite", info["segment"]))
+        return steps, survey
+
+    def run_once(self):
+        """One compaction pass over every channel, returns the number of segments compacted"""
+        started = time.perf_counter()
+        compacted = 0
+        total_segments = 0
+        garbage_records = 0
+        archived_segments = 0
+        for channel_name in segments.list_channels():
+            steps, survey = self.plan(channel_name)
+            total_segments += len(survey)
+            garbage_records += sum(info["patches"] for info in survey)
+            archived_segments += sum(info["archived"] for info in survey)
+            for action, segment in steps:
+                if compacted >= self.max_segments_per_run:
+                    break
+                if action == "merge":
+                    result = segments.merge_segments(channel_name, segment)
+                elif action == "archive":
+                    result = segments.archive_segment(channel_name, segment, self.archive_codec)
+                else:
+                    result = segments.rewrite_segment(channel_name, segment)
+                if result is None:
+                    continue
+                before, after = result
+                compacted += 1
+                counter = {"merge": "merged", "archive": "archived", "rewrite": "rewritten"}[action]
+                self.stats[counter] += 1
+                self.stats["bytes_reclaimed"] += max(0, before - after)
+                metrics.increment(f"compaction.{counter}")
+                metrics.increment("compaction.bytes_reclaimed", max(0, before - after))
+
+        self.stats["runs"] += 1
+        self.stats["last_run"] = time.time()
+        self.stats["segments"] = total_segments
+        self.stats["garbage_records"] = garbage_records
+        self.stats["archived_segments"] = archived_segments
+        metrics.observe("compaction.run_ms", (time.perf_counter() - started) * 1000)
+        if compacted:
+            Logger.info(f"Compacted {compacted} channel segments")
+        return compacted
+
+    def snapshot(self):
+        return dict(self.stats)
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from websockets import frames
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import metrics, SIZE_BUCKETS_BYTES
+
+# Same defaults websockets uses when compression is left at "deflate"
+DEFAULTS = {
+    "enabled": True,
+    "server_max_window_bits": 12,
+    "client_max_window_bits": 12,
+    "mem_level": 5,
+    "min_size": 256,
+    "server_no_context_takeover": False,
+    "shared_frame_cache": 32
+}
+
+class CompressedFrameCache:
+    """
+    Recently compressed payloads, shared by every connection.
+
+    Without context takeover each message is compressed on its own, so the same
+    payload compressed with the same window size gives the same bytes for every
+    recipient and a broadcast only needs to be compressed once.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def put(self, key, data: bytes):
+        self._entries[key] = data
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """
+    permessage-deflate that leaves messages under `min_size` bytes uncompressed,
+    which RFC 7692 allows per message, and reuses compressed frames from `cache`.
+    """
+
+    def __init__(self, *args, min_size: int = 0, cache: CompressedFrameCache = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+        self.cache = cache
+        self._skipping_message = False
+
+    def encode(self, frame: frames.Frame) -> frames.Frame:
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+
+        # Continuation frames follow whatever was decided for the first frame
+        if frame.opcode is frames.OP_CONT:
+            if self._skipping_message:
+                self._skipping_message = not frame.fin
+                return frame
+            return super().encode(frame)
+
+        size = len(frame.data)
+        if size < self.min_size:
+            self._skipping_message = not frame.fin
+            metrics.increment("ws.compression.skipped")
+            return frame
+
+        key = None
+        if self.cache is not None and frame.fin and isinstance(frame.data, bytes):
+            key = (self.local_max_window_bits, frame.data)
+            compressed = self.cache.get(key)
+            if compressed is not None:
+                metrics.increment("ws.compression.cache_hits")
+                metrics.observe("ws.compressed_message_bytes", len(compressed), buckets=SIZE_BUCKETS_BYTES)
+                return frames.Frame(frame.opcode, compressed, True, True, frame.rsv2, frame.rsv3)
+
+        encoded = super().encode(frame)
+        if key is not None:
+            self.cache.put(key, bytes(encoded.data))
+        metrics.observe("ws.compressed_message_bytes", len(encoded.data), buckets=SIZE_BUCKETS_BYTES)
+        return encoded
+
+class ServerDeflateFactory(ServerPerMessageDeflateFactory):
+    """Negotiates permessage-deflate like websockets does, with a size threshold and shared frames"""
+
+    def __init__(self, min_size: int = 0, cache_size: int = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+        self.cache = CompressedFrameCache(cache_size) if cache_size > 0 else None
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_size=self.min_size,
+            # Compressed output only matches across connections without context takeover
+            cache=self.cache if extension.local_no_context_takeover else None
+        )
+
+def build_extensions(compression_config=None):
+    """Server extensions for websockets.serve from the `compression` section of config.json"""
+    settings = dict(DEFAULTS)
+    settings.update(compression_config or {})
+    if not settings["enabled"]:
+        return []
+    return [ServerDeflateFactory(
+        min_size=settings["min_size"],
+        cache_size=settings["shared_frame_cache"],
+        server_no_context_takeover=settings["server_no_context_takeover"],
+        server_max_window_bits=settings["server_max_window_bits"],
+        client_max_window_bits=settings["client_max_window_bits"],
+        compress_settings={"memLevel": settings["mem_level"]}
+    )]
@@ -0,0 +1,128 @@
+import asyncio
+import websockets
+from websockets.protocol import State
+from handlers.codecs import SharedFrame
+from handlers.websocket_utils import send_raw
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from logger import Logger
+from metrics import metrics
+
+class HeartbeatScheduler:
+    """
+    One timer for the heartbeats of every connection.
+
+    Connections are spread over `buckets` slots of a timer wheel. Each tick the
+    wheel advances one slot, so every connection is visited once per `interval`
+    while the work is spread evenly over it. A visit sends the ping frame,
+    encoded once per codec for the scheduler's lifetime, plus a protocol-level
+    ping. Any frame or pong from the client marks it as seen. Clients not seen
+    for `timeout` seconds are treated as dead and their transport is aborted,
+    which ends their handle_client loop and runs the usual disconnect cleanup.
+
+    Pings are sent from short-lived tasks, so a client that stops reading
+    only stalls its own ping, never the wheel. A client with more than
+    `max_buffer_bytes` waiting in its send buffer is reaped as well.
+    """
+
+    def __init__(self, interval: float = 30, timeout: float = 90, buckets: int = 30,
+                 max_buffer_bytes: int = 1024 * 1024):
+        self.interval = interval
+        self.timeout = timeout
+        self.max_buffer_bytes = max_buffer_bytes
+        self.buckets = [set() for _ in range(max(1, buckets))]
+        self.tick = self.interval / len(self.buckets)
+        self.cursor = 0
+        self.ping_frame = SharedFrame({"cmd": "ping"})
+        self.loop = None
+        self._task = None
+        # In-flight ping tasks, referenced here so they are not garbage collected
+        self._pings = set()
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._task = self.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._pings):
+            task.cancel()
+
+    def add(self, ws):
+        """Start tracking a connection, its first ping goes out one interval from now"""
+        ws.last_seen = asyncio.get_running_loop().time()
+        # The slot just behind the cursor is the last one the wheel reaches
+        slot = (self.cursor - 1) % len(self.buckets)
+        ws.heartbeat_slot = slot
+        self.buckets[slot].add(ws)
+
+    def remove(self, ws):
+        slot = getattr(ws, "heartbeat_slot", None)
+        if slot is not None:
+            self.buckets[slot].discard(ws)
+
+    def seen(self, ws):
+        """Record that the client is alive, called for every frame it sends"""
+        ws.last_seen = self.loop.time() if self.loop else asyncio.get_running_loop().time()
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    async def _run(self):
+        next_tick = self.loop.time()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0, next_tick - self.loop.time()))
+            bucket = self.buckets[self.cursor]
+            self.cursor = (self.cursor + 1) % len(self.buckets)
+            try:
+                self._visit(bucket)
+            except Exception as e:
+                Logger.error(f"Heartbeat error: {str(e)}")
+
+    def _visit(self, bucket):
+        now = self.loop.time()
+        for ws in list(bucket):
+            if ws.state is not State.OPEN or now - ws.last_seen > self.timeout:
+                self._reap(ws, bucket)
+                continue
+            if ws.transport is not None and ws.transport.get_write_buffer_size() > self.max_buffer_bytes:
+                # The client stopped reading what we send it
+                self._reap(ws, bucket)
+                continue
+            previous = getattr(ws, "heartbeat_ping", None)
+            if previous is not None and not previous.done():
+                continue  # its last ping is still waiting for the socket to drain
+            task = ws.heartbeat_ping = self.loop.create_task(self._ping(ws, bucket))
+            self._pings.add(task)
+            task.add_done_callback(self._pings.discard)
+
+    async def _ping(self, ws, bucket):
+        try:
+            sent = await asyncio.wait_for(send_raw(ws, self.ping_frame.for_client(ws)), self.interval)
+            if not sent:
+                if ws in bucket:
+                    self._reap(ws, bucket)
+                return
+            metrics.increment("heartbeat.pings")
+            pong_waiter = await asyncio.wait_for(ws.ping(), self.interval)
+        except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
+            return
+        except Exception as e:
+            Logger.error(f"Heartbeat error: {str(e)}")
+            return
+        pong_waiter.add_done_callback(lambda future, ws=ws: self._on_pong(ws, future))
+
+    def _on_pong(self, ws, future):
+        if not future.cancelled() and future.exception() is None:
+            ws.last_seen = self.loop.time()
+
+    def _reap(self, ws, bucket):
+        bucket.discard(ws)
+        metrics.increment("heartbeat.reaped")
+        Logger.delete(f"Reaping unresponsive connection{' of ' + ws.username if getattr(ws, 'username', None) else ''}")
+        if ws.transport is not None:
+            ws.transport.abort()
@@ -1,391 +1,424 @@
-from db import channels, users, roles
+from db import channels, users, search, user_index
+from handlers.registry import CommandRegistry
+from handlers.codecs import SharedFrame
+from handlers.presence import role_color
 import time
 import uuid
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from logger import Logger
+from metrics import metrics
+
+# Command registry shared by the core commands below and by plugins
+registry = CommandRegistry()
+command = registry.command
 
 def handle(ws, message, server_data=None):
     """
     Handle incoming messages from clients.
     This function should be called when a new message is received.
-    
+
     Args:
         ws: WebSocket connection
         message: Message data from client
         server_data: Dict containing server state (connected_clients, etc.)
     """
-    if True:
-        # Process the message here
-        Logger.get(f"Received message: {message}")
-
-        if not isinstance(message, dict):
-            return {"cmd": "error", "val": f"Invalid message format: expected a dictionary, got {type(message).__name__}"}
-
-        match_cmd = message.get("cmd")
-        match match_cmd:
-            case "ping":
-                # Handle ping command
-                return {"cmd": "pong", "val": "pong"}
-            case "message_new":
-                if server_data is None:
-                    return {"cmd": "error", "val": "Server data not available"}
-                # Handle chat message
-                channel_name = message.get("channel")
-                content = message.get("content")
-                reply_to = message.get("reply_to")  # Optional: ID of message being replied to
-                user = getattr(ws, 'username', None)
-
-                if not channel_name or not content or not user:
-                    return {"cmd": "error", "val": "Invalid chat message format"}
-
-                content = content.strip()
-                if not content:
-                    return {"cmd": "error", "val": "Message content cannot be empty"}
-
-                # Check message length limit from config
-                max_length = server_data.get("config", {}).get("limits", {}).get("post_content", 2000)
-                if len(content) > max_length:
-                    return {"cmd": "error", "val": f"Message too long. Maximum length is {max_length} characters"}
-
-                # Check rate limiting if enabled
-                if server_data and server_data.get("rate_limiter"):
-                    is_allowed, reason, wait_time = server_data["rate_limiter"].is_allowed(user)
-                    if not is_allowed:
-                        # Convert wait time to milliseconds and send rate_limit packet
-                        wait_time_ms = int(wait_time * 1000)
-                        return {"cmd": "rate_limit", "length": wait_time_ms}
-
-                user_roles = users.get_user_roles(user)
-                if not user_roles:
-                    return {"cmd": "error", "val": "User roles not found"}
-
-                # Check if the user has permission to send messages in this channel
-                if not channels.does_user_have_permission(channel_name, user_roles, "send"):
-                    return {"cmd": "error", "val": "You do not have permission to send messages in this channel"}
-
-                # Validate reply_to if provided
-                replied_message = None
-                if reply_to:
-                    replied_message = channels.get_channel_message(channel_name, reply_to)
-                    if not replied_message:
-                        return {"cmd": "error", "val": "The message you're trying to reply to was not found"}
-
-                # Save the message to the channel
-                out_msg = {
-                    "user": user,
-                    "content": content,
-                    "timestamp": time.time(),  # Use current timestamp
-                    "type": "message",
-                    "pinned": False,
-                    "id": str(uuid.uuid4())
-                }
-
-                # Add reply information if this is a reply
-                if reply_to and replied_message:
-                    out_msg["reply_to"] = {
-                        "id": reply_to,
-                        "user": replied_message.get("user")
-                    }
-
-                channels.save_channel_message(channel_name, out_msg)
-
-                # Trigger new_message event for plugins
-                if server_data and "plugin_manager" in server_data:
-                    server_data["plugin_manager"].trigger_event("new_message", ws, {
-                        "content": content,
-                        "channel": channel_name,
-                        "user": user,
-                        "message": out_msg
-                    }, server_data)
-
-                # Optionally broadcast to all clients
-                return {"cmd": "message_new", "message": out_msg, "channel": channel_name, "global": True}
-            case "message_edit":
-                # Handle message edit
-                user = getattr(ws, 'username', None)
-                if not user:
-                    return {"cmd": "error", "val": "User not authenticated"}
-                # Check rate limiting if enabled
-                if server_data and server_data.get("rate_limiter"):
-                    is_allowed, reason, wait_time = server_data["rate_limiter"].is_allowed(user)
-                    if not is_allowed:
-                        # Convert wait time to milliseconds and send rate_limit packet
-                        wait_time_ms = int(wait_time * 1000)
-                        return {"cmd": "rate_limit", "length": wait_time_ms}
-                message_id = message.get("id")
-                channel_name = message.get("channel")
-                new_content = message.get("content")
-                if not message_id or not channel_name or not new_content:
-                    return {"cmd": "error", "val": "Invalid message edit format"}
-                # Check if the message exists
-                msg_obj = channels.get_channel_message(channel_name, message_id)
-                if not msg_obj:
-                    return {"cmd": "error", "val": "Message not found or cannot be edited"}
-                user_roles = users.get_user_roles(user)
-                if not user_roles:
-                    return {"cmd": "error", "val": "User roles not found"}
-                if msg_obj.get("user") == user:
-                    # Editing own message
-                    if not channels.can_user_edit_own(channel_name, user_roles):
-                        return {"cmd": "error", "val": "You do not have permission to edit your own message in this channel"}
-                else:
-                    # Editing someone else's message (future: add edit permission if needed)
-                    return {"cmd": "error", "val": "You do not have permission to edit this message"}
-                if not channels.edit_channel_message(channel_name, message_id, new_content):
-                    return {"cmd": "error", "val": "Failed to edit message"}
-                return {"cmd": "message_edit", "id": message_id, "content": new_content, "channel": channel_name, "global": True}
-            case "message_delete":
-                # Handle message delete
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-                
-                # Check rate limiting if enabled
-                if server_data and server_data.get("rate_limiter"):
-                    is_allowed, reason, wait_time = server_data["rate_limiter"].is_allowed(username)
-                    if not is_allowed:
-                        # Convert wait time to milliseconds and send rate_limit packet
-                        wait_time_ms = int(wait_time * 1000)
-                        return {"cmd": "rate_limit", "length": wait_time_ms}
-                
-                message_id = message.get("id")
-                channel_name = message.get("channel")
-                if not message_id or not channel_name:
-                    return {"cmd": "error", "val": "Invalid message delete format"}
-
-                # Check if the message exists and can be deleted
-                message = channels.get_channel_message(channel_name, message_id)
-                if not message:
-                    return {"cmd": "error", "val": "Message not found or cannot be deleted"}
-                
-                user_roles = users.get_user_roles(username)
-                if not user_roles:
-                    return {"cmd": "error", "val": "User roles not found"}
-                
-
-                if message.get("user") == username:
-                    # User is deleting their own message
-                    if not channels.can_user_delete_own(channel_name, user_roles):
-                        return {"cmd": "error", "val": "You do not have permission to delete your own message in this channel"}
-                else:
-                    # User is deleting someone else's message
-                    if not channels.does_user_have_permission(channel_name, user_roles, "delete"):
-                        return {"cmd": "error", "val": "You do not have permission to delete this message"}
-
-                if not channels.delete_channel_message(channel_name, message_id):
-                    return {"cmd": "error", "val": "Failed to delete message"}
-                return {"cmd": "message_delete", "id": message_id, "channel": channel_name, "global": True}
-            case "messages_get":
-                # Handle request for channel messages
-                channel_name = message.get("channel")
-                limit = message.get("limit", 100)
-
-                if not channel_name:
-                    return {"cmd": "error", "val": "Invalid channel name"}
-
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-
-                user_data = users.get_user(username)
-                if not user_data:
-                    return {"cmd": "error", "val": "User not found"}
-
-                # Check if user can see this channel
-                allowed_channels = channels.get_all_channels_for_roles(user_data.get("roles", []))
-
-                if channel_name not in [c.get("name") for c in allowed_channels if c.get("type") == "text"]:
-                    return {"cmd": "error", "val": "Access denied to this channel"}
-
-                messages = channels.get_channel_messages(channel_name, limit)
-                return {"cmd": "messages_get", "channel": channel_name, "messages": messages}
-            case "message_get":
-                # Handle request for a specific message by ID
-                channel_name = message.get("channel")
-                message_id = message.get("id")
-
-                if not channel_name or not message_id:
-                    return {"cmd": "error", "val": "Channel name and message ID are required"}
-
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-
-                user_data = users.get_user(username)
-                if not user_data:
-                    return {"cmd": "error", "val": "User not found"}
-
-                # Check if user can see this channel
-                allowed_channels = channels.get_all_channels_for_roles(user_data.get("roles", []))
-
-                if channel_name not in [c.get("name") for c in allowed_channels if c.get("type") == "text"]:
-                    return {"cmd": "error", "val": "Access denied to this channel"}
-
-                # Get the specific message
-                msg = channels.get_channel_message(channel_name, message_id)
-                if not msg:
-                    return {"cmd": "error", "val": "Message not found"}
-
-                return {"cmd": "message_get", "channel": channel_name, "message": msg}
-            case "message_replies":
-                # Handle request for replies to a specific message
-                channel_name = message.get("channel")
-                message_id = message.get("id")
-                limit = message.get("limit", 50)
-
-                if not channel_name or not message_id:
-                    return {"cmd": "error", "val": "Channel name and message ID are required"}
-
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-
-                user_data = users.get_user(username)
-                if not user_data:
-                    return {"cmd": "error", "val": "User not found"}
-
-                # Check if user can see this channel
-                allowed_channels = channels.get_all_channels_for_roles(user_data.get("roles", []))
-
-                if channel_name not in [c.get("name") for c in allowed_channels if c.get("type") == "text"]:
-                    return {"cmd": "error", "val": "Access denied to this channel"}
-
-                # Get replies to the message
-                replies = channels.get_message_replies(channel_name, message_id, limit)
-                return {"cmd": "message_replies", "channel": channel_name, "message_id": message_id, "replies": replies}
-            case "channels_get":
-                # Handle request for available channels
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-                    
-                user_data = users.get_user(username)  # Ensure user exists
-                if not user_data:
-                    return {"cmd": "error", "val": "User not found"}
-                channels_list = channels.get_all_channels_for_roles(user_data.get("roles", []))
-                return {"cmd": "channels_get", "val": channels_list}
-            case "users_list":
-                # Handle request for all users list
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-                
-                users_list = users.get_users()
-                return {"cmd": "users_list", "users": users_list}
-            case "users_online":
-                # Handle request for online users list  
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-                
-                if not server_data or "connected_clients" not in server_data:
-                    return {"cmd": "error", "val": "Server data not available"}
-                
-                # Gather authenticated users' info efficiently
-                online_users = []
-                for client_ws in server_data["connected_clients"]:
-                    if getattr(client_ws, "authenticated", False):
-                        user_data = users.get_user(client_ws.username)
-                        if not user_data:
-                            continue
-                        
-                        # Get the color of the first role
-                        user_roles = user_data.get("roles", [])
-                        color = None
-                        if user_roles:
-                            first_role_name = user_roles[0]
-                            first_role_data = roles.get_role(first_role_name)
-                            if first_role_data:
-                                color = first_role_data.get("color")
-                        
-                        online_users.append({
-                            "username": client_ws.username,
-                            "roles": user_data.get("roles"),
-                            "color": color
-                        })
-                
-                return {"cmd": "users_online", "users": online_users}
-            case "plugins_list":
-                # Handle request for loaded plugins (admin only)
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-                
-                user_roles = users.get_user_roles(username)
-                if not user_roles or "owner" not in user_roles:
-                    return {"cmd": "error", "val": "Access denied: owner role required"}
-                
-                if not server_data or "plugin_manager" not in server_data:
-                    return {"cmd": "error", "val": "Plugin manager not available"}
-                
-                plugins = server_data["plugin_manager"].get_loaded_plugins()
-                return {"cmd": "plugins_list", "plugins": plugins}
-            case "plugins_reload":
-                # Handle request to reload plugins (admin only)
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-                
-                user_roles = users.get_user_roles(username)
-                if not user_roles or "owner" not in user_roles:
-                    return {"cmd": "error", "val": "Access denied: owner role required"}
-                
-                if not server_data or "plugin_manager" not in server_data:
-                    return {"cmd": "error", "val": "Plugin manager not available"}
-                
-                plugin_name = message.get("plugin")
-                if plugin_name:
-                    # Reload specific plugin
-                    success = server_data["plugin_manager"].reload_plugin(plugin_name)
-                    if success:
-                        return {"cmd": "plugins_reload", "val": f"Plugin '{plugin_name}' reloaded successfully"}
-                    else:
-                        return {"cmd": "error", "val": f"Failed to reload plugin '{plugin_name}'"}
-                else:
-                    # Reload all plugins
-                    server_data["plugin_manager"].reload_all_plugins()
-                    return {"cmd": "plugins_reload", "val": "All plugins reloaded successfully"}
-            case "rate_limit_status":
-                # Handle request for rate limit status (admin or self)
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-                
-                target_user = message.get("user", username)  # Default to self
-                user_roles = users.get_user_roles(username)
-                
-                # Allow users to check their own status, or admins to check anyone's
-                if target_user != username and (not user_roles or "owner" not in user_roles):
-                    return {"cmd": "error", "val": "Access denied: can only check your own rate limit status"}
-                
-                if not server_data or not server_data.get("rate_limiter"):
-                    return {"cmd": "error", "val": "Rate limiter not available or disabled"}
-                
-                status = server_data["rate_limiter"].get_user_status(target_user)
-                return {"cmd": "rate_limit_status", "user": target_user, "status": status}
-            case "rate_limit_reset":
-                # Handle request to reset rate limit for a user (admin only)
-                username = getattr(ws, 'username', None)
-                if not username:
-                    return {"cmd": "error", "val": "User not authenticated"}
-                
-                user_roles = users.get_user_roles(username)
-                if not user_roles or "owner" not in user_roles:
-                    return {"cmd": "error", "val": "Access denied: owner role required"}
-                
-                target_user = message.get("user")
-                if not target_user:
-                    return {"cmd": "error", "val": "User parameter is required"}
-                
-                if not server_data or not server_data.get("rate_limiter"):
-                    return {"cmd": "error", "val": "Rate limiter not available or disabled"}
-                
-                server_data["rate_limiter"].reset_user(target_user)
-                return {"cmd": "rate_limit_reset", "user": target_user, "val": f"Rate limit reset for user {target_user}"}
-            case _:
-                return {"cmd": "error", "val": f"Unknown command: {message.get('cmd')}"}
-    # except Exception as e:
-    #    print(f"[OriginChatsWS] Error handling message: {str(e)}")
-    #    return {"cmd": "error", "val": f"Exception: {str(e)}"}
\ No newline at end of file
+    Logger.get(f"Received message: {message}")
+    return registry.dispatch(ws, message, server_data)
+
+@command("ping", auth=False, batchable=True)
+def ping(ctx):
+    return {"cmd": "pong", "val": "pong"}
+
+def _validate_message_new(ctx):
+    """Reject malformed, empty and overlong messages before they count against the rate limit"""
+    server_data = ctx.server_data
+    if server_data is None:
+        return {"cmd": "error", "val": "Server data not available"}
+    channel_name = ctx.message.get("channel")
+    content = ctx.message.get("content")
+
+    if not channel_name or not content or not ctx.username:
+        return {"cmd": "error", "val": "Invalid chat message format"}
+
+    content = content.strip()
+    if not content:
+        return {"cmd": "error", "val": "Message content cannot be empty"}
+
+    # Check message length limit from config
+    max_length = server_data.get("config", {}).get("limits", {}).get("post_content", 2000)
+    if len(content) > max_length:
+        return {"cmd": "error", "val": f"Message too long. Maximum length is {max_length} characters"}
+    return None
+
+@command("message_new", rate_limited=True, channel_permission="send", validate=_validate_message_new)
+def message_new(ctx):
+    server_data = ctx.server_data
+    # Handle chat message, already validated by _validate_message_new
+    channel_name = ctx.message.get("channel")
+    content = ctx.message.get("content").strip()
+    reply_to = ctx.message.get("reply_to")  # Optional: ID of message being replied to
+    user = ctx.username
+
+    # Validate reply_to if provided
+    replied_message = None
+    if reply_to:
+        replied_message = channels.get_channel_message(channel_name, reply_to)
+        if not replied_message:
+            return {"cmd": "error", "val": "The message you're trying to reply to was not found"}
+
+    # Save the message to the channel
+    out_msg = {
+        "user": user,
+        "content": content,
+        "timestamp": time.time(),  # Use current timestamp
+        "type": "message",
+        "pinned": False,
+        "id": str(uuid.uuid4())
+    }
+
+    # Add reply information if this is a reply
+    if reply_to and replied_message:
+        out_msg["reply_to"] = {
+            "id": reply_to,
+            "user": replied_message.get("user")
+        }
+
+    rev = channels.save_channel_message(channel_name, out_msg)
+
+    # Trigger new_message event for plugins
+    if "plugin_manager" in server_data:
+        server_data["plugin_manager"].trigger_event("new_message", ctx.ws, {
+            "content": content,
+            "channel": channel_name,
+            "user": user,
+            "roles": ctx.roles,
+            "message": out_msg
+        }, server_data)
+
+    # Optionally broadcast to all clients. rev lets clients resume the channel from this change
+    return {"cmd": "message_new", "message": out_msg, "channel": channel_name, "rev": rev, "global": True}
+
+@command("message_edit", rate_limited=True)
+def message_edit(ctx):
+    user = ctx.username
+    message_id = ctx.message.get("id")
+    channel_name = ctx.message.get("channel")
+    new_content = ctx.message.get("content")
+    if not message_id or not channel_name or not new_content:
+        return {"cmd": "error", "val": "Invalid message edit format"}
+    # Check if the message exists
+    msg_obj = channels.get_channel_message(channel_name, message_id)
+    if not msg_obj:
+        return {"cmd": "error", "val": "Message not found or cannot be edited"}
+    if not ctx.roles:
+        return {"cmd": "error", "val": "User roles not found"}
+    if msg_obj.get("user") == user:
+        # Editing own message
+        if not ctx.can_act_on_own(channel_name, "edit_own"):
+            return {"cmd": "error", "val": "You do not have permission to edit your own message in this channel"}
+    else:
+        # Editing someone else's message (future: add edit permission if needed)
+        return {"cmd": "error", "val": "You do not have permission to edit this message"}
+    rev = channels.edit_channel_message(channel_name, message_id, new_content)
+    if not rev:
+        return {"cmd": "error", "val": "Failed to edit message"}
+    return {"cmd": "message_edit", "id": message_id, "content": new_content, "channel": channel_name, "rev": rev, "global": True}
+
+@command("message_delete", rate_limited=True)
+def message_delete(ctx):
+    username = ctx.username
+    message_id = ctx.message.get("id")
+    channel_name = ctx.message.get("channel")
+    if not message_id or not channel_name:
+        return {"cmd": "error", "val": "Invalid message delete format"}
+
+    # Check if the message exists and can be deleted
+    message = channels.get_channel_message(channel_name, message_id)
+    if not message:
+        return {"cmd": "error", "val": "Message not found or cannot be deleted"}
+
+    if not ctx.roles:
+        return {"cmd": "error", "val": "User roles not found"}
+
+    if message.get("user") == username:
+        # User is deleting their own message
+        if not ctx.can_act_on_own(channel_name, "delete_own"):
+            return {"cmd": "error", "val": "You do not have permission to delete your own message in this channel"}
+    else:
+        # User is deleting someone else's message
+        if not ctx.has_channel_permission(channel_name, "delete"):
+            return {"cmd": "error", "val": "You do not have permission to delete this message"}
+
+    rev = channels.delete_channel_message(channel_name, message_id)
+    if not rev:
+        return {"cmd": "error", "val": "Failed to delete message"}
+    return {"cmd": "message_delete", "id": message_id, "channel": channel_name, "rev": rev, "global": True}
+
+@command("messages_get", channel_permission="view", batchable=True)
+def messages_get(ctx):
+    channel_name = ctx.message.get("channel")
+    limit = ctx.message.get("limit", 100)
+    before = ctx.message.get("before")
+    before_id = ctx.message.get("before_id")
+
+    if not channel_name:
+        return {"cmd": "error", "val": "Invalid channel name"}
+
+    if before is not None:
+        if not isinstance(before, (int, float)) or isinstance(before, bool):
+            return {"cmd": "error", "val": "before must be a unix timestamp"}
+        if before_id is not None and not isinstance(before_id, str):
+            return {"cmd": "error", "val": "before_id must be a message id"}
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+            return {"cmd": "error", "val": "limit must be a positive integer"}
+        # A page of older history, the sync fields below only describe the live end of the channel
+        messages, more = channels.get_messages_before(channel_name, before, limit, before_id)
+        response = {"cmd": "messages_get", "channel": channel_name, "messages": messages, "before": before, "more": more}
+        if before_id is not None:
+            response["before_id"] = before_id
+        return response
+
+    messages = channels.get_channel_messages(channel_name, limit)
+    # Revision of the stored messages, to sync from later with messages_since or resume
+    return {"cmd": "messages_get", "channel": channel_name, "messages": messages, "rev": channels.get_channel_rev(channel_name)}
+
+@command("messages_range", channel_permission="view", batchable=True)
+def messages_range(ctx):
+    channel_name = ctx.message.get("channel")
+    start = ctx.message.get("from")
+    end = ctx.message.get("to")
+    limit = ctx.message.get("limit", 100)
+
+    if not channel_name:
+        return {"cmd": "error", "val": "Invalid channel name"}
+    for bound in (start, end):
+        if bound is not None and (not isinstance(bound, (int, float)) or isinstance(bound, bool)):
+            return {"cmd": "error", "val": "from and to must be unix timestamps"}
+    if start is not None and end is not None and start > end:
+        return {"cmd": "error", "val": "from must not be after to"}
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+        return {"cmd": "error", "val": "limit must be a positive integer"}
+
+    messages, more = channels.get_messages_in_range(channel_name, start, end, limit)
+    return {"cmd": "messages_range", "channel": channel_name, "messages": messages, "more": more}
+
+@command("messages_search", batchable=True)
+def messages_search(ctx):
+    query = ctx.message.get("query")
+    channel_name = ctx.message.get("channel")
+    user = ctx.message.get("user")
+    limit = ctx.message.get("limit", 20)
+
+    if not isinstance(query, str) or not search.tokenize(query):
+        return {"cmd": "error", "val": "Search query cannot be empty"}
+    if user is not None and not isinstance(user, str):
+        return {"cmd": "error", "val": "Invalid user"}
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+        return {"cmd": "error", "val": "limit must be a positive integer"}
+
+    # Only text channels the user can view are searched
+    visible = {channel.get("name"): channel for channel in ctx.visible_channels}
+    if channel_name is not None:
+        if channel_name not in visible:
+            return {"cmd": "error", "val": "Access denied to this channel"}
+        visible = {channel_name: visible[channel_name]}
+    searched = [name for name, channel in visible.items() if channel.get("type", "text") == "text"]
+
+    hits, indexing = search.search(searched, query, user, min(limit, 100))
+    results = []
+    for timestamp, hit_channel, message_id, _ in hits:
+        message = channels.get_channel_message_at(hit_channel, message_id, timestamp)
+        if message is not None:
+            results.append({"channel": hit_channel, "message": message})
+    return {"cmd": "messages_search", "query": query, "results": results, "indexing": indexing}
+
+@command("messages_by_user", roles=("owner", "admin"), batchable=True)
+def messages_by_user(ctx):
+    user = ctx.message.get("user")
+    channel_name = ctx.message.get("channel")
+    limit = ctx.message.get("limit", 100)
+
+    if not isinstance(user, str) or not user:
+        return {"cmd": "error", "val": "User parameter is required"}
+    if channel_name is not None and not channels.get_channel(channel_name):
+        return {"cmd": "error", "val": "Channel not found"}
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+        return {"cmd": "error", "val": "limit must be a positive integer"}
+
+    refs = user_index.get_user_messages(user, channel_name)
+    if refs is None:
+        return {"cmd": "error", "val": "The message index is still being built, try again shortly"}
+    results = []
+    # The most recent messages, oldest first
+    for ref_channel, message_id, timestamp in refs[-min(limit, 500):]:
+        message = channels.get_channel_message_at(ref_channel, message_id, timestamp)
+        if message is not None:
+            results.append({"channel": ref_channel, "message": message})
+    return {"cmd": "messages_by_user", "user": user.lower(), "results": results, "total": len(refs)}
+
+@command("messages_since", channel_permission="view", batchable=True)
+def messages_since(ctx):
+    channel_name = ctx.message.get("channel")
+    rev = ctx.message.get("rev")
+    since = ctx.message.get("since")
+
+    if not channel_name:
+        return {"cmd": "error", "val": "Invalid channel name"}
+    if rev is not None:
+        if not isinstance(rev, int) or isinstance(rev, bool) or rev < 0:
+            return {"cmd": "error", "val": "rev must be a non-negative integer"}
+    elif not isinstance(since, (int, float)) or isinstance(since, bool):
+        return {"cmd": "error", "val": "Either rev or since (a unix timestamp) is required"}
+
+    delta = channels.get_messages_since(channel_name, rev=rev, timestamp=since)
+    if delta is None:
+        # The change log does not go back that far, the client has to fetch the channel again
+        return {"cmd": "messages_since", "channel": channel_name, "resync": True, "rev": channels.get_channel_rev(channel_name)}
+    return {"cmd": "messages_since", "channel": channel_name, "resync": False, **delta}
+
+@command("message_get", channel_permission="view", batchable=True)
+def message_get(ctx):
+    channel_name = ctx.message.get("channel")
+    message_id = ctx.message.get("id")
+
+    if not channel_name or not message_id:
+        return {"cmd": "error", "val": "Channel name and message ID are required"}
+
+    # Get the specific message
+    msg = channels.get_channel_message(channel_name, message_id)
+    if not msg:
+        return {"cmd": "error", "val": "Message not found"}
+
+    return {"cmd": "message_get", "channel": channel_name, "message": msg}
+
+@command("message_replies", channel_permission="view", batchable=True)
+def message_replies(ctx):
+    channel_name = ctx.message.get("channel")
+    message_id = ctx.message.get("id")
+    limit = ctx.message.get("limit", 50)
+
+    if not channel_name or not message_id:
+        return {"cmd": "error", "val": "Channel name and message ID are required"}
+
+    # Get replies to the message
+    replies = channels.get_message_replies(channel_name, message_id, limit)
+    return {"cmd": "message_replies", "channel": channel_name, "message_id": message_id, "replies": replies}
+
+@command("channels_get", batchable=True)
+def channels_get(ctx):
+    return {"cmd": "channels_get", "val": ctx.visible_channels}
+
+@command("users_list", batchable=True)
+def users_list(ctx):
+    return {"cmd": "users_list", "users": users.get_users()}
+
+@command("users_online", batchable=True)
+def users_online(ctx):
+    server_data = ctx.server_data
+    if not server_data or "connected_clients" not in server_data:
+        return {"cmd": "error", "val": "Server data not available"}
+
+    presence = server_data.get("presence")
+    if presence is not None:
+        return presence.users_online()
+
+    # Without a presence index, look every online user up
+    online_users = {}
+    for client_ws in server_data["connected_clients"]:
+        if getattr(client_ws, "authenticated", False) and client_ws.username not in online_users:
+            user_data = users.get_user(client_ws.username)
+            if not user_data:
+                continue
+            user_roles = user_data.get("roles", [])
+            online_users[client_ws.username] = {
+                "username": client_ws.username,
+                "roles": user_roles,
+                "color": role_color(user_roles)
+            }
+
+    return {"cmd": "users_online", "users": list(online_users.values())}
+
+@command("plugins_list", owner=True, batchable=True)
+def plugins_list(ctx):
+    if not ctx.server_data or "plugin_manager" not in ctx.server_data:
+        return {"cmd": "error", "val": "Plugin manager not available"}
+
+    plugin_manager = ctx.server_data["plugin_manager"]
+    return {
+        "cmd": "plugins_list",
+        "plugins": plugin_manager.get_loaded_plugins(),
+        "stats": plugin_manager.get_plugin_stats()
+    }
+
+@command("metrics_get", owner=True, batchable=True)
+def metrics_get(ctx):
+    return {"cmd": "metrics_get", "metrics": metrics.snapshot()}
+
+@command("plugins_reload", owner=True)
+def plugins_reload(ctx):
+    if not ctx.server_data or "plugin_manager" not in ctx.server_data:
+        return {"cmd": "error", "val": "Plugin manager not available"}
+
+    plugin_name = ctx.message.get("plugin")
+    if plugin_name:
+        # Reload specific plugin
+        success = ctx.server_data["plugin_manager"].reload_plugin(plugin_name)
+        if success:
+            return {"cmd": "plugins_reload", "val": f"Plugin '{plugin_name}' reloaded successfully"}
+        else:
+            return {"cmd": "error", "val": f"Failed to reload plugin '{plugin_name}'"}
+    else:
+        # Reload all plugins
+        ctx.server_data["plugin_manager"].reload_all_plugins()
+        return {"cmd": "plugins_reload", "val": "All plugins reloaded successfully"}
+
+@command("rate_limit_status", batchable=True)
+def rate_limit_status(ctx):
+    username = ctx.username
+    target_user = ctx.message.get("user", username)  # Default to self
+
+    # Allow users to check their own status, or admins to check anyone's
+    if target_user != username and "owner" not in ctx.roles:
+        return {"cmd": "error", "val": "Access denied: can only check your own rate limit status"}
+
+    if not ctx.server_data or not ctx.server_data.get("rate_limiter"):
+        return {"cmd": "error", "val": "Rate limiter not available or disabled"}
+
+    status = ctx.server_data["rate_limiter"].get_user_status(target_user)
+    return {"cmd": "rate_limit_status", "user": target_user, "status": status}
+
+@command("rate_limit_reset", owner=True)
+def rate_limit_reset(ctx):
+    target_user = ctx.message.get("user")
+    if not target_user:
+        return {"cmd": "error", "val": "User parameter is required"}
+
+    if not ctx.server_data or not ctx.server_data.get("rate_limiter"):
+        return {"cmd": "error", "val": "Rate limiter not available or disabled"}
+
+    ctx.server_data["rate_limiter"].reset_user(target_user)
+    return {"cmd": "rate_limit_reset", "user": target_user, "val": f"Rate limit reset for user {target_user}"}
+
+@command("batch")
+def batch(ctx):
+    cmds = ctx.message.get("cmds")
+    if not isinstance(cmds, list) or not cmds:
+        return {"cmd": "error", "val": "Batch requires a non-empty cmds array"}
+
+    max_batch = (ctx.server_data or {}).get("config", {}).get("limits", {}).get("batch_commands", 50)
+    if len(cmds) > max_batch:
+        return {"cmd": "error", "val": f"Batch too large. Maximum is {max_batch} commands"}
+
+    # Run every sub-command against the same lookup cache
+    responses = []
+    for sub_message in cmds:
+        sub_command = registry.commands.get(sub_message.get("cmd")) if isinstance(sub_message, dict) else None
+        if sub_command and not sub_command.batchable:
+            responses.append({"cmd": "error", "val": f"Command cannot be batched: {sub_command.name}"})
+            continue
+        response = registry.dispatch(ctx.ws, sub_message, ctx.server_data, ctx.cache)
+        responses.append(response.message if isinstance(response, SharedFrame) else response)
+
+    return {"cmd": "batch", "responses": responses}
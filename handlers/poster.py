@@ -0,0 +1,112 @@
+import asyncio
+import concurrent.futures
+import time
+import uuid
+from db import channels
+from handlers.websocket_utils import publish_to_channel
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from logger import Logger
+
+class MessagePoster:
+    """
+    Server-side API for plugins to post messages into channels.
+
+    Messages posted during the same loop iteration are coalesced: each channel
+    gets one file write for the whole batch, then every message is fanned out
+    with publish_to_channel like a regular message_new, so only clients that
+    can view the channel receive it.
+
+    post() returns an asyncio.Future when called on the server loop and a
+    concurrent.futures.Future when called from another thread, such as a sync
+    plugin handler on the plugin thread pool. Either resolves to the saved message.
+    """
+
+    def __init__(self, server_data):
+        self.server_data = server_data
+        self._pending = {}
+        self._flush_scheduled = False
+
+    @property
+    def loop(self):
+        return self.server_data.get("main_loop")
+
+    def post(self, channel, content, user="OriginChats", reply_to=None):
+        """Queue a message for the channel, returns a future resolving to the saved message"""
+        message = {
+            "user": user,
+            "content": content.strip(),
+            "timestamp": time.time(),
+            "type": "message",
+            "pinned": False,
+            "id": str(uuid.uuid4())
+        }
+        if reply_to:
+            message["reply_to"] = reply_to
+
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+
+        if on_loop:
+            future = self.loop.create_future()
+            self._enqueue(channel, message, future)
+            return future
+
+        future = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self._enqueue, channel, message, future)
+        return future
+
+    def _enqueue(self, channel, message, future):
+        self._pending.setdefault(channel, []).append((message, future))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self._start_flush)
+
+    def _start_flush(self):
+        batch = self._pending
+        self._pending = {}
+        self._flush_scheduled = False
+        self.loop.create_task(self._flush(batch))
+
+    async def _flush(self, batch):
+        try:
+            for channel, items in batch.items():
+                try:
+                    rev = channels.save_channel_messages(channel, [message for message, _ in items])
+                except Exception as e:
+                    Logger.error(f"Error saving posted messages to #{channel}: {str(e)}")
+                    for _, future in items:
+                        self._settle(future, error=e)
+                    continue
+
+                # Each message of the batch was logged as one revision, the last one at rev
+                for i, (message, future) in enumerate(items):
+                    # The message is saved whatever happens to the broadcast
+                    try:
+                        await publish_to_channel(self.server_data, {
+                            "cmd": "message_new",
+                            "message": message,
+                            "channel": channel,
+                            "rev": rev - len(items) + 1 + i,
+                            "global": True
+                        }, channel)
+                    except Exception as e:
+                        Logger.error(f"Error broadcasting posted message to #{channel}: {str(e)}")
+                    self._settle(future, result=message)
+        finally:
+            # Never leave a poster waiting, even if the flush itself was cancelled
+            for items in batch.values():
+                for message, future in items:
+                    self._settle(future, error=RuntimeError("Message posting was interrupted"))
+
+    @staticmethod
+    def _settle(future, result=None, error=None):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
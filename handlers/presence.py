@@ -0,0 +1,196 @@
+import asyncio
+from db import users, roles
+from handlers.codecs import SharedFrame
+from handlers.websocket_utils import broadcast_to_all
+
+def role_color(user_roles, role_cache=None):
+    """Color of the user's first role, if it has one"""
+    if not user_roles:
+        return None
+    first_role_name = user_roles[0]
+    if role_cache is not None and first_role_name in role_cache:
+        return role_cache[first_role_name]
+    first_role_data = roles.get_role(first_role_name)
+    color = first_role_data.get("color") if first_role_data else None
+    if role_cache is not None:
+        role_cache[first_role_name] = color
+    return color
+
+class PresenceIndex:
+    """
+    Who is online, kept up to date as sockets authenticate and disconnect.
+
+    Each online user has a connection count, so a user with several tabs stays
+    online until their last socket closes. Roles and color are looked up once,
+    when the first socket connects, and again when users.json or roles.json
+    change. The users_online response is built and encoded only after the
+    index changes, not on every request.
+
+    Users coming online or going offline are announced to everyone in one
+    presence_update per tick. A user only comes online with their first socket
+    and goes offline with their last, and a change that is undone within the
+    same tick, like a quick reconnect, is never announced.
+
+    With several nodes linked by a broker (see broker.py) each node counts its
+    own sockets and tells the others when a user comes online or goes offline
+    locally, so every node knows who is online on any of them.
+    """
+
+    def __init__(self, connected_clients=None, tick: float = 0.25, broker=None):
+        # username -> {"count": local sockets, "nodes": other nodes the user is on, "roles", "color"}
+        self.entries = {}
+        self._frame = None
+        self.connected_clients = connected_clients
+        self.tick = tick
+        self.broker = broker
+        # username -> "connect" or "disconnect", not yet announced
+        self._pending = {}
+        self._flush_handle = None
+
+    def connect(self, ws, user_data=None):
+        """Record a newly authenticated socket, returns True if the user just came online"""
+        if getattr(ws, "presence_counted", False):
+            return False
+        ws.presence_counted = True
+        username = ws.username
+        entry = self.entries.get(username)
+        if entry is None:
+            if user_data is None:
+                user_data = users.get_user(username) or {}
+            user_roles = user_data.get("roles", [])
+            entry = self._come_online(username, user_roles, role_color(user_roles))
+            came_online = True
+        else:
+            came_online = False
+
+        entry["count"] += 1
+        if entry["count"] == 1 and self.broker is not None:
+            self.broker.publish("presence", {"op": "online", "user": self.user(username)})
+        return came_online
+
+    def disconnect(self, ws):
+        """Record a closed socket, returns True if the user went offline"""
+        if not getattr(ws, "presence_counted", False):
+            return False
+        ws.presence_counted = False
+        username = ws.username
+        entry = self.entries.get(username)
+        if entry is None:
+            return False
+        entry["count"] -= 1
+        if entry["count"] > 0:
+            return False
+        if self.broker is not None:
+            self.broker.publish("presence", {"op": "offline", "username": username})
+        return self._maybe_go_offline(username)
+
+    def _come_online(self, username, user_roles, color):
+        entry = self.entries[username] = {"count": 0, "nodes": set(), "roles": user_roles, "color": color}
+        self._frame = None
+        self._queue_change(username, "connect")
+        return entry
+
+    def _maybe_go_offline(self, username):
+        entry = self.entries[username]
+        if entry["count"] > 0 or entry["nodes"]:
+            return False
+        del self.entries[username]
+        self._frame = None
+        self._queue_change(username, "disconnect")
+        return True
+
+    def apply_remote(self, data, node):
+        """Apply a presence change published by another node"""
+        if data["op"] == "state":
+            # Full list of the node's users, sent when a node joins the broker
+            listed = {user["username"] for user in data["users"]}
+            for username in [name for name, entry in self.entries.items() if node in entry["nodes"] and name not in listed]:
+                self.entries[username]["nodes"].discard(node)
+                self._maybe_go_offline(username)
+            for user in data["users"]:
+                self._remote_online(user, node)
+        elif data["op"] == "online":
+            self._remote_online(data["user"], node)
+        elif data["op"] == "offline":
+            entry = self.entries.get(data["username"])
+            if entry is not None:
+                entry["nodes"].discard(node)
+                self._maybe_go_offline(data["username"])
+
+    def _remote_online(self, user, node):
+        entry = self.entries.get(user["username"])
+        if entry is None:
+            entry = self._come_online(user["username"], user.get("roles", []), user.get("color"))
+        entry["nodes"].add(node)
+
+    def drop_node(self, node):
+        """Forget the users of a node that went away"""
+        for username in [name for name, entry in self.entries.items() if node in entry["nodes"]]:
+            self.entries[username]["nodes"].discard(node)
+            self._maybe_go_offline(username)
+
+    def publish_state(self):
+        """Send the users connected to this node to the other nodes"""
+        if self.broker is not None:
+            self.broker.publish("presence", {
+                "op": "state",
+                "users": [self.user(username) for username, entry in self.entries.items() if entry["count"] > 0]
+            })
+
+    def _queue_change(self, username, change):
+        if self.connected_clients is None:
+            return
+        if username in self._pending:
+            # Going back to the state clients last saw, nothing to announce
+            del self._pending[username]
+        else:
+            self._pending[username] = change
+        if self._pending and self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.tick, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        if self._pending:
+            asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        """Broadcast the presence changes collected since the last flush"""
+        pending, self._pending = self._pending, {}
+        connected = [self.user(username) for username, change in pending.items() if change == "connect"]
+        disconnected = [username for username, change in pending.items() if change == "disconnect"]
+        if not connected and not disconnected:
+            return
+        await broadcast_to_all(self.connected_clients, {
+            "cmd": "presence_update",
+            "connected": [user for user in connected if user is not None],
+            "disconnected": disconnected
+        })
+
+    def is_online(self, username):
+        return username in self.entries
+
+    def user(self, username):
+        """Public presence info for an online user, as sent in presence_update"""
+        entry = self.entries.get(username)
+        if entry is None:
+            return None
+        return {"username": username, "roles": entry["roles"], "color": entry["color"]}
+
+    def refresh(self, users_data=None):
+        """Reload roles and colors of online users, after users.json or roles.json changed"""
+        role_cache = {}
+        for username, entry in self.entries.items():
+            user_data = users_data.get(username) if users_data is not None else users.get_user(username)
+            user_roles = (user_data or {}).get("roles", [])
+            entry["roles"] = user_roles
+            entry["color"] = role_color(user_roles, role_cache)
+        self._frame = None
+
+    def users_online(self):
+        """The users_online response, shared until the index changes"""
+        if self._frame is None:
+            self._frame = SharedFrame({
+                "cmd": "users_online",
+                "users": [self.user(username) for username in self.entries]
+            })
+        return self._frame
@@ -0,0 +1,245 @@
+from db import channels, users
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from logger import Logger
+
+class CommandContext:
+    """
+    Per-request state shared by the middleware chain and the command handler.
+
+    User, role and channel lookups are cached for the lifetime of the request, so
+    each of them costs at most one disk read no matter how many checks use it.
+    """
+
+    def __init__(self, ws, message, server_data=None, cache=None):
+        self.ws = ws
+        self.message = message
+        self.server_data = server_data
+        self.username = getattr(ws, 'username', None)
+        # Lookup cache, shared between the sub-commands of a batch
+        self.cache = cache if cache is not None else {}
+
+    def _cached(self, key, loader):
+        if key not in self.cache:
+            self.cache[key] = loader()
+        return self.cache[key]
+
+    @property
+    def user(self):
+        """The user record of the requesting client, or None"""
+        if not self.username:
+            return None
+        return self._cached(("user", self.username), lambda: users.get_user(self.username))
+
+    @property
+    def roles(self):
+        """The roles of the requesting client"""
+        user_data = self.user
+        return user_data.get("roles", []) if user_data else []
+
+    @property
+    def channels(self):
+        """The full channel list from the channels index"""
+        return self._cached("channels", channels.get_channels)
+
+    @property
+    def visible_channels(self):
+        """The channels the requesting client is allowed to view"""
+        return self._cached(("visible_channels", tuple(self.roles)),
+                            lambda: channels.filter_channels_for_roles(self.channels, self.roles))
+
+    def get_channel(self, channel_name):
+        """Get a channel by name from the cached channel list"""
+        for channel in self.channels:
+            if channel.get("name") == channel_name:
+                return channel
+        return None
+
+    def has_channel_permission(self, channel_name, permission_type):
+        """Check a channel permission against the cached channel list"""
+        channel = self.get_channel(channel_name)
+        if not channel:
+            return False
+        allowed_roles = channel.get("permissions", {}).get(permission_type, [])
+        return any(role in allowed_roles for role in self.roles)
+
+    def can_view_text_channel(self, channel_name):
+        """Check if the client can read messages from a text channel"""
+        return any(c.get("name") == channel_name and c.get("type") == "text" for c in self.visible_channels)
+
+    def can_act_on_own(self, channel_name, permission_type):
+        """
+        Check an `*_own` permission (e.g. "edit_own", "delete_own").
+        Channels that do not specify the permission allow it for all roles.
+        """
+        channel = self.get_channel(channel_name)
+        if not channel:
+            return True
+        permissions = channel.get("permissions", {})
+        if permission_type not in permissions:
+            return True
+        return any(role in permissions[permission_type] for role in self.roles)
+
+class Command:
+    """A registered command handler and the requirements it declares"""
+
+    def __init__(self, name, func, auth=True, owner=False, roles=None, rate_limited=False,
+                 channel_permission=None, batchable=False, validate=None, plugin=None):
+        self.name = name
+        self.func = func
+        self.auth = auth
+        self.owner = owner
+        # Any one of these roles is required, e.g. ("owner", "admin")
+        self.roles = tuple(roles) if roles else ()
+        self.rate_limited = rate_limited
+        # Called with the context before rate limiting, returns an error response or None
+        self.validate = validate
+        self.channel_permission = channel_permission
+        # Only read-only commands whose response goes back to the caller may be batched
+        self.batchable = batchable
+        self.plugin = plugin
+
+def require_auth(ctx, command):
+    """Reject unauthenticated clients for commands that need a user"""
+    if not command.auth:
+        return None
+    if not ctx.username:
+        return {"cmd": "error", "val": "User not authenticated"}
+    if not ctx.user:
+        return {"cmd": "error", "val": "User not found"}
+    return None
+
+def require_owner(ctx, command):
+    """Reject clients without the owner role for owner-only commands"""
+    if command.owner and "owner" not in ctx.roles:
+        return {"cmd": "error", "val": "Access denied: owner role required"}
+    return None
+
+def require_roles(ctx, command):
+    """Reject clients that have none of the roles a command declares"""
+    if command.roles and not any(role in command.roles for role in ctx.roles):
+        return {"cmd": "error", "val": f"Access denied: {' or '.join(command.roles)} role required"}
+    return None
+
+def validate_request(ctx, command):
+    """Run the command's own request validation, so malformed requests do not use up rate limit slots"""
+    if not command.validate:
+        return None
+    return command.validate(ctx)
+
+def apply_rate_limit(ctx, command):
+    """Consume one rate limit slot for rate limited commands"""
+    if not command.rate_limited or not ctx.server_data:
+        return None
+    rate_limiter = ctx.server_data.get("rate_limiter")
+    if not rate_limiter:
+        return None
+    is_allowed, reason, wait_time = rate_limiter.is_allowed(ctx.username)
+    if not is_allowed:
+        # Convert wait time to milliseconds and send rate_limit packet
+        return {"cmd": "rate_limit", "length": int(wait_time * 1000)}
+    return None
+
+_PERMISSION_ERRORS = {
+    "view": "Access denied to this channel",
+    "send": "You do not have permission to send messages in this channel"
+}
+
+def check_channel_permission(ctx, command):
+    """
+    Check the channel permission a command declares against the `channel` field.
+    Requests without a channel are left to the handler's own validation.
+    """
+    permission = command.channel_permission
+    channel_name = ctx.message.get("channel")
+    if not permission or not channel_name:
+        return None
+    if not ctx.roles:
+        return {"cmd": "error", "val": "User roles not found"}
+    if permission == "view":
+        allowed = ctx.can_view_text_channel(channel_name)
+    else:
+        allowed = ctx.has_channel_permission(channel_name, permission)
+    if not allowed:
+        return {"cmd": "error", "val": _PERMISSION_ERRORS.get(permission, "Access denied to this channel")}
+    return None
+
+DEFAULT_MIDDLEWARE = [require_auth, require_owner, require_roles, validate_request, apply_rate_limit, check_channel_permission]
+
+class PluginCommands:
+    """Registration handle given to a plugin, tagging its commands with the plugin name"""
+
+    def __init__(self, registry, plugin_name):
+        self.registry = registry
+        self.plugin_name = plugin_name
+
+    def register(self, name, func, **requirements):
+        return self.registry.register(name, func, plugin=self.plugin_name, **requirements)
+
+    def command(self, name, **requirements):
+        def decorator(func):
+            self.register(name, func, **requirements)
+            return func
+        return decorator
+
+class CommandRegistry:
+    """Maps command names to handlers and runs them through the middleware chain"""
+
+    def __init__(self, middleware=None):
+        self.commands = {}
+        self.middleware = list(middleware if middleware is not None else DEFAULT_MIDDLEWARE)
+
+    def register(self, name, func, plugin=None, **requirements):
+        """
+        Register a command handler.
+
+        Args:
+            name (str): The `cmd` value the handler answers to.
+            func (callable): Called with a CommandContext, returns the response dict.
+            plugin (str): Name of the plugin registering the command, if any.
+            **requirements: auth, owner, roles, rate_limited, channel_permission, batchable, validate.
+
+        Returns:
+            bool: True if registered, False if the name is taken by another owner.
+        """
+        existing = self.commands.get(name)
+        if existing and existing.plugin != plugin:
+            Logger.warning(f"Command '{name}' is already registered, ignoring registration from {plugin or 'core'}")
+            return False
+        self.commands[name] = Command(name, func, plugin=plugin, **requirements)
+        if plugin:
+            Logger.add(f"Registered command '{name}' from plugin '{plugin}'")
+        return True
+
+    def command(self, name, **requirements):
+        """Decorator form of register() for core commands"""
+        def decorator(func):
+            self.register(name, func, **requirements)
+            return func
+        return decorator
+
+    def for_plugin(self, plugin_name):
+        """Get a registration handle that tags commands with the plugin name"""
+        return PluginCommands(self, plugin_name)
+
+    def unregister_plugin(self, plugin_name):
+        """Remove every command registered by a plugin"""
+        for name in [n for n, c in self.commands.items() if c.plugin == plugin_name]:
+            del self.commands[name]
+
+    def dispatch(self, ws, message, server_data=None, cache=None):
+        """Resolve, check and run a single command"""
+        if not isinstance(message, dict):
+            return {"cmd": "error", "val": f"Invalid message format: expected a dictionary, got {type(message).__name__}"}
+
+        command = self.commands.get(message.get("cmd"))
+        if not command:
+            return {"cmd": "error", "val": f"Unknown command: {message.get('cmd')}"}
+
+        ctx = CommandContext(ws, message, server_data, cache)
+        for middleware in self.middleware:
+            error = middleware(ctx, command)
+            if error:
+                return error
+        return command.func(ctx)
@@ -0,0 +1,128 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from handlers.websocket_utils import send_to_client
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json_codec
+from logger import Logger
+
+_KEY_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "db", ".resume_key")
+
+def load_key(path: str = _KEY_PATH) -> bytes:
+    """
+    Get the key resume tokens are signed with, creating it on first use.
+
+    The key lives in the db directory, so every worker and every host sharing
+    that directory signs and checks tokens with the same key.
+    """
+    try:
+        with open(path, 'rb') as f:
+            key = f.read()
+        if key:
+            return key
+    except FileNotFoundError:
+        pass
+
+    # Written aside and linked into place, so a node racing to create it reads a whole key
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(secrets.token_bytes(32))
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+class SessionStore:
+    """
+    Resume tokens handed out with `ready`, so a client that reconnects can skip
+    authenticating with Rotur again.
+
+    A token is the username, an expiry time and a nonce, signed with an HMAC.
+    Nothing is stored per token, so any node with the same key can check it,
+    whichever worker or host issued it. A token is valid for 1.5 * `ttl`
+    seconds, and open connections get a fresh one in a `session` packet every
+    `ttl` / 2 seconds, so the last token a client received stays valid for at
+    least `ttl` seconds after its connection closes. A node accepts each token
+    once.
+    """
+
+    def __init__(self, key: bytes, ttl: float = 300, send_timeout: float = 10):
+        self.key = key
+        self.ttl = ttl
+        self.send_timeout = send_timeout
+        # nonce -> expiry of the tokens this node has redeemed
+        self.redeemed = {}
+        self._last_prune = time.time()
+        self._task = None
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self.key, payload.encode("ascii"), hashlib.sha256).digest())
+
+    def issue(self, username):
+        expiry = int(time.time() + self.ttl * 1.5)
+        payload = _b64encode(json_codec.dumps_bytes([username, expiry, secrets.token_urlsafe(12)]))
+        return f"{payload}.{self._sign(payload)}"
+
+    def redeem(self, token):
+        """Use up a token, returns its username or None if it is forged, expired or already used"""
+        if not isinstance(token, str) or token.count(".") != 1:
+            return None
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            username, expiry, nonce = json_codec.loads(_b64decode(payload))
+        except (ValueError, TypeError):
+            return None
+
+        now = time.time()
+        self._prune(now)
+        if expiry < now or nonce in self.redeemed:
+            return None
+        self.redeemed[nonce] = expiry
+        return username
+
+    def _prune(self, now):
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for nonce in [nonce for nonce, expiry in self.redeemed.items() if expiry < now]:
+            del self.redeemed[nonce]
+
+    def start(self, connected_clients):
+        """Start renewing the tokens of open connections"""
+        self._task = asyncio.get_running_loop().create_task(self._run(connected_clients))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self, connected_clients):
+        while True:
+            await asyncio.sleep(self.ttl / 2)
+            renewals = [self._renew(ws) for ws in list(connected_clients) if getattr(ws, "session", None)]
+            # Sent concurrently and each under a timeout, so a client that stops reading holds up nobody
+            await asyncio.gather(*renewals, return_exceptions=True)
+
+    async def _renew(self, ws):
+        ws.session = self.issue(ws.username)
+        try:
+            await asyncio.wait_for(send_to_client(ws, {"cmd": "session", "session": ws.session}), self.send_timeout)
+        except asyncio.TimeoutError:
+            Logger.warning(f"Timed out sending a renewed session token to {ws.username}")
@@ -0,0 +1,92 @@
+import asyncio
+import time
+from db import channels
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from logger import Logger
+from metrics import metrics
+
+class RetentionEnforcer:
+    """
+    Applies the `retention` policies of channels.json in the background.
+
+    Every `interval` seconds each channel with a policy is trimmed towards it
+    with channels.enforce_retention, one bounded step at a time: a whole
+    expired segment, or at most `step_messages` messages. Steps run in a
+    worker thread and are planned without locking; the channel's lock is only
+    held while a step removes its messages and is released between steps, so
+    message writes never wait long and trimming a large backlog never stalls
+    clients. What was removed is logged and reported under `retention` by
+    metrics_get.
+    """
+
+    def __init__(self, interval: float = 300, step_messages: int = 50):
+        self.interval = interval
+        self.step_messages = step_messages
+        self.stats = {
+            "runs": 0,
+            "last_run": None,
+            "removed": 0,
+            # channel name -> {"removed", "last_removed", "removed_until"}
+            "channels": {}
+        }
+        self._task = None
+        metrics.register_source("retention", self.snapshot)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                Logger.error(f"Retention error: {str(e)}")
+
+    async def run_once(self):
+        """Trim every channel with a retention policy, returns {channel name: messages removed}"""
+        loop = asyncio.get_running_loop()
+        report = {}
+        for channel in channels.get_channels():
+            retention = channel.get("retention")
+            channel_name = channel.get("name")
+            if not retention or not channel_name:
+                continue
+            removed = 0
+            newest_removed = None
+            while True:
+                step = await loop.run_in_executor(None, channels.enforce_retention, channel_name, retention, self.step_messages)
+                if step is None:
+                    break
+                removed += len(step)
+                for msg in step:
+                    timestamp = msg.get("timestamp")
+                    if isinstance(timestamp, (int, float)) and (newest_removed is None or timestamp > newest_removed):
+                        newest_removed = timestamp
+            if removed:
+                report[channel_name] = removed
+                self._record(channel_name, removed, newest_removed)
+
+        self.stats["runs"] += 1
+        self.stats["last_run"] = time.time()
+        return report
+
+    def _record(self, channel_name, removed, newest_removed):
+        channel_stats = self.stats["channels"].setdefault(channel_name, {"removed": 0, "last_removed": 0, "removed_until": None})
+        channel_stats["removed"] += removed
+        channel_stats["last_removed"] = removed
+        channel_stats["removed_until"] = newest_removed
+        self.stats["removed"] += removed
+        metrics.increment("retention.removed", removed)
+        until = f", sent up to {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(newest_removed))} UTC" if newest_removed is not None else ""
+        Logger.info(f"Retention removed {removed} messages from #{channel_name}{until}")
+
+    def snapshot(self):
+        return {**self.stats, "channels": {name: dict(stats) for name, stats in self.stats["channels"].items()}}
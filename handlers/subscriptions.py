@@ -0,0 +1,82 @@
+from db import channels
+from handlers.websocket_utils import broadcast_to_sockets
+
+class ChannelSubscriptions:
+    """
+    The local sockets subscribed to each channel, meaning the authenticated
+    sockets whose user can view it.
+
+    Channel broadcasts are delivered straight to these sockets, without
+    looking up users and permissions for every client on every message. The
+    index is built when a socket authenticates and rebuilt when users.json or
+    channels.json change.
+
+    With a broker, the node subscribes to a channel's broker topic while it
+    has local subscribers for it, so frames for a channel only reach the
+    nodes that have someone to deliver them to.
+    """
+
+    def __init__(self, connected_clients, broker=None):
+        self.connected_clients = connected_clients
+        self.broker = broker
+        # channel name -> set of local sockets
+        self.sockets = {}
+
+    @staticmethod
+    def topic(channel_name):
+        return f"channel:{channel_name}"
+
+    def add(self, ws, user_roles, all_channels=None):
+        """Subscribe an authenticated socket to the channels its roles can view"""
+        if all_channels is None:
+            visible = channels.get_all_channels_for_roles(user_roles)
+        else:
+            visible = channels.filter_channels_for_roles(all_channels, user_roles)
+        names = {channel.get("name") for channel in visible}
+        previous = getattr(ws, "subscribed_channels", set())
+        for channel_name in previous - names:
+            self._leave(channel_name, ws)
+        for channel_name in names - previous:
+            self._join(channel_name, ws)
+        ws.subscribed_channels = names
+
+    def remove(self, ws):
+        for channel_name in getattr(ws, "subscribed_channels", ()):
+            self._leave(channel_name, ws)
+        ws.subscribed_channels = set()
+
+    def refresh(self, users_data, all_channels):
+        """Resubscribe every local socket, after users.json or channels.json changed"""
+        for ws in list(self.connected_clients):
+            if not getattr(ws, "authenticated", False):
+                continue
+            user_data = users_data.get(getattr(ws, "username", None))
+            self.add(ws, (user_data or {}).get("roles", []), all_channels)
+
+    def subscribers(self, channel_name):
+        return self.sockets.get(channel_name, set())
+
+    def _join(self, channel_name, ws):
+        sockets = self.sockets.get(channel_name)
+        if sockets is None:
+            sockets = self.sockets[channel_name] = set()
+            if self.broker is not None:
+                self.broker.subscribe(self.topic(channel_name), self._on_remote)
+        sockets.add(ws)
+
+    def _leave(self, channel_name, ws):
+        sockets = self.sockets.get(channel_name)
+        if sockets is None:
+            return
+        sockets.discard(ws)
+        if not sockets:
+            del self.sockets[channel_name]
+            if self.broker is not None:
+                self.broker.unsubscribe(self.topic(channel_name), self._on_remote)
+
+    async def deliver(self, message, channel_name):
+        """Send a channel broadcast to the local subscribers"""
+        return await broadcast_to_sockets(self.connected_clients, self.subscribers(channel_name), message)
+
+    async def _on_remote(self, frame, node):
+        await self.deliver(frame["message"], frame["channel"])
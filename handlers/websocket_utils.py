@@ -1,13 +1,20 @@
-import asyncio, json, websockets
+import websockets
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from logger import Logger
+from handlers.codecs import codec_for, SharedFrame
+from metrics import metrics, SIZE_BUCKETS_BYTES
 
 async def send_to_client(ws, message):
-    """Send a message to a specific client"""
+    """Send a message to a specific client, encoded with the client's codec"""
+    return await send_raw(ws, codec_for(ws).encode(message))
+
+async def send_raw(ws, payload):
+    """Send an already encoded frame to a specific client"""
     try:
-        await ws.send(json.dumps(message))
+        await ws.send(payload, text=not codec_for(ws).binary)
+        metrics.observe("ws.message_bytes", len(payload), buckets=SIZE_BUCKETS_BYTES)
         return True
     except websockets.exceptions.ConnectionClosed:
         Logger.warning("Connection closed when trying to send message")
@@ -16,25 +23,18 @@ async def send_to_client(ws, message):
         Logger.error(f"Error sending message: {str(e)}")
         return False
 
-async def heartbeat(ws, heartbeat_interval=30):
-    """Send periodic pings to keep the connection alive"""
-    try:
-        while True:
-            await asyncio.sleep(heartbeat_interval)
-            if not await send_to_client(ws, {"cmd": "ping"}):
-                break
-    except asyncio.CancelledError:
-        Logger.info("Heartbeat task cancelled")
-    except Exception as e:
-        Logger.error(f"Heartbeat error: {str(e)}")
-
 async def broadcast_to_all(connected_clients, message):
     """Broadcast a message to all connected clients"""
+    return await broadcast_to_sockets(connected_clients, connected_clients, message)
+
+async def broadcast_to_sockets(connected_clients, sockets, message):
+    """Broadcast a message to the given sockets, dropping those found closed from connected_clients"""
     disconnected = set()
-    # Create a copy of the set to avoid "Set changed size during iteration" error
-    clients_copy = connected_clients.copy()
+    frame = SharedFrame(message)
+    # Copy the sockets to avoid "Set changed size during iteration" error
+    clients_copy = list(sockets)
     for ws in clients_copy:
-        success = await send_to_client(ws, message)
+        success = await send_raw(ws, frame.for_client(ws))
         if not success:
             disconnected.add(ws)
     
@@ -53,6 +53,7 @@ async def broadcast_to_channel(connected_clients, message, channel_name):
     
     disconnected = set()
     sent_count = 0
+    frame = SharedFrame(message)
     
     # Create a copy of the set to avoid "Set changed size during iteration" error
     clients_copy = connected_clients.copy()
@@ -75,7 +76,7 @@ async def broadcast_to_channel(connected_clients, message, channel_name):
         
         # Check if user has view permission for this channel
         if channels.does_user_have_permission(channel_name, user_roles, "view"):
-            success = await send_to_client(ws, message)
+            success = await send_raw(ws, frame.for_client(ws))
             if not success:
                 disconnected.add(ws)
             else:
@@ -90,6 +91,30 @@ async def broadcast_to_channel(connected_clients, message, channel_name):
     
     return disconnected
 
+async def publish_to_all(server_data, message):
+    """Broadcast to every client, including those connected to other nodes"""
+    broker = server_data.get("broker")
+    if broker is not None:
+        broker.publish("all", {"message": message})
+    return await broadcast_to_all(server_data["connected_clients"], message)
+
+async def publish_to_channel(server_data, message, channel_name):
+    """Broadcast to everyone who can view the channel, including clients of other nodes"""
+    subscriptions = server_data.get("subscriptions")
+    if subscriptions is None:
+        return await broadcast_to_channel(server_data["connected_clients"], message, channel_name)
+    broker = server_data.get("broker")
+    if broker is not None:
+        broker.publish(subscriptions.topic(channel_name), {"channel": channel_name, "message": message})
+    return await subscriptions.deliver(message, channel_name)
+
+async def publish_disconnect_user(server_data, username, reason="User disconnected"):
+    """Disconnect a user's sockets on every node"""
+    broker = server_data.get("broker")
+    if broker is not None:
+        broker.publish("disconnect_user", {"username": username, "reason": reason})
+    return await disconnect_user(server_data["connected_clients"], username, reason)
+
 async def disconnect_user(connected_clients, username, reason="User disconnected"):
     """Disconnect a specific user by username"""
     disconnected = []
@@ -1,17 +1,42 @@
+import argparse
 import asyncio
+import os
+import json_codec
 from server import OriginChatsServer
 from logger import Logger
 
-async def main():
+async def main(config_path="config.json", worker_id=None, bus_path=None):
     """Main function to start the OriginChats server"""
     Logger.info("Initializing OriginChats server...")
-    server = OriginChatsServer()
+    server = OriginChatsServer(config_path, worker_id=worker_id, bus_path=bus_path)
     Logger.success("Server initialized successfully")
     await server.start_server()
 
+async def supervise(config, config_path, workers):
+    """Run several workers sharing the port, see cluster.py"""
+    from cluster import Supervisor
+    await Supervisor(config, workers, config_path).run()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the OriginChats server")
+    parser.add_argument("--config", default="config.json", help="Path to config.json, relative to this directory")
+    parser.add_argument("--workers", type=int, help="Number of worker processes, overrides cluster.workers")
+    # Set by the supervisor when it starts a worker
+    parser.add_argument("--worker-id", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--bus", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        asyncio.run(main())
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), args.config), "r") as f:
+            config = json_codec.load(f)
+        workers = args.workers if args.workers is not None else config.get("cluster", {}).get("workers", 1)
+
+        if args.worker_id is None and workers > 1:
+            asyncio.run(supervise(config, args.config, workers))
+        else:
+            asyncio.run(main(args.config, args.worker_id, args.bus))
     except KeyboardInterrupt:
         Logger.warning("Server stopped by user")
     except Exception as e:
@@ -0,0 +1,81 @@
+"""
+JSON serialization for the whole server.
+
+Uses orjson when it is installed and the standard library otherwise. Either
+way the output is compact and does not escape non-ASCII characters, like
+json.dumps(obj, separators=(',', ':'), ensure_ascii=False). Anything orjson
+refuses (non-string dict keys, integers over 64 bits, lone surrogates) falls
+back to the standard library instead of failing.
+
+With orjson the output matches the standard library's except for floats:
+- orjson writes exponents without a sign or padding, e.g. 1e16 and 1e-7
+  where the standard library writes 1e+16 and 1e-07. Both parse to the same value.
+- orjson writes NaN and Infinity as null, where the standard library writes
+  the non-standard NaN and Infinity tokens.
+Parsing accepts NaN and Infinity with either backend.
+
+Human-edited files (users.json, roles.json, channels.json) keep their
+four-space indentation through dump_indented, which always uses the standard library.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so one except clause catches both
+JSONDecodeError = json.JSONDecodeError
+
+def _stdlib_dumps(obj, default=None) -> str:
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=default)
+
+if orjson is not None:
+    def dumps_bytes(obj, default=None) -> bytes:
+        """Serialize to compact UTF-8 encoded JSON"""
+        try:
+            return orjson.dumps(obj, default=default)
+        except orjson.JSONEncodeError:
+            return _stdlib_dumps(obj, default).encode("utf-8")
+
+    def dumps(obj, default=None) -> str:
+        """Serialize to a compact JSON string"""
+        try:
+            return orjson.dumps(obj, default=default).decode("utf-8")
+        except orjson.JSONEncodeError:
+            return _stdlib_dumps(obj, default)
+
+    def loads(data):
+        """Parse JSON from str or bytes"""
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN and Infinity, the standard library reads them (and raises for real errors)
+            return json.loads(data)
+else:
+    def dumps_bytes(obj, default=None) -> bytes:
+        """Serialize to compact UTF-8 encoded JSON"""
+        return _stdlib_dumps(obj, default).encode("utf-8")
+
+    def dumps(obj, default=None) -> str:
+        """Serialize to a compact JSON string"""
+        return _stdlib_dumps(obj, default)
+
+    def loads(data):
+        """Parse JSON from str or bytes"""
+        return json.loads(data)
+
+def load(f):
+    """Parse JSON from an open file"""
+    return loads(f.read())
+
+def dump(obj, f):
+    """Write compact JSON to an open text file"""
+    f.write(dumps(obj))
+
+def dump_indented(obj, f):
+    """Write indented JSON for files people edit by hand"""
+    json.dump(obj, f, indent=4)
@@ -0,0 +1,84 @@
+import bisect
+import threading
+from typing import Dict, Any, Callable
+
+# Latency bucket upper bounds in milliseconds, the last bucket catches everything above
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Size bucket upper bounds in bytes, for frame and payload sizes
+SIZE_BUCKETS_BYTES = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072, 262144, 524288, 1048576)
+
+class Histogram:
+    """Fixed-bucket histogram, constant memory no matter how many values are observed"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p: float) -> float:
+        """Upper bound of the bucket containing the p-th percentile (p in 0..1)"""
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": round(self.max, 3)
+        }
+
+class Metrics:
+    """Process-wide counters, histograms and snapshot sources"""
+
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.sources: Dict[str, Callable[[], Any]] = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS_MS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register_source(self, name: str, func: Callable[[], Any]):
+        """Register a callable whose return value is included in snapshots under `name`"""
+        self.sources[name] = func
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            data = {
+                "counters": dict(self.counters),
+                "histograms": {name: h.snapshot() for name, h in self.histograms.items()}
+            }
+        for name, func in self.sources.items():
+            data[name] = func()
+        return data
+
+metrics = Metrics()
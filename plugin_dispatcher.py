@@ -0,0 +1,210 @@
+import asyncio
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, Optional
+from logger import Logger
+from metrics import Histogram
+
+class PluginStats:
+    """Invocation statistics for one plugin's handler of one event"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        # Events dropped because the plugin's queue was full, not counted as calls or errors
+        self.dropped = 0
+        self.last_error = None
+        self.last_error_at = None
+        self.latency = Histogram()
+
+    def record(self, elapsed_ms: Optional[float], error: Optional[str] = None):
+        self.calls += 1
+        if elapsed_ms is not None:
+            self.latency.observe(elapsed_ms)
+        if error is not None:
+            self.errors += 1
+            self.last_error = error
+            self.last_error_at = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "last_error": self.last_error,
+            "last_error_at": self.last_error_at,
+            "latency_ms": self.latency.snapshot()
+        }
+
+class CircuitBreaker:
+    """Counts consecutive failures of a plugin and trips once a threshold is reached"""
+
+    def __init__(self, failure_threshold: int = 5):
+        self.failure_threshold = failure_threshold
+        self.consecutive_failures = 0
+        self.tripped = False
+
+    def record_success(self):
+        self.consecutive_failures = 0
+
+    def record_failure(self) -> bool:
+        """Record a failure, returns True if this failure tripped the breaker"""
+        self.consecutive_failures += 1
+        if not self.tripped and self.consecutive_failures >= self.failure_threshold:
+            self.tripped = True
+            return True
+        return False
+
+class PluginDispatcher:
+    """
+    Runs plugin event handlers off the request path.
+
+    Every plugin gets its own bounded queue drained by `max_concurrency` consumers,
+    so a slow plugin only ever backs up itself. Sync handlers run on a shared thread
+    pool, async handlers on the event loop, both under a per-call timeout. A sync call
+    that times out keeps its thread until it returns, and the plugin's consumers wait
+    for it before taking more events. A plugin that keeps failing or timing out trips
+    its circuit breaker and is disabled.
+    """
+
+    def __init__(self, workers: int = 4, timeout: float = 5.0, max_concurrency: int = 1,
+                 queue_size: int = 256, failure_threshold: int = 5, slow_call_ms: Optional[float] = None,
+                 on_trip: Optional[Callable[[str], None]] = None):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.failure_threshold = failure_threshold
+        self.slow_call_ms = slow_call_ms
+        self.on_trip = on_trip
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plugin")
+        self.loop = None
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._consumers: Dict[str, list] = {}
+        # Sync calls still running on the pool per plugin, including ones that timed out
+        self._running: Dict[str, set] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        # plugin name -> event -> PluginStats, kept across reloads
+        self.stats: Dict[str, Dict[str, PluginStats]] = {}
+
+    def breaker(self, plugin_name: str) -> CircuitBreaker:
+        if plugin_name not in self.breakers:
+            self.breakers[plugin_name] = CircuitBreaker(self.failure_threshold)
+        return self.breakers[plugin_name]
+
+    def submit(self, handler_info: Dict[str, Any], ws, message_data, server_data) -> bool:
+        """
+        Queue a handler call. Must be called from the event loop thread.
+        Returns False if the plugin's queue is full and the event was dropped.
+        """
+        plugin_name = handler_info['plugin_name']
+        queue = self._queues.get(plugin_name)
+        if queue is None:
+            queue = self._start_plugin(plugin_name)
+        try:
+            queue.put_nowait((handler_info, ws, message_data, server_data))
+            return True
+        except asyncio.QueueFull:
+            Logger.warning(f"Plugin '{plugin_name}' queue is full, dropping event")
+            self.stats.setdefault(plugin_name, {}).setdefault(handler_info['event'], PluginStats()).dropped += 1
+            return False
+
+    def _start_plugin(self, plugin_name: str) -> asyncio.Queue:
+        self.loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._queues[plugin_name] = queue
+        self._consumers[plugin_name] = [
+            self.loop.create_task(self._consume(plugin_name, queue))
+            for _ in range(self.max_concurrency)
+        ]
+        return queue
+
+    def stop_plugin(self, plugin_name: str):
+        """Cancel a plugin's consumers and drop its queued events"""
+        for task in self._consumers.pop(plugin_name, []):
+            # A consumer disabling its own plugin exits on its next loop instead
+            if task is not asyncio.current_task():
+                task.cancel()
+        self._queues.pop(plugin_name, None)
+        self.breakers.pop(plugin_name, None)
+
+    async def _consume(self, plugin_name: str, queue: asyncio.Queue):
+        while self._queues.get(plugin_name) is queue:
+            # Events stay queued while earlier calls, including timed out ones, hold every slot
+            await self._wait_for_slot(plugin_name)
+            handler_info, ws, message_data, server_data = await queue.get()
+            if self._queues.get(plugin_name) is not queue:
+                break
+            # Another consumer may have taken the slot while this one waited for the event
+            await self._wait_for_slot(plugin_name)
+            try:
+                await self._run(handler_info, ws, message_data, server_data)
+            finally:
+                queue.task_done()
+
+    async def _run(self, handler_info: Dict[str, Any], ws, message_data, server_data):
+        plugin_name = handler_info['plugin_name']
+        breaker = self.breaker(plugin_name)
+        if breaker.tripped:
+            return
+
+        stats = self.stats.setdefault(plugin_name, {}).setdefault(handler_info['event'], PluginStats())
+        start = time.perf_counter()
+        error = None
+        try:
+            if handler_info['is_async']:
+                await asyncio.wait_for(handler_info['call'](ws, message_data, server_data), self.timeout)
+            else:
+                await self._run_sync(handler_info, ws, message_data, server_data)
+        except asyncio.TimeoutError:
+            error = f"Timed out after {self.timeout}s"
+            Logger.error(f"Plugin '{plugin_name}' handler timed out after {self.timeout}s")
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e)}"
+            Logger.error(f"Error in plugin '{plugin_name}' handler: {str(e)}")
+            traceback.print_exc()
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stats.record(elapsed_ms, error)
+        if self.slow_call_ms and elapsed_ms >= self.slow_call_ms:
+            Logger.warning(f"Slow plugin call: '{plugin_name}' took {elapsed_ms:.1f}ms on '{handler_info['event']}'")
+
+        if error is None:
+            breaker.record_success()
+        else:
+            self._record_failure(plugin_name, breaker)
+
+    def _record_failure(self, plugin_name: str, breaker: CircuitBreaker):
+        if breaker.record_failure():
+            Logger.error(f"Plugin '{plugin_name}' failed {breaker.consecutive_failures} times in a row, disabling it")
+            if self.on_trip:
+                self.on_trip(plugin_name)
+
+    async def _wait_for_slot(self, plugin_name: str):
+        """Wait until the plugin has fewer than max_concurrency sync calls on the thread pool"""
+        running = self._running.get(plugin_name)
+        while running and len(running) >= self.max_concurrency:
+            await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+
+    async def _run_sync(self, handler_info: Dict[str, Any], ws, message_data, server_data):
+        """Run a sync handler on the thread pool, its thread stays counted until it returns"""
+        running = self._running.setdefault(handler_info['plugin_name'], set())
+        future = self.loop.run_in_executor(self.executor, handler_info['call'], ws, message_data, server_data)
+        running.add(future)
+        future.add_done_callback(running.discard)
+        await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    def stats_snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Per-plugin, per-event invocation statistics"""
+        return {
+            plugin_name: {event: stats.snapshot() for event, stats in events.items()}
+            for plugin_name, events in self.stats.items()
+        }
+
+    def shutdown(self):
+        """Stop all consumers and the thread pool"""
+        for plugin_name in list(self._consumers):
+            self.stop_plugin(plugin_name)
+        self.executor.shutdown(wait=False, cancel_futures=True)
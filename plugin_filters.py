@@ -0,0 +1,120 @@
+import re
+from typing import Dict, List, Any, Optional
+
+class EventFilter:
+    """
+    A plugin's declared filter for one event, from the `filters` key of getInfo():
+
+        "filters": {
+            "new_message": {"prefix": "!", "channels": ["general"], "roles": ["owner"]}
+        }
+
+    - prefix: string or list of strings the message content must start with, "" allows any
+    - regex: pattern searched for in the message content
+    - channels: channel names the event must come from
+    - roles: roles of which the acting user must have at least one
+    """
+
+    def __init__(self, prefix=None, regex=None, channels=None, roles=None):
+        if isinstance(prefix, str):
+            prefix = [prefix]
+        # Every content starts with "", so a list holding it filters nothing
+        self.prefixes = tuple(prefix) if prefix and "" not in prefix else ()
+        self.regex = re.compile(regex) if regex else None
+        self.channels = frozenset(channels) if channels else None
+        self.roles = frozenset(roles) if roles else None
+
+    @classmethod
+    def from_info(cls, spec: Optional[Dict[str, Any]], required_roles: Optional[List[str]] = None):
+        """Build a filter from a getInfo() spec, merging the plugin's required_permission roles"""
+        spec = dict(spec or {})
+        if required_roles:
+            spec["roles"] = list(spec.get("roles") or []) + list(required_roles)
+        return cls(
+            prefix=spec.get("prefix"),
+            regex=spec.get("regex"),
+            channels=spec.get("channels"),
+            roles=spec.get("roles")
+        )
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.prefixes or self.regex or self.channels or self.roles)
+
+    def matches(self, message_data: Dict[str, Any], get_roles) -> bool:
+        content = message_data.get("content") or ""
+        if self.prefixes and not content.startswith(self.prefixes):
+            return False
+        if self.regex and not self.regex.search(content):
+            return False
+        if self.channels is not None and message_data.get("channel") not in self.channels:
+            return False
+        if self.roles is not None and not self.roles.intersection(get_roles()):
+            return False
+        return True
+
+class EventIndex:
+    """
+    Handlers for one event, bucketed by their filters so that an event only
+    touches the handlers that could possibly match it:
+
+    - unfiltered handlers always run
+    - prefix filters are bucketed by the first character of each prefix
+    - channel filters without a prefix are bucketed by channel name
+    - anything else (regex or roles only) is checked individually
+    """
+
+    def __init__(self):
+        self.unfiltered = []
+        self.by_prefix_char: Dict[str, list] = {}
+        self.by_channel: Dict[str, list] = {}
+        self.other = []
+        self._count = 0
+
+    def add(self, handler_info: Dict[str, Any], event_filter: EventFilter):
+        # Registration order is kept so handlers run in the order plugins were loaded
+        entry = (self._count, event_filter, handler_info)
+        self._count += 1
+        if event_filter.is_empty:
+            self.unfiltered.append(entry)
+        elif event_filter.prefixes:
+            for first_char in {p[:1] for p in event_filter.prefixes}:
+                self.by_prefix_char.setdefault(first_char, []).append(entry)
+        elif event_filter.channels is not None:
+            for channel in event_filter.channels:
+                self.by_channel.setdefault(channel, []).append(entry)
+        else:
+            self.other.append(entry)
+
+    def __len__(self):
+        return self._count
+
+    def match(self, message_data: Dict[str, Any], get_roles) -> List[Dict[str, Any]]:
+        """Return the handlers whose filters accept the event, in registration order"""
+        if not self.by_prefix_char and not self.by_channel and not self.other:
+            return [handler_info for _, _, handler_info in self.unfiltered]
+
+        content = message_data.get("content") or ""
+        candidates = list(self.unfiltered)
+        candidates += self.by_prefix_char.get(content[:1], ())
+        candidates += self.by_channel.get(message_data.get("channel"), ())
+        candidates += self.other
+        if len(candidates) > len(self.unfiltered):
+            candidates.sort(key=lambda entry: entry[0])
+
+        # Resolve the user's roles at most once, and only if a filter asks for them
+        roles_cache = []
+        def cached_roles():
+            if not roles_cache:
+                roles_cache.append(get_roles())
+            return roles_cache[0]
+
+        matched = []
+        seen = set()
+        for order, event_filter, handler_info in candidates:
+            if order in seen:
+                continue
+            seen.add(order)
+            if event_filter.matches(message_data, cached_roles):
+                matched.append(handler_info)
+        return matched
@@ -1,13 +1,19 @@
 import os
+import asyncio
 import importlib.util
 import inspect
+import traceback
 from typing import Dict, List, Any, Callable, Optional
 from logger import Logger
+from plugin_dispatcher import PluginDispatcher
+from plugin_filters import EventFilter, EventIndex
+from metrics import metrics
+from plugin_sandbox import SandboxedPlugin
 
 class PluginManager:
     """Manages loading and execution of plugins"""
     
-    def __init__(self, plugins_dir="plugins"):
+    def __init__(self, plugins_dir="plugins", config=None):
         # Make plugins_dir relative to this file's location
         if not os.path.isabs(plugins_dir):
             self.plugins_dir = os.path.join(os.path.dirname(__file__), plugins_dir)
@@ -15,6 +21,25 @@ class PluginManager:
             self.plugins_dir = plugins_dir
         self.loaded_plugins = {}
         self.event_handlers = {}
+        # Per-event handler index compiled from the plugins' declared filters
+        self.event_index = {}
+        # Plugins switched off by their circuit breaker
+        self.disabled_plugins = set()
+        
+        self.config = config or {}
+        plugin_config = self.config.get("plugins", {})
+        # Plugins that run in their own worker process instead of in the server
+        self.sandboxed = set(plugin_config.get("sandboxed", []))
+        self.dispatcher = PluginDispatcher(
+            workers=plugin_config.get("workers", 4),
+            timeout=plugin_config.get("timeout_seconds", 5),
+            max_concurrency=plugin_config.get("max_concurrency", 1),
+            queue_size=plugin_config.get("queue_size", 256),
+            failure_threshold=plugin_config.get("failure_threshold", 5),
+            slow_call_ms=plugin_config.get("slow_call_ms"),
+            on_trip=self.disable_plugin
+        )
+        metrics.register_source("plugins", self.get_plugin_stats)
         self.load_plugins()
     
     def load_plugins(self):
@@ -37,6 +62,9 @@ class PluginManager:
     
     def _load_plugin(self, plugin_name: str, plugin_path: str):
         """Load a single plugin"""
+        if plugin_name in self.sandboxed:
+            return self._load_sandboxed_plugin(plugin_name, plugin_path)
+        
         # Load the module
         spec = importlib.util.spec_from_file_location(plugin_name, plugin_path)
         if spec is None or spec.loader is None:
@@ -63,86 +91,174 @@ class PluginManager:
             'path': plugin_path
         }
         
+        # Let the plugin register its own commands
+        if hasattr(module, 'register_commands'):
+            from handlers.message import registry
+            module.register_commands(registry.for_plugin(plugin_name))
+        
         # Register event handlers
+        required_permission = getattr(module, 'required_permission', [])
         for event in plugin_info['handles']:
             handler_name = f"on_{event}"
             if hasattr(module, handler_name):
-                if event not in self.event_handlers:
-                    self.event_handlers[event] = []
-                self.event_handlers[event].append({
-                    'plugin_name': plugin_name,
-                    'handler': getattr(module, handler_name),
-                    'required_permission': getattr(module, 'required_permission', [])
-                })
-                Logger.add(f"Registered handler '{handler_name}' for event '{event}' from plugin '{plugin_name}'")
+                handler = getattr(module, handler_name)
+                self._register_handler(plugin_name, plugin_info, event, handler, self._bind_handler(handler),
+                                       inspect.iscoroutinefunction(handler), required_permission)
             else:
                 Logger.warning(f"Plugin '{plugin_name}' handles '{event}' but missing '{handler_name}' function")
         
+        self._rebuild_index()
+        
         Logger.success(f"Loaded plugin '{plugin_name}': {plugin_info.get('name', 'Unknown')}")
         Logger.info(f"Handles events: {plugin_info['handles']}")
     
+    def _load_sandboxed_plugin(self, plugin_name: str, plugin_path: str):
+        """Load a plugin into its own worker process and register proxies for its handlers"""
+        sandbox = SandboxedPlugin(plugin_name, plugin_path, self.config)
+        plugin_info = sandbox.start()
+        if not isinstance(plugin_info, dict) or 'handles' not in plugin_info:
+            Logger.warning(f"Plugin '{plugin_name}' has invalid getInfo() return value")
+            sandbox.stop()
+            return
+        
+        self.loaded_plugins[plugin_name] = {
+            'module': None,
+            'info': plugin_info,
+            'path': plugin_path,
+            'sandbox': sandbox
+        }
+        
+        for event in plugin_info['handles']:
+            if event in sandbox.events:
+                call = lambda ws, message_data, server_data, event=event: sandbox.call(event, ws, message_data, server_data)
+                self._register_handler(plugin_name, plugin_info, event, None, call, True, sandbox.required_permission)
+            else:
+                Logger.warning(f"Plugin '{plugin_name}' handles '{event}' but missing 'on_{event}' function")
+        
+        self._rebuild_index()
+        
+        Logger.success(f"Loaded sandboxed plugin '{plugin_name}': {plugin_info.get('name', 'Unknown')}")
+        Logger.info(f"Handles events: {plugin_info['handles']}")
+    
+    def _register_handler(self, plugin_name: str, plugin_info: Dict[str, Any], event: str, handler: Optional[Callable],
+                          call: Callable, is_async: bool, required_permission: List[str]):
+        if event not in self.event_handlers:
+            self.event_handlers[event] = []
+        self.event_handlers[event].append({
+            'plugin_name': plugin_name,
+            'event': event,
+            'handler': handler,
+            'call': call,
+            'is_async': is_async,
+            'filter': EventFilter.from_info(plugin_info.get('filters', {}).get(event), required_permission),
+            'required_permission': required_permission
+        })
+        Logger.add(f"Registered handler 'on_{event}' for event '{event}' from plugin '{plugin_name}'")
+    
     def get_loaded_plugins(self) -> Dict[str, Dict[str, Any]]:
         """Get information about all loaded plugins"""
         return {name: plugin['info'] for name, plugin in self.loaded_plugins.items()}
     
+    def get_plugin_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get per-event invocation statistics and state for every loaded plugin"""
+        stats = self.dispatcher.stats_snapshot()
+        return {
+            name: {
+                "disabled": name in self.disabled_plugins,
+                "events": stats.get(name, {})
+            }
+            for name in self.loaded_plugins
+        }
+    
+    @staticmethod
+    def _bind_handler(handler: Callable) -> Callable:
+        """
+        Resolve a handler's calling convention once, at load time.
+        Handlers take either (ws, message_data) or (ws, message_data, server_data);
+        the returned callable always takes all three.
+        """
+        if len(inspect.signature(handler).parameters) == 3:
+            return handler
+        return lambda ws, message_data, server_data: handler(ws, message_data)
+    
+    def _rebuild_index(self):
+        """Compile the registered handlers and their filters into per-event indexes"""
+        event_index = {}
+        for event, handlers in self.event_handlers.items():
+            if not handlers:
+                continue
+            index = EventIndex()
+            for handler_info in handlers:
+                index.add(handler_info, handler_info['filter'])
+            event_index[event] = index
+        self.event_index = event_index
+    
     def trigger_event(self, event: str, ws, message_data: Dict[str, Any], server_data: Optional[Dict[str, Any]] = None):
-        """Trigger an event for all plugins that handle it"""
+        """
+        Trigger an event for all plugins whose filters match it.
+        Handlers are queued on the dispatcher and run after the caller returns.
+        """
+        index = self.event_index.get(event)
+        if not index:
+            return
         
-        if event not in self.event_handlers:
-            Logger.warning(f"No handlers found for event '{event}'")
+        def get_roles():
+            # Events raised for a user carry their roles, fall back to a lookup otherwise
+            if "roles" in message_data:
+                return message_data["roles"] or []
+            from db import users
+            return users.get_user_roles(getattr(ws, 'username', None))
+        
+        handlers = index.match(message_data, get_roles)
+        if not handlers:
             return
         
-        for handler_info in self.event_handlers[event]:
-            try:
-                
-                # Check permissions if required
-                required_permissions = handler_info.get('required_permission', [])
-                if required_permissions:
-                    from db import users
-                    user_roles = users.get_user_roles(getattr(ws, 'username', None))
-                    if not user_roles or not any(role in user_roles for role in required_permissions):
-                        continue
-                
-                # Call the handler
-                handler = handler_info['handler']
-                
-                # Check handler signature to determine how to call it
-                sig = inspect.signature(handler)
-                
-                # Check if handler is async
-                if inspect.iscoroutinefunction(handler):
-                    # For async handlers, we need to schedule them
-                    import asyncio
-                    try:
-                        loop = asyncio.get_event_loop()
-                        if len(sig.parameters) == 2:
-                            asyncio.create_task(handler(ws, message_data))
-                        elif len(sig.parameters) == 3:
-                            asyncio.create_task(handler(ws, message_data, server_data))
-                        else:
-                            asyncio.create_task(handler(ws, message_data))
-                    except RuntimeError:
-                        # No event loop running, create one
-                        if len(sig.parameters) == 2:
-                            asyncio.run(handler(ws, message_data))
-                        elif len(sig.parameters) == 3:
-                            asyncio.run(handler(ws, message_data, server_data))
-                        else:
-                            asyncio.run(handler(ws, message_data))
-                else:
-                    # Synchronous handler
-                    if len(sig.parameters) == 2:
-                        handler(ws, message_data)
-                    elif len(sig.parameters) == 3:
-                        handler(ws, message_data, server_data)
-                    else:
-                        # Fallback: try with ws and message_data
-                        handler(ws, message_data)
-                    
-            except Exception as e:
-                Logger.error(f"Error in plugin '{handler_info['plugin_name']}' handler: {str(e)}")
-                import traceback
-                traceback.print_exc()
+        try:
+            asyncio.get_running_loop()
+            running = True
+        except RuntimeError:
+            running = False
+        
+        for handler_info in handlers:
+            if handler_info['plugin_name'] in self.disabled_plugins:
+                continue
+            if running:
+                self.dispatcher.submit(handler_info, ws, message_data, server_data)
+            else:
+                self._call_inline(handler_info, ws, message_data, server_data)
+    
+    def _call_inline(self, handler_info: Dict[str, Any], ws, message_data: Dict[str, Any], server_data: Optional[Dict[str, Any]]):
+        """Run a handler to completion when no event loop is running"""
+        try:
+            result = handler_info['call'](ws, message_data, server_data)
+            if handler_info['is_async']:
+                asyncio.run(result)
+        except Exception as e:
+            Logger.error(f"Error in plugin '{handler_info['plugin_name']}' handler: {str(e)}")
+            traceback.print_exc()
+    
+    def disable_plugin(self, plugin_name: str):
+        """Stop delivering events to a plugin until it is reloaded"""
+        self.disabled_plugins.add(plugin_name)
+        self.dispatcher.stop_plugin(plugin_name)
+        Logger.warning(f"Plugin '{plugin_name}' disabled, reload it to enable it again")
+    
+    def _stop_sandbox(self, plugin_name: str):
+        """Stop the worker process of a sandboxed plugin, if it has one"""
+        sandbox = self.loaded_plugins.get(plugin_name, {}).get('sandbox')
+        if sandbox:
+            sandbox.stop()
+    
+    def shutdown(self):
+        """Stop plugin workers and sandbox processes"""
+        for plugin_name in self.loaded_plugins:
+            self._stop_sandbox(plugin_name)
+        self.dispatcher.shutdown()
+    
+    def _unregister_commands(self, plugin_name: str):
+        """Remove commands a plugin registered with the command registry"""
+        from handlers.message import registry
+        registry.unregister_plugin(plugin_name)
     
     def reload_plugin(self, plugin_name: str):
         """Reload a specific plugin"""
@@ -155,9 +271,14 @@ class PluginManager:
         # Remove old handlers
         for event, handlers in self.event_handlers.items():
             self.event_handlers[event] = [h for h in handlers if h['plugin_name'] != plugin_name]
+        self._rebuild_index()
         
-        # Remove old plugin
+        # Remove old plugin, its commands and its queued events
+        self._stop_sandbox(plugin_name)
         del self.loaded_plugins[plugin_name]
+        self._unregister_commands(plugin_name)
+        self.dispatcher.stop_plugin(plugin_name)
+        self.disabled_plugins.discard(plugin_name)
         
         # Reload the plugin
         try:
@@ -173,8 +294,14 @@ class PluginManager:
         Logger.info("Reloading all plugins...")
         
         # Clear everything
+        for plugin_name in self.loaded_plugins:
+            self._unregister_commands(plugin_name)
+            self._stop_sandbox(plugin_name)
+            self.dispatcher.stop_plugin(plugin_name)
         self.loaded_plugins.clear()
+        self.disabled_plugins.clear()
         self.event_handlers.clear()
+        self.event_index = {}
         
         # Reload all plugins
         self.load_plugins()
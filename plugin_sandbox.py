@@ -0,0 +1,303 @@
+import asyncio
+import importlib.util
+import inspect
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Any, Optional
+from logger import Logger
+import json_codec
+
+_ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# IPC frames are compact JSON arrays sent length-prefixed over a multiprocessing pipe:
+#   parent -> worker  ["event", id, event, client, message_data]  |  ["stop"]
+#   worker -> parent  ["info", info, events, required_permission]  |  ["done", id, error]  |  ["error", message]
+#                     ["post", channel, content, user]
+
+def _encode(frame) -> bytes:
+    return json_codec.dumps_bytes(frame, default=str)
+
+def _decode(data: bytes):
+    return json_codec.loads(data)
+
+class RemoteClient:
+    """Stand-in for the websocket passed to handlers inside a worker process"""
+
+    def __init__(self, client: Optional[Dict[str, Any]]):
+        client = client or {}
+        self.username = client.get("username")
+        self.authenticated = client.get("authenticated", False)
+
+class RemotePoster:
+    """
+    Stand-in for the server's MessagePoster inside a worker process.
+    Posts are forwarded to the server, which saves and broadcasts them.
+    The returned object can be awaited or .result()-ed, but only confirms the post was sent.
+    """
+
+    def __init__(self, conn, send_lock):
+        self.conn = conn
+        self.send_lock = send_lock
+
+    def post(self, channel, content, user="OriginChats"):
+        with self.send_lock:
+            self.conn.send_bytes(_encode(["post", channel, content, user]))
+        return _SentPost()
+
+class _SentPost:
+    def result(self, timeout=None):
+        return None
+
+    def __await__(self):
+        return None
+        yield
+
+def _client_info(ws) -> Optional[Dict[str, Any]]:
+    if ws is None:
+        return None
+    return {"username": getattr(ws, "username", None), "authenticated": getattr(ws, "authenticated", False)}
+
+def _worker_main(conn, plugin_name: str, plugin_path: str, config: Dict[str, Any]):
+    """Entry point of a sandbox worker process: load the plugin and serve events"""
+    if _ROOT_DIR not in sys.path:
+        sys.path.insert(0, _ROOT_DIR)
+    try:
+        spec = importlib.util.spec_from_file_location(plugin_name, plugin_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        info = module.getInfo()
+        handlers = {}
+        for event in info.get("handles", []):
+            handler = getattr(module, f"on_{event}", None)
+            if handler is not None:
+                handlers[event] = (handler, len(inspect.signature(handler).parameters) == 3)
+        conn.send_bytes(_encode(["info", info, list(handlers), getattr(module, "required_permission", [])]))
+    except Exception as e:
+        conn.send_bytes(_encode(["error", f"{type(e).__name__}: {str(e)}"]))
+        return
+
+    loop = asyncio.new_event_loop()
+    send_lock = threading.Lock()
+    server_data = {"config": config, "sandboxed": True, "message_poster": RemotePoster(conn, send_lock)}
+    while True:
+        try:
+            frame = _decode(conn.recv_bytes())
+        except (EOFError, OSError):
+            break
+        if frame[0] == "stop":
+            break
+        if frame[0] != "event":
+            continue
+
+        _, request_id, event, client, message_data = frame
+        error = None
+        try:
+            handler, takes_server_data = handlers[event]
+            args = (RemoteClient(client), message_data, server_data) if takes_server_data else (RemoteClient(client), message_data)
+            result = handler(*args)
+            if inspect.iscoroutine(result):
+                loop.run_until_complete(result)
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e)}"
+            traceback.print_exc()
+        with send_lock:
+            conn.send_bytes(_encode(["done", request_id, error]))
+    loop.close()
+
+class SandboxedPlugin:
+    """
+    A plugin running in its own worker process.
+
+    Events are forwarded over a pipe and awaited on the server loop, so the
+    dispatcher's timeouts, circuit breaker and statistics apply as usual. Pipe
+    reads and writes happen on helper threads and never block the loop. If the
+    worker dies it is restarted with an increasing delay, which starts over
+    once a restarted worker completes a call or stays up for `max_restart_delay`.
+    A worker whose event times out or is cancelled is still busy with it, so it
+    is killed and restarted the same way.
+    """
+
+    def __init__(self, plugin_name: str, plugin_path: str, config: Dict[str, Any],
+                 start_timeout: float = 10.0, max_restart_delay: float = 30.0):
+        self.plugin_name = plugin_name
+        self.plugin_path = plugin_path
+        self.config = config
+        self.start_timeout = start_timeout
+        self.max_restart_delay = max_restart_delay
+
+        self.info = None
+        self.events = []
+        self.required_permission = []
+        self.process = None
+        self.conn = None
+        self.loop = None
+        self.message_poster = None
+        self.restarts = 0
+        # Restarts since a worker last proved healthy, sets the backoff delay
+        self._crashes = 0
+        self._started_at = None
+        self._stopping = False
+        self._terminated = None
+        self._next_id = 0
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._outbox = queue.SimpleQueue()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker and wait for it to report the plugin's info"""
+        ctx = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe(duplex=True)
+        process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, self.plugin_name, self.plugin_path, self.config),
+            name=f"plugin-{self.plugin_name}",
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+
+        if not parent_conn.poll(self.start_timeout):
+            process.terminate()
+            raise RuntimeError(f"Sandbox worker for '{self.plugin_name}' did not start in {self.start_timeout}s")
+        frame = _decode(parent_conn.recv_bytes())
+        if frame[0] == "error":
+            process.join(timeout=1)
+            raise RuntimeError(frame[1])
+
+        _, self.info, self.events, self.required_permission = frame
+        self.process = process
+        self.conn = parent_conn
+        self._started_at = time.monotonic()
+        threading.Thread(target=self._read_loop, args=(parent_conn,), name=f"plugin-{self.plugin_name}-reader", daemon=True).start()
+        threading.Thread(target=self._write_loop, args=(parent_conn, self._outbox), name=f"plugin-{self.plugin_name}-writer", daemon=True).start()
+        Logger.success(f"Started sandbox worker for plugin '{self.plugin_name}' (pid {process.pid})")
+        return self.info
+
+    async def call(self, event: str, ws, message_data: Dict[str, Any], server_data: Optional[Dict[str, Any]] = None):
+        """Forward an event to the worker and wait until the handler has finished"""
+        self.loop = asyncio.get_running_loop()
+        if server_data and server_data.get("message_poster"):
+            self.message_poster = server_data["message_poster"]
+        future = self.loop.create_future()
+        # Registering and queueing under the lock keeps _restart from swapping the outbox in between
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            process = self.process
+            self._pending[request_id] = future
+            self._outbox.put(_encode(["event", request_id, event, _client_info(ws), message_data]))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The future is cancelled along with the caller unless the worker already settled it
+            if future.cancelled():
+                self._terminate(process, event)
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    def _terminate(self, process, event: str):
+        """Kill a worker still running an abandoned event, its reader thread then restarts it"""
+        if self._stopping or process is None or not process.is_alive():
+            return
+        self._terminated = event
+        process.terminate()
+
+    def _write_loop(self, conn, outbox):
+        while True:
+            data = outbox.get()
+            if data is None:
+                break
+            try:
+                conn.send_bytes(data)
+            except (OSError, ValueError):
+                break
+
+    def _read_loop(self, conn):
+        while True:
+            try:
+                frame = _decode(conn.recv_bytes())
+            except (EOFError, OSError):
+                break
+            if frame[0] == "done":
+                # A handler error is the plugin's, the worker itself is healthy
+                self._crashes = 0
+                self._resolve(frame[1], frame[2])
+            elif frame[0] == "post":
+                self._post(*frame[1:])
+
+        if self._stopping:
+            return
+        if self._terminated is not None:
+            Logger.warning(f"Killed sandbox worker for plugin '{self.plugin_name}' after '{self._terminated}' timed out or was cancelled")
+            self._terminated = None
+        else:
+            Logger.error(f"Sandbox worker for plugin '{self.plugin_name}' exited unexpectedly")
+        self._restart()
+
+    def _post(self, channel: str, content: str, user: str):
+        if self.message_poster is None:
+            Logger.warning(f"Plugin '{self.plugin_name}' posted to #{channel} before the server was ready, dropping it")
+            return
+        self.message_poster.post(channel, content, user)
+
+    def _resolve(self, request_id: int, error: Optional[str]):
+        future = self._pending.get(request_id)
+        if future is None or self.loop is None:
+            return
+
+        def settle():
+            if future.done():
+                return
+            if error:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(None)
+        self.loop.call_soon_threadsafe(settle)
+
+    def _fail_pending(self, reason: str, request_ids=None):
+        for request_id in list(self._pending) if request_ids is None else request_ids:
+            self._resolve(request_id, reason)
+
+    def _restart(self):
+        """Restart a crashed worker, backing off while it keeps crashing"""
+        # Every event registered before the swap went to the dead worker or is stuck in its
+        # outbox, including ones queued after its writer stopped, so all of them are failed
+        with self._lock:
+            old_outbox, self._outbox = self._outbox, queue.SimpleQueue()
+            lost = list(self._pending)
+        old_outbox.put(None)
+        self._fail_pending("Sandbox worker exited", lost)
+        if self._started_at is not None and time.monotonic() - self._started_at >= self.max_restart_delay:
+            self._crashes = 0
+        while not self._stopping:
+            self.restarts += 1
+            self._crashes += 1
+            delay = min(self.max_restart_delay, 0.5 * (2 ** min(self._crashes - 1, 6)))
+            time.sleep(delay)
+            if self._stopping:
+                return
+            try:
+                self.start()
+                Logger.success(f"Restarted sandbox worker for plugin '{self.plugin_name}' (restart {self.restarts})")
+                return
+            except Exception as e:
+                Logger.error(f"Failed to restart sandbox worker for plugin '{self.plugin_name}': {str(e)}")
+
+    def stop(self):
+        """Stop the worker process"""
+        self._stopping = True
+        self._fail_pending("Sandbox worker stopped")
+        if self.process is None:
+            return
+        self._outbox.put(_encode(["stop"]))
+        self._outbox.put(None)
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.terminate()
+        Logger.info(f"Stopped sandbox worker for plugin '{self.plugin_name}'")
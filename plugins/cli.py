@@ -1,8 +1,7 @@
 import os
 import sys
 import asyncio
-import time
-import uuid
+from datetime import datetime, timezone
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -17,7 +16,10 @@ def getInfo():
     return {
         "name": "CLI Plugin",
         "description": "Manage your server, channels, and users through chat commands.",
-        "handles": ["new_message"]
+        "handles": ["new_message"],
+        "filters": {
+            "new_message": {"prefix": COMMAND_PREFIX, "roles": REQUIRED_PERMISSIONS}
+        }
     }
 
 
@@ -30,7 +32,7 @@ class CommandHandler:
         self.username = getattr(ws, 'username', None)
         
     def reply(self, message):
-        send_message_to_channel(self.channel, message, self.server_data)
+        self.server_data["message_poster"].post(self.channel, message)
     
     def error(self, message):
         self.reply(f"❌ Error: {message}")
@@ -52,13 +54,12 @@ class UserCommands:
         username = args[0]
         if users.ban_user(username):
             if handler.server_data and "connected_clients" in handler.server_data:
-                from handlers.websocket_utils import disconnect_user
-                loop = asyncio.get_event_loop()
-                loop.create_task(disconnect_user(
-                    handler.server_data["connected_clients"],
+                from handlers.websocket_utils import publish_disconnect_user
+                asyncio.run_coroutine_threadsafe(publish_disconnect_user(
+                    handler.server_data,
                     username,
                     "You have been banned from this server"
-                ))
+                ), handler.server_data["main_loop"])
             handler.success(f"Banned user '{username}'")
         else:
             handler.error(f"Failed to ban user '{username}'")
@@ -284,6 +285,49 @@ class ModerationCommands:
         else:
             handler.error("Failed to purge messages")
 
+    @staticmethod
+    def purge_after(handler, args):
+        """
+        Purge messages sent after a time: purgeafter <unix timestamp | YYYY-MM-DDTHH:MM[:SS] UTC>
+        """
+        if len(args) < 1:
+            return handler.error("Usage: purgeafter <unix timestamp | YYYY-MM-DDTHH:MM[:SS]>")
+
+        try:
+            timestamp = float(args[0])
+        except ValueError:
+            try:
+                timestamp = datetime.fromisoformat(args[0]).replace(tzinfo=timezone.utc).timestamp()
+            except ValueError:
+                return handler.error("Invalid time, use a unix timestamp or YYYY-MM-DDTHH:MM[:SS] (UTC)")
+
+        purged = channels.purge_messages_after(handler.channel, timestamp)
+        if purged is None:
+            handler.error("Failed to purge messages")
+        else:
+            handler.success(f"Purged {purged} messages sent after {datetime.fromtimestamp(timestamp, timezone.utc):%Y-%m-%d %H:%M:%S} UTC")
+
+    @staticmethod
+    def purge_user(handler, args):
+        """
+        Purge every message a user sent: purgeuser <username> [channel]
+        """
+        if len(args) < 1:
+            return handler.error("Usage: purgeuser <username> [channel]")
+
+        username = args[0].lower()
+        channel_name = args[1] if len(args) > 1 else None
+        if channel_name is not None and not channels.get_channel(channel_name):
+            return handler.error(f"Channel '{channel_name}' not found")
+
+        purged = channels.purge_user_messages(username, channel_name)
+        if purged is None:
+            return handler.error("The message index is still being built, try again shortly")
+        if not purged:
+            return handler.reply(f"No messages from '{username}' to purge")
+        details = ", ".join(f"#{name}: {count}" for name, count in sorted(purged.items()))
+        handler.success(f"Purged {sum(purged.values())} messages from '{username}' ({details})")
+
 
 COMMANDS = {
     "ban": UserCommands.ban,
@@ -301,6 +345,8 @@ COMMANDS = {
     "remove": RoleCommands.remove_role,
     "rolecolor": RoleCommands.rolecolor,
     "purge": ModerationCommands.purge,
+    "purgeafter": ModerationCommands.purge_after,
+    "purgeuser": ModerationCommands.purge_user,
 }
 
 
@@ -317,7 +363,7 @@ def show_help(handler, args):
             "User Management": ["ban", "unban", "banned", "users"],
             "Channel Management": ["channels", "create", "delete", "info"],
             "Role Management": ["roles", "createrole", "deleterole", "give", "remove", "rolecolor"],
-            "Moderation": ["purge"]
+            "Moderation": ["purge", "purgeafter", "purgeuser"]
         }
         
         for category, cmds in categories.items():
@@ -334,45 +380,13 @@ def show_help(handler, args):
 COMMANDS["help"] = show_help
 
 
-def send_message_to_channel(channel, content, server_data):
-    from handlers.websocket_utils import broadcast_to_all
-    
-    message = {
-        "user": "OriginChats",
-        "content": content.strip(),
-        "timestamp": time.time(),
-        "type": "message",
-        "pinned": False,
-        "id": str(uuid.uuid4())
-    }
-    
-    channels.save_channel_message(channel, message)
-    
-    if server_data and "connected_clients" in server_data:
-        broadcast_msg = {
-            "cmd": "message_new",
-            "message": message,
-            "channel": channel,
-            "global": True
-        }
-        loop = asyncio.get_event_loop()
-        loop.create_task(broadcast_to_all(server_data["connected_clients"], broadcast_msg))
-
-
 def on_new_message(ws, message_data, server_data=None):
+    # The filters in getInfo() already limit this to prefixed messages from admins
     if not ws or not getattr(ws, 'authenticated', False):
         Logger.warning("Authentication check failed")
         return
     
-    username = getattr(ws, 'username', None)
-    user_roles = users.get_user_roles(username)
-    
-    if not user_roles or not any(role in user_roles for role in REQUIRED_PERMISSIONS):
-        return
-    
     content = message_data.get("content", "").strip()
-    if not content.startswith(COMMAND_PREFIX):
-        return
     
     parts = content[len(COMMAND_PREFIX):].split()
     if not parts:
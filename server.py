@@ -1,8 +1,23 @@
-import asyncio, websockets, json, os
-from handlers.websocket_utils import send_to_client, heartbeat, broadcast_to_all, broadcast_to_channel
-from handlers.auth import handle_authentication
+import asyncio, websockets, os
+import json_codec
+from handlers.websocket_utils import (
+    send_to_client, send_raw, broadcast_to_all,
+    publish_to_all, publish_to_channel, disconnect_user
+)
+from handlers.heartbeat import HeartbeatScheduler
+from handlers import codecs
+from handlers.compression import build_extensions
+from handlers.auth import handle_authentication, handle_resume
 from handlers import message as message_handler
 from handlers.rate_limiter import RateLimiter
+from handlers.poster import MessagePoster
+from handlers.presence import PresenceIndex
+from handlers.subscriptions import ChannelSubscriptions
+from handlers.resume import SessionStore, load_key
+from handlers.compactor import Compactor
+from handlers.retention import RetentionEnforcer
+from db import segments, user_index
+from broker import build_broker, NODE_DOWN
 import watchers
 from plugin_manager import PluginManager
 from logger import Logger
@@ -10,17 +25,55 @@ from logger import Logger
 class OriginChatsServer:
     """OriginChats WebSocket server"""
     
-    def __init__(self, config_path="config.json"):
+    def __init__(self, config_path="config.json", worker_id=None, bus_path=None, broker=None):
         # Load configuration
         with open(os.path.join(os.path.dirname(__file__), config_path), "r") as f:
-            self.config = json.load(f)
+            self.config = json_codec.load(f)
         
+        # Set when running as one of several workers under the supervisor (see cluster.py)
+        self.worker_id = worker_id
+        # Links this server to the other nodes, None for a single standalone server (see broker.py)
+        self.broker = broker if broker is not None else build_broker(self.config, bus_path=bus_path)
+
         # Server state
         self.connected_clients = set()
         self.version = self.config["service"]["version"]
-        self.heartbeat_interval = 30
+        heartbeat_config = self.config.get("heartbeat", {})
+        self.heartbeats = HeartbeatScheduler(
+            interval=heartbeat_config.get("interval_seconds", 30),
+            timeout=heartbeat_config.get("timeout_seconds", 90),
+            buckets=heartbeat_config.get("buckets", 30),
+            max_buffer_bytes=heartbeat_config.get("max_buffer_bytes", 1024 * 1024)
+        )
         self.main_event_loop = None
         self.file_observer = None
+
+        # Channel storage, compacted and trimmed in the background by a single worker
+        storage_config = self.config.get("storage", {})
+        segments.configure(storage_config)
+        compaction_config = storage_config.get("compaction", {})
+        archive_config = storage_config.get("archive", {})
+        archive_after_days = archive_config.get("after_days")
+        if compaction_config.get("enabled", True) and worker_id in (None, 0):
+            self.compactor = Compactor(
+                interval=compaction_config.get("interval_seconds", 60),
+                garbage_ratio=compaction_config.get("garbage_ratio", 0.25),
+                min_segment_bytes=compaction_config.get("min_segment_bytes", 64 * 1024),
+                max_segments_per_run=compaction_config.get("max_segments_per_run", 16),
+                archive_after_seconds=archive_after_days * 86400 if archive_after_days is not None else None,
+                archive_keep_segments=archive_config.get("keep_segments"),
+                archive_codec=archive_config.get("codec", "gzip")
+            )
+        else:
+            self.compactor = None
+        retention_config = storage_config.get("retention", {})
+        if retention_config.get("enabled", True) and worker_id in (None, 0):
+            self.retention = RetentionEnforcer(
+                interval=retention_config.get("interval_seconds", 300),
+                step_messages=retention_config.get("step_messages", 50)
+            )
+        else:
+            self.retention = None
         
         # Initialize rate limiter if enabled
         rate_config = self.config.get("rate_limiting", {})
@@ -34,7 +87,29 @@ class OriginChatsServer:
             self.rate_limiter = None
         
         # Initialize plugin manager
-        self.plugin_manager = PluginManager()
+        self.plugin_manager = PluginManager(config=self.config)
+        
+        # Server state shared with handlers and plugins
+        self.server_data = {
+            "connected_clients": self.connected_clients,
+            "config": self.config,
+            "plugin_manager": self.plugin_manager,
+            "rate_limiter": self.rate_limiter,
+            "main_loop": None,
+            "broker": self.broker
+        }
+        self.server_data["message_poster"] = MessagePoster(self.server_data)
+        presence_config = self.config.get("presence", {})
+        self.presence = self.server_data["presence"] = PresenceIndex(
+            self.connected_clients,
+            tick=presence_config.get("broadcast_interval_ms", 250) / 1000,
+            broker=self.broker
+        )
+        resume_config = self.config.get("resume", {})
+        self.sessions = self.server_data["sessions"] = SessionStore(
+            load_key(), resume_config.get("session_ttl_seconds", 300)
+        )
+        self.subscriptions = self.server_data["subscriptions"] = ChannelSubscriptions(self.connected_clients, self.broker)
         
         Logger.info(f"OriginChats WebSocket Server v{self.version} initialized")
         if self.rate_limiter:
@@ -49,12 +124,15 @@ class OriginChatsServer:
         client_ip = headers.get('CF-Connecting-IP') or headers.get('X-Forwarded-For') or websocket.remote_address[0]
         Logger.add(f"New connection from {client_ip}")
         
+        # Clients can pick a codec with a subprotocol, otherwise frames are JSON
+        websocket.codec = codecs.codec_for_subprotocol(websocket.subprotocol)
+
         # Add to connected clients
         self.connected_clients.add(websocket)
         Logger.info(f"Total connected clients: {len(self.connected_clients)}")
         
-        # Start heartbeat task
-        heartbeat_task = asyncio.create_task(heartbeat(websocket, self.heartbeat_interval))
+        # Pings and dead peer detection are handled by the shared scheduler
+        self.heartbeats.add(websocket)
         
         try:
             # Send handshake message
@@ -64,64 +142,69 @@ class OriginChatsServer:
                     "server": self.config["server"],
                     "limits": self.config["limits"],
                     "version": "1.1.0",
-                    "validator_key": "originChats-" + self.config["rotur"]["validate_key"]
+                    "validator_key": "originChats-" + self.config["rotur"]["validate_key"],
+                    "codecs": list(codecs.CODECS),
+                    "codec": websocket.codec.name
                 }
             })
                 
             # Keep connection open and handle client messages
+            first_frame = True
             async for message in websocket:
+                is_first_frame, first_frame = first_frame, False
+                self.heartbeats.seen(websocket)
                 try:
-                    data = json.loads(message)
+                    data = websocket.codec.decode(message)
+
+                    # A codec switch is only allowed as the first frame
+                    if isinstance(data, dict) and data.get("cmd") == "codec":
+                        await self.switch_codec(websocket, data, is_first_frame)
+                        continue
                     
                     # Handle authentication
                     if data.get("cmd") == "auth" and not getattr(websocket, "authenticated", False):
-                        # Create server data object for authentication
-                        auth_server_data = {
-                            "connected_clients": self.connected_clients,
-                            "config": self.config,
-                            "plugin_manager": self.plugin_manager,
-                            "rate_limiter": self.rate_limiter
-                        }
                         await handle_authentication(
                             websocket, data, self.config, 
-                            self.connected_clients, client_ip, auth_server_data
+                            self.connected_clients, client_ip, self.server_data
                         )
                         continue
 
+                    # A reconnecting client can resume its session instead of authenticating
+                    if data.get("cmd") == "resume" and not getattr(websocket, "authenticated", False):
+                        await handle_resume(websocket, data, self.connected_clients, client_ip, self.server_data)
+                        continue
+
                     # Require authentication for other commands
                     if not getattr(websocket, "authenticated", False):
                         await send_to_client(websocket, {"cmd": "auth_error", "val": "Authentication required"})
                         continue
 
-                    # Create server data object for message handler
-                    server_data = {
-                        "connected_clients": self.connected_clients,
-                        "config": self.config,
-                        "plugin_manager": self.plugin_manager,
-                        "rate_limiter": self.rate_limiter
-                    }
-                    
                     # Handle message
-                    response = message_handler.handle(websocket, data, server_data)
+                    response = message_handler.handle(websocket, data, self.server_data)
                     if not response:
                         Logger.warning(f"No response for message: {data}")
                         continue
+
+                    # Shared responses are already encoded for this client's codec
+                    if isinstance(response, codecs.SharedFrame):
+                        await send_raw(websocket, response.for_client(websocket))
+                        continue
                     
                     if response.get("global", False):
                         # Check if this is a channel-specific message
                         if response.get("channel"):
                             # Broadcast only to users who have access to the channel
-                            await broadcast_to_channel(self.connected_clients, response, response["channel"])
+                            await publish_to_channel(self.server_data, response, response["channel"])
                         else:
                             # Broadcast to all clients if no channel specified
-                            await broadcast_to_all(self.connected_clients, response)
+                            await publish_to_all(self.server_data, response)
                         continue
                     
                     if response:
                         await send_to_client(websocket, response)
 
-                except json.JSONDecodeError:
-                    Logger.error(f"Received invalid JSON: {message[:50]}...")
+                except codecs.CodecError:
+                    Logger.error(f"Received invalid {websocket.codec.name} frame: {message[:50]!r}...")
                 except Exception as e:
                     Logger.error(f"Error processing message: {str(e)}")
                     
@@ -131,17 +214,47 @@ class OriginChatsServer:
             Logger.error(f"Error handling connection: {str(e)}")
         finally:
             # Clean up
-            heartbeat_task.cancel()
+            self.heartbeats.remove(websocket)
+            # Broadcast cleanup may already have dropped the socket, presence is updated regardless.
+            # If this was the user's last socket, they go offline in the next presence_update.
+            self.presence.disconnect(websocket)
+            self.subscriptions.remove(websocket)
             if websocket in self.connected_clients:
                 self.connected_clients.remove(websocket)
                 Logger.delete(f"Client {client_ip} removed. {len(self.connected_clients)} clients remaining")
-                
-                if getattr(websocket, "authenticated", False):
-                    await broadcast_to_all(self.connected_clients, {
-                        "cmd": "user_disconnect",
-                        "username": websocket.username
-                    })
     
+    async def switch_codec(self, websocket, data, is_first_frame):
+        """Handle a client's request to change the codec used for its frames"""
+        if not is_first_frame:
+            await send_to_client(websocket, {"cmd": "error", "val": "Codec can only be chosen in the first frame"})
+            return
+        codec = codecs.get_codec(data.get("val"))
+        if codec is None:
+            await send_to_client(websocket, {"cmd": "error", "val": f"Unsupported codec, available: {', '.join(codecs.CODECS)}"})
+            return
+        websocket.codec = codec
+        # Confirmed in the new codec, every later frame in both directions uses it
+        await send_to_client(websocket, {"cmd": "codec", "val": codec.name})
+
+    async def connect_broker(self):
+        """Join the other nodes: relay their broadcasts and presence to this node"""
+        broker = self.broker
+        # Channel broadcasts arrive on per-channel topics, see ChannelSubscriptions
+        broker.subscribe("all", lambda frame, node: broadcast_to_all(self.connected_clients, frame["message"]))
+        broker.subscribe("disconnect_user", lambda frame, node: disconnect_user(self.connected_clients, frame["username"], frame["reason"]))
+        broker.subscribe("presence", self.presence.apply_remote)
+        broker.subscribe("hello", lambda frame, node: self.presence.publish_state())
+        broker.subscribe(NODE_DOWN, lambda frame, node: self.presence.drop_node(node))
+
+        # On every (re)connect, share our users and ask the other nodes for theirs
+        def announce():
+            self.presence.publish_state()
+            broker.publish("hello")
+        broker.on_connect(announce)
+
+        await broker.start()
+        Logger.success(f"Node {broker.node_id} connected to the broker")
+
     async def broadcast_wrapper(self, message):
         """Wrapper for broadcast_to_all to maintain compatibility with watchers"""
         await broadcast_to_all(self.connected_clients, message)
@@ -150,9 +263,20 @@ class OriginChatsServer:
         """Start the WebSocket server"""
         # Store the main event loop for use in other threads
         self.main_event_loop = asyncio.get_event_loop()
+        self.server_data["main_loop"] = self.main_event_loop
+        self.heartbeats.start()
+        self.sessions.start(self.connected_clients)
+        # Built in a background thread, lookups report that it is not ready meanwhile
+        user_index.ensure_built()
+        if self.compactor:
+            self.compactor.start()
+        if self.retention:
+            self.retention.start()
+        if self.broker:
+            await self.connect_broker()
 
         # Setup file watchers for users.json and channels.json
-        self.file_observer = watchers.setup_file_watchers(self.broadcast_wrapper, self.main_event_loop)
+        self.file_observer = watchers.setup_file_watchers(self.broadcast_wrapper, self.main_event_loop, self.connected_clients, self.presence, self.subscriptions)
 
         # Get port from config or use default
         port = self.config.get("websocket", {}).get("port", 5613)
@@ -161,21 +285,31 @@ class OriginChatsServer:
         Logger.info(f"Starting WebSocket server on {host}:{port}")
         
         # Trigger server_start event for plugins
-        server_data = {
-            "connected_clients": self.connected_clients,
-            "config": self.config,
-            "plugin_manager": self.plugin_manager,
-            "rate_limiter": self.rate_limiter
-        }
-        self.plugin_manager.trigger_event("server_start", None, {}, server_data)
+        self.plugin_manager.trigger_event("server_start", None, {}, self.server_data)
         
         try:
-            async with websockets.serve(self.handle_client, host, port, ping_interval=None):
+            # Workers bind the same port with SO_REUSEPORT and the kernel spreads connections
+            async with websockets.serve(self.handle_client, host, port, ping_interval=None,
+                                        reuse_port=self.worker_id is not None,
+                                        compression=None,
+                                        extensions=build_extensions(self.config.get("compression")),
+                                        subprotocols=codecs.subprotocols(),
+                                        select_subprotocol=codecs.select_subprotocol):
                 Logger.success(f"WebSocket server running at ws://{host}:{port}")
                 
                 # Keep the server running
                 await asyncio.Future()
         finally:
+            self.heartbeats.stop()
+            self.sessions.stop()
+            if self.compactor:
+                self.compactor.stop()
+            if self.retention:
+                self.retention.stop()
+            self.plugin_manager.shutdown()
+            if self.broker:
+                await self.broker.close()
+            
             # Stop file watcher when server stops
             if self.file_observer:
                 self.file_observer.stop()
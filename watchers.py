@@ -1,21 +1,28 @@
 import asyncio
-import json
+import json_codec
 import os
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from db import users, channels, roles
+from handlers.websocket_utils import send_raw
+from handlers.codecs import SharedFrame
 from logger import Logger
 
 class FileWatcher(FileSystemEventHandler):
     """File system event handler for watching JSON files"""
     
-    def __init__(self, broadcast_func, main_loop):
+    def __init__(self, broadcast_func, main_loop, connected_clients=None, presence=None, subscriptions=None):
         self.broadcast_func = broadcast_func
         self.main_loop = main_loop
+        self.connected_clients = connected_clients if connected_clients is not None else set()
+        self.presence = presence
+        self.subscriptions = subscriptions
         
         # Cache for tracking changes
         self._users_cache = {}
         self._channels_cache = []
+        # Last channels_get payload sent to each distinct role set
+        self._channel_payloads = {}
         
         # Initialize caches
         self._load_initial_state()
@@ -25,24 +32,32 @@ class FileWatcher(FileSystemEventHandler):
         """Load initial state of files to track changes"""
         try:
             with open(users.users_index, 'r') as f:
-                self._users_cache = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+                self._users_cache = json_codec.load(f)
+        except (FileNotFoundError, json_codec.JSONDecodeError):
             self._users_cache = {}
         
         try:
             with open(channels.channels_index, 'r') as f:
-                self._channels_cache = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+                self._channels_cache = json_codec.load(f)
+        except (FileNotFoundError, json_codec.JSONDecodeError):
             self._channels_cache = []
     
     def on_modified(self, event):
         if event.is_directory:
             return
-        
-        filename = os.path.basename(event.src_path)
+        self._handle_file_change(event.src_path)
+
+    def on_moved(self, event):
+        # Database files are written to a temp file and renamed over the original
+        if event.is_directory:
+            return
+        self._handle_file_change(event.dest_path)
+
+    def _handle_file_change(self, path):
+        filename = os.path.basename(path)
              # Handle users.json changes
         if filename == 'users.json' or filename == 'roles.json':
-            Logger.edit(f"Users file changed: {event.src_path}")
+            Logger.edit(f"Users file changed: {path}")
             asyncio.run_coroutine_threadsafe(
                 self._handle_users_change(), 
                 self.main_loop
@@ -50,7 +65,7 @@ class FileWatcher(FileSystemEventHandler):
         
         # Handle channels.json changes
         elif filename == 'channels.json':
-            Logger.edit(f"Channels file changed: {event.src_path}")
+            Logger.edit(f"Channels file changed: {path}")
             asyncio.run_coroutine_threadsafe(
                 self._handle_channels_change(),
                 self.main_loop
@@ -58,6 +73,19 @@ class FileWatcher(FileSystemEventHandler):
     
     async def _handle_users_change(self):
         try:
+            try:
+                with open(users.users_index, 'r') as f:
+                    self._users_cache = json_codec.load(f)
+            except (FileNotFoundError, json_codec.JSONDecodeError):
+                pass
+
+            # Roles or role colors of online users may have changed
+            if self.presence is not None:
+                self.presence.refresh(self._users_cache)
+            # ...and with them the channels they can view
+            if self.subscriptions is not None:
+                self.subscriptions.refresh(self._users_cache, self._channels_cache)
+
             await self.broadcast_func({
                 "cmd": "users_list",
                 "users": users.get_users()
@@ -71,24 +99,53 @@ class FileWatcher(FileSystemEventHandler):
         try:
             # Load new channels data
             with open(channels.channels_index, 'r') as f:
-                new_channels = json.load(f)
-            
-            await self.broadcast_func({
-                "cmd": "channels_get",
-                "val": new_channels
-            })
+                new_channels = json_codec.load(f)
+            self._channels_cache = new_channels
+            if self.subscriptions is not None:
+                self.subscriptions.refresh(self._users_cache, new_channels)
+
+            # Group authenticated sessions by role set so each distinct view is built once
+            sessions_by_roles = {}
+            for ws in self.connected_clients.copy():
+                if not getattr(ws, "authenticated", False):
+                    continue
+                user_data = self._users_cache.get(getattr(ws, "username", None))
+                if not user_data:
+                    continue
+                role_set = frozenset(user_data.get("roles", []))
+                sessions_by_roles.setdefault(role_set, []).append(ws)
+
+            # A role set with nobody online missed the changes since its last push, and
+            # whoever connects with it next gets the list then, so its payload is unknown
+            for role_set in list(self._channel_payloads):
+                if role_set not in sessions_by_roles:
+                    del self._channel_payloads[role_set]
+
+            sent = 0
+            for role_set, sessions in sessions_by_roles.items():
+                visible = channels.filter_channels_for_roles(new_channels, role_set)
+                # Skip role sets whose view of the channel list did not change
+                if self._channel_payloads.get(role_set) == visible:
+                    continue
+                self._channel_payloads[role_set] = visible
+                frame = SharedFrame({"cmd": "channels_get", "val": visible})
+                for ws in sessions:
+                    if await send_raw(ws, frame.for_client(ws)):
+                        sent += 1
+
+            Logger.info(f"Sent channel updates to {sent} clients across {len(sessions_by_roles)} role sets")
             
         except Exception as e:
             Logger.error(f"Error handling channels.json change: {e}")
 
-def setup_file_watchers(broadcast_func, main_loop):
+def setup_file_watchers(broadcast_func, main_loop, connected_clients=None, presence=None, subscriptions=None):
     """Setup file watchers for users.json and channels.json"""
     
     # Get the database directory
     db_dir = os.path.dirname(users.users_index)
     
     # Create event handler
-    event_handler = FileWatcher(broadcast_func, main_loop)
+    event_handler = FileWatcher(broadcast_func, main_loop, connected_clients, presence, subscriptions)
     
     # Create observer
     observer = Observer()